@@ -1,8 +1,7 @@
 from django.contrib import admin
-from .models import Category, Product
+from .models import Category, Job, Order, OrderLine, Product
 from mptt.admin import DraggableMPTTAdmin
 from . import forms
-from django.db.models import F
 # Register your models here.
 
 
@@ -22,7 +21,9 @@ class ProductModelAdmin(admin.ModelAdmin):
     generated automatically. Filters the categories in a way
     that ensures that a product can be put only in a leaf (bottom)
     node and not in a category which contains subcategories.
+    The SKU is set only by the products import.
     """
+    readonly_fields = ('sku',)
 
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
         """
@@ -30,11 +31,41 @@ class ProductModelAdmin(admin.ModelAdmin):
         """
 
         if db_field.name == "category":
-            kwargs["queryset"] = Category.objects.filter(rght=F('lft') + 1)
+            kwargs["queryset"] = Category.objects.filter(is_leaf=True)
         return super(__class__, self).formfield_for_foreignkey(
             db_field, request, **kwargs
         )
 
 
+class OrderLineInline(admin.TabularInline):
+    model = OrderLine
+    fields = ('product', 'product_name', 'price', 'quantity')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class OrderModelAdmin(admin.ModelAdmin):
+    """
+    Shows the orders with their lines, which are not editable as
+    they keep the products as they were at the time of the order.
+    """
+    list_display = ('number', 'created', 'first_name', 'last_name', 'total')
+    readonly_fields = ('number', 'created', 'total')
+    inlines = (OrderLineInline,)
+
+
+class JobModelAdmin(admin.ModelAdmin):
+    """
+    Lists the queued and the failed jobs, so that
+    a failed job can be queued again or deleted.
+    """
+    list_display = ('task', 'status', 'attempts', 'run_at', 'created')
+    list_filter = ('status', 'task')
+    readonly_fields = ('claim', 'lease_expires', 'last_error')
+
+
 admin.site.register(Category, CategoryDraggableMPTTAdmin)
 admin.site.register(Product, ProductModelAdmin)
+admin.site.register(Order, OrderModelAdmin)
+admin.site.register(Job, JobModelAdmin)
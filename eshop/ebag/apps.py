@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class EbagConfig(AppConfig):
     name = 'ebag'
     verbose_name = 'Ebag.bg - Buy food online and save time!'
+
+    def ready(self):
+        """
+        Connects the signal receivers and registers the job tasks.
+        """
+        from . import signals  # noqa: F401
+        from . import tasks  # noqa: F401
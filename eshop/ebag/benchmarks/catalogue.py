@@ -0,0 +1,201 @@
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.template.defaultfilters import slugify
+from ebag.models import Category, Product
+from ebag.caching import CategoryTreeCache
+from ebag.stats import CategoryStats
+from decimal import Decimal
+import os
+import random
+
+WORDS = (
+    "fresh", "organic", "bio", "classic", "light", "premium", "local",
+    "milk", "cheese", "yogurt", "butter", "bread", "honey", "apple",
+    "banana", "tomato", "coffee", "tea", "juice", "water", "rice",
+    "pasta", "chicken", "salmon", "chocolate", "cookies", "olive", "oil",
+)
+
+PLACEHOLDER_DIR = "benchmark"
+PLACEHOLDER_NAME = "placeholder-{number}.png"
+
+
+def create_placeholders(count):
+    """
+    Creates (if missing) `count` small solid colour PNG images in
+    MEDIA_ROOT and returns their names, as stored in Product.image.
+
+    :param count: The number of distinct placeholder images
+    :type count: int
+    """
+    from PIL import Image
+
+    directory = os.path.join(settings.MEDIA_ROOT, PLACEHOLDER_DIR)
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for number in range(count):
+        name = PLACEHOLDER_NAME.format(number=number)
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            colour = (
+                number * 67 % 256, number * 131 % 256, number * 29 % 256
+            )
+            Image.new("RGB", (300, 300), colour).save(path)
+        names.append(PLACEHOLDER_DIR + "/" + name)
+    return names
+
+
+def build_categories(depth, branching, first_id, first_tree_id):
+    """
+    Returns unsaved Category instances forming `branching` trees of
+    the given depth, where every non-leaf category has `branching`
+    subcategories. The ids, URLs and MPTT fields are computed here, so
+    the categories can be inserted with bulk_create(), without the
+    per-node tree updates done by MPTTModel.save().
+
+    :param depth: The number of levels, 1 creates only root categories
+    :type depth: int
+    :param branching: The number of roots and subcategories per category
+    :type branching: int
+    :param first_id: The id of the first category
+    :type first_id: int
+    :param first_tree_id: The tree_id of the first root category
+    :type first_tree_id: int
+    """
+    categories = []
+    next_id = [first_id]
+
+    def add_category(parent_id, tree_id, level, lft, path):
+        category = Category(
+            id=next_id[0],
+            name="Category " + path,
+            slug=slugify("Category " + path),
+            parent_id=parent_id,
+            tree_id=tree_id,
+            level=level,
+            lft=lft,
+            is_leaf=level == depth - 1
+        )
+        category.url = category.build_url()
+        categories.append(category)
+        next_id[0] += 1
+        rght = lft + 1
+        if not category.is_leaf:
+            for number in range(1, branching + 1):
+                rght = add_category(
+                    category.id, tree_id, level + 1, rght,
+                    "%s.%d" % (path, number)
+                ) + 1
+        category.rght = rght
+        return rght
+
+    for number in range(branching):
+        add_category(None, first_tree_id + number, 0, 1, str(number + 1))
+    return categories
+
+
+def build_products(category, count, images, rnd):
+    """
+    Returns `count` unsaved products with random names,
+    prices and images for the given category.
+
+    :param category: The (leaf) category
+    :type category: Category
+    :param count: The number of products
+    :type count: int
+    :param images: The image names to choose from, may be empty
+    :type images: list
+    :param rnd: The random numbers generator
+    :type rnd: random.Random
+    """
+    return [
+        Product(
+            name=" ".join(rnd.sample(WORDS, 3)).capitalize(),
+            category_id=category.id,
+            description=" ".join(rnd.choice(WORDS) for i in range(20)),
+            price=Decimal(rnd.randint(10, 10000)) / 100,
+            image=rnd.choice(images) if images else ""
+        )
+        for i in range(count)
+    ]
+
+
+def bulk_insert(model, objects, batch_size):
+    """
+    Inserts the objects with one bulk_create() per batch. The batches
+    are sliced here, as the batch_size argument of bulk_create() is not
+    capped to the DB limits (e.g. the SQLite variables limit).
+
+    :param model: The objects model
+    :type model: Model
+    :param objects: The unsaved objects
+    :type objects: list
+    :param batch_size: The maximum number of objects per INSERT
+    :type batch_size: int
+    """
+    for start in range(0, len(objects), batch_size):
+        model.objects.bulk_create(objects[start:start + batch_size])
+
+
+def generate_catalogue(depth, branching, products_per_leaf,
+                       images=0, seed=0, batch_size=1000):
+    """
+    Adds a synthetic catalogue to the DB, in a single transaction and
+    with bulk inserts: the categories trees and `products_per_leaf`
+    products in every leaf category. The same parameters and seed
+    always generate the same catalogue. Returns a tuple with the
+    number of the created categories and products.
+
+    :param depth: The number of category levels
+    :type depth: int
+    :param branching: The number of roots and subcategories per category
+    :type branching: int
+    :param products_per_leaf: The number of products per leaf category
+    :type products_per_leaf: int
+    :param images: The number of distinct placeholder images,
+                   0 leaves the products without images
+    :type images: int
+    :param seed: The random numbers generator seed
+    :type seed: int
+    :param batch_size: The number of rows per INSERT
+    :type batch_size: int
+    """
+    rnd = random.Random(seed)
+    image_names = create_placeholders(images)
+    products_count = 0
+    with transaction.atomic():
+        last = Category.objects.aggregate(
+            last_id=Max("id"), last_tree_id=Max("tree_id")
+        )
+        categories = build_categories(
+            depth,
+            branching,
+            (last["last_id"] or 0) + 1,
+            (last["last_tree_id"] or 0) + 1
+        )
+        bulk_insert(Category, categories, batch_size)
+        # The ids are set explicitly, so the sequences which are not
+        # updated by such inserts (e.g. on PostgreSQL) are reset
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [Category]):
+                cursor.execute(sql)
+        products = []
+        for category in categories:
+            if not category.is_leaf:
+                continue
+            products += build_products(
+                category, products_per_leaf, image_names, rnd
+            )
+            if len(products) >= batch_size:
+                bulk_insert(Product, products, batch_size)
+                products_count += len(products)
+                products = []
+        bulk_insert(Product, products, batch_size)
+        products_count += len(products)
+        # bulk_create() sends no signals, so the category stats are
+        # rebuilt and the tree cache is invalidated here
+        CategoryStats.rebuild()
+        transaction.on_commit(CategoryTreeCache.invalidate)
+    return len(categories), products_count
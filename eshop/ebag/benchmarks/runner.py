@@ -0,0 +1,299 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, F, Max, Sum
+from django.test import Client
+from django.urls import reverse
+from ebag.caching import ProductCache
+from ebag.models import Category, Job, Order, OrderLine, Product
+from ebag.orders import Orders
+import django
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+
+def percentile(values, percent):
+    """
+    Returns the percentile of the values, linearly
+    interpolated between the closest ranks.
+
+    :param values: The measured values
+    :type values: list
+    :param percent: The percentile, between 0 and 100
+    :type percent: float
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class StorefrontBenchmark:
+    """
+    Times the storefront views through the Django test client, so the
+    whole middleware, view and template stack is measured, against the
+    catalogue in the DB (see generate_catalogue). Every scenario is
+    repeated for the latency percentiles, then run once more with the
+    queries captured and once with tracemalloc on, so the instrumentation
+    does not distort the timings.
+    """
+
+    CART_ITEMS = 5
+    # The number of lines of the checkout scenarios carts
+    CHECKOUT_LINES = (1, 10, 200)
+    CHECKOUT_FORM = {
+        "country": "1",
+        "first_name": "John",
+        "last_name": "Doe",
+        "address_1": "1 Main Street",
+        "state_region": "Sofia",
+        "post_code": "1000",
+        "email": "john@example.com",
+        "phone": "359888123456",
+    }
+
+    def __init__(self, repeat=100, warmup=10):
+        """
+        :param repeat: The number of timed requests per scenario
+        :type repeat: int
+        :param warmup: The number of untimed requests per scenario
+        :type warmup: int
+        """
+        self.repeat = repeat
+        self.warmup = warmup
+        self.client = Client()
+        self.category = Category.objects.filter(is_leaf=True).annotate(
+            products_count=Count("product")
+        ).order_by("-products_count", "id").first()
+        if self.category is None or not self.category.products_count:
+            raise ValueError(
+                "There are no products, run generate_catalogue first."
+            )
+        self.root = Category.objects.get(
+            tree_id=self.category.tree_id, level=0
+        )
+        self.product_ids = list(Product.objects.filter(
+            category=self.category
+        ).order_by("id").values_list("id", flat=True)[:self.CART_ITEMS])
+        self.last_page = -(
+            -self.category.products_count // settings.CATEGORY_PAGE_SIZE
+        )
+        self.checkout_ids = list(Product.objects.order_by("id").values_list(
+            "id", flat=True
+        )[:max(self.CHECKOUT_LINES)])
+        self.quantity = 0
+        self.update_cart()
+
+    def update_cart(self, product_ids=None):
+        """
+        Sets a new quantity of the cart items, so that
+        every call really changes the stored cart.
+        """
+        self.quantity = self.quantity % 9 + 1
+        items = [
+            {"product_id": str(pk), "quantity": str(self.quantity)}
+            for pk in (product_ids or self.product_ids)
+        ]
+        return self.client.post(
+            reverse("update_cart"), {"items": json.dumps(items)}
+        )
+
+    def checkout_scenarios(self):
+        """
+        Returns a list of (name, setup, function) of the checkout
+        of carts with CHECKOUT_LINES lines, or fewer if there are
+        not enough products. The cart emptied by the checkout is
+        filled again by the untimed setup. The placed orders are
+        deleted by delete_orders() when the scenarios are done.
+        """
+        scenarios = []
+        for lines in self.CHECKOUT_LINES:
+            product_ids = self.checkout_ids[:lines]
+            scenarios.append((
+                "checkout_%d_line%s" % (lines, "s" if lines > 1 else ""),
+                lambda product_ids=product_ids: self.update_cart(
+                    product_ids
+                ),
+                lambda: self.client.post(
+                    reverse("checkout_view"),
+                    self.CHECKOUT_FORM,
+                    HTTP_REFERER=reverse("checkout_view")
+                )
+            ))
+        return scenarios
+
+    def scenarios(self):
+        """
+        Returns a list of (name, function) with the measured requests.
+        """
+        url = "/" + self.category.url + "/"
+        return [
+            ("home_view", lambda: self.client.get(reverse("home_view"))),
+            ("category_view", lambda: self.client.get(url)),
+            ("category_view_last_page", lambda: self.client.get(
+                url, {"page": self.last_page}
+            )),
+            ("category_subtree_view", lambda: self.client.get(
+                "/" + self.root.url + "/", {"sort": "price", "price": 1}
+            )),
+            ("cart_view", lambda: self.client.get(reverse("cart_view"))),
+            ("checkout_view", lambda: self.client.get(
+                reverse("checkout_view"), HTTP_REFERER=reverse("cart_view")
+            )),
+            ("ajax_session_cart", self.update_cart),
+        ]
+
+    def measure(self, function, setup=None, order=False):
+        """
+        Returns the latency percentiles in milliseconds, the number
+        of queries and the peak of the memory allocated by a request.
+        Every response is checked, untimed, so that no failed request
+        is measured.
+
+        :param function: Sends the request, returns the response
+        :type function: function
+        :param setup: Called untimed before every request
+        :type setup: function
+        :param order: The requests must place an order
+        :type order: bool
+        """
+        setup = setup or (lambda: None)
+        for i in range(self.warmup):
+            setup()
+            self.check_response(function(), order)
+        timings = []
+        for i in range(self.repeat):
+            setup()
+            start = time.perf_counter()
+            response = function()
+            timings.append((time.perf_counter() - start) * 1000)
+            self.check_response(response, order)
+        setup()
+        queries = self.count_queries(
+            lambda: self.check_response(function(), order)
+        )
+        setup()
+        tracemalloc.start()
+        try:
+            response = function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.check_response(response, order)
+        return {
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+            "p99_ms": round(percentile(timings, 99), 3),
+            "mean_ms": round(sum(timings) / len(timings), 3),
+            "queries": queries,
+            "peak_memory_kb": round(peak / 1024, 1),
+        }
+
+    def count_queries(self, function):
+        """
+        Returns the number of queries executed by the function. Not
+        CaptureQueriesContext, as connection.queries is reset when
+        every request starts.
+        """
+        queries = []
+
+        def wrapper(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            function()
+        return len(queries)
+
+    def check_response(self, response, order=False):
+        """
+        Makes sure that the measured page is really rendered, not
+        e.g. a redirect to the home page, or that the order is really
+        placed, redirecting to the thank you page, not e.g. the
+        checkout form rendered again with an out of stock error.
+
+        :param response: The response of a measured request
+        :type response: HttpResponse
+        :param order: The request must place an order
+        :type order: bool
+        """
+        if order:
+            if response.status_code != 302 or not response.url.startswith(
+                    reverse("thank_you_view")):
+                raise ValueError("%s placed no order, returned status %d." % (
+                    response.request["PATH_INFO"], response.status_code
+                ))
+        elif response.status_code != 200:
+            raise ValueError("%s returned status %d." % (
+                response.request["PATH_INFO"], response.status_code
+            ))
+
+    def metadata(self):
+        """
+        Returns the environment details saved along with the results.
+        """
+        try:
+            commit = subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=settings.BASE_DIR,
+                stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "debug": settings.DEBUG,
+            "cart_storage": settings.CART_STORAGE,
+            "categories": Category.objects.count(),
+            "products": Product.objects.count(),
+            "repeat": self.repeat,
+            "warmup": self.warmup,
+        }
+
+    def delete_orders(self, last_order_id, last_job_id):
+        """
+        Deletes the orders placed by the checkout scenarios, giving
+        their stock back, and the jobs they queued, so that the
+        benchmarked catalogue does not change from run to run.
+
+        :param last_order_id: The last order id before the scenarios
+        :type last_order_id: int
+        :param last_job_id: The last job id before the scenarios
+        :type last_job_id: int
+        """
+        quantities = dict(OrderLine.objects.filter(
+            order_id__gt=last_order_id, product__isnull=False
+        ).values("product_id").annotate(
+            quantity=Sum("quantity")
+        ).values_list("product_id", "quantity").order_by())
+        for product_id, quantity in quantities.items():
+            Product.objects.filter(pk=product_id).update(
+                stock=F("stock") + quantity
+            )
+        ProductCache.invalidate_many(quantities)
+        Order.objects.filter(id__gt=last_order_id).delete()
+        Job.objects.filter(id__gt=last_job_id, task__in=Orders.JOBS).delete()
+
+    def run(self):
+        """
+        Returns the results of all the scenarios with the metadata.
+        """
+        results = {
+            name: self.measure(function)
+            for name, function in self.scenarios()
+        }
+        last_order_id = Order.objects.aggregate(id=Max("id"))["id"] or 0
+        last_job_id = Job.objects.aggregate(id=Max("id"))["id"] or 0
+        try:
+            for name, setup, function in self.checkout_scenarios():
+                results[name] = self.measure(function, setup, order=True)
+        finally:
+            self.delete_orders(last_order_id, last_job_id)
+        return {"meta": self.metadata(), "results": results}
@@ -0,0 +1,129 @@
+from django.db import OperationalError, connection
+from ebag.models import Category, Order, OrderLine, Product
+from ebag.orders import Orders
+from ebag.stock import OutOfStock
+import random
+import threading
+import time
+
+
+class CheckoutStress:
+    """
+    Checks out a single hot product from many threads at once, each
+    thread ordering until the product is sold out, then verifies that
+    it was not oversold and reports the orders throughput. The
+    transactions which fail on lock contention (a deadlock, a lock wait
+    timeout or a locked SQLite database) are retried. The product and
+    its orders are deleted afterwards.
+    """
+
+    CUSTOMER = {
+        "country": "1",
+        "first_name": "John",
+        "last_name": "Doe",
+        "address_1": "1 Main Street",
+        "state_region": "Sofia",
+        "post_code": "1000",
+        "email": "john@example.com",
+        "phone": "359888123456",
+    }
+
+    def __init__(self, threads=16, stock=200, quantity=1, max_retries=100):
+        """
+        :param threads: The number of the concurrent buyers
+        :type threads: int
+        :param stock: The initial stock of the product
+        :type stock: int
+        :param quantity: The quantity of every order
+        :type quantity: int
+        :param max_retries: The retries of a failed order
+        :type max_retries: int
+        """
+        self.threads = threads
+        self.stock = stock
+        self.quantity = quantity
+        self.max_retries = max_retries
+
+    def buy(self, product_id, barrier, result):
+        """
+        Orders the product until it is sold out.
+        """
+        cart = {str(product_id): str(self.quantity)}
+        retries = 0
+        try:
+            barrier.wait()
+            while retries <= self.max_retries:
+                try:
+                    Orders.place(cart, self.CUSTOMER)
+                except OutOfStock:
+                    result["out_of_stock"] += 1
+                    return
+                except OperationalError:
+                    retries += 1
+                    result["retries"] += 1
+                    time.sleep(random.uniform(0, 0.005))
+                else:
+                    retries = 0
+                    result["orders"] += 1
+            result["failed"] += 1
+        finally:
+            connection.close()
+
+    def run(self):
+        """
+        Returns the orders, retries and throughput and the
+        stock check results.
+        """
+        category = Category.objects.create(name="Stress test")
+        product = Product.objects.create(
+            name="Hot product",
+            category=category,
+            description="Hot product",
+            price=1,
+            image="stress-test.png",
+            stock=self.stock
+        )
+        try:
+            results = [
+                {"orders": 0, "out_of_stock": 0, "retries": 0, "failed": 0}
+                for i in range(self.threads)
+            ]
+            barrier = threading.Barrier(self.threads + 1)
+            threads = [
+                threading.Thread(
+                    target=self.buy, args=(product.pk, barrier, result)
+                )
+                for result in results
+            ]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+            orders = sum(result["orders"] for result in results)
+            lines = OrderLine.objects.filter(product=product)
+            sold = sum(lines.values_list("quantity", flat=True))
+            remaining = Product.objects.values_list(
+                "stock", flat=True
+            ).get(pk=product.pk)
+            return {
+                "threads": self.threads,
+                "initial_stock": self.stock,
+                "orders": orders,
+                "sold": sold,
+                "remaining_stock": remaining,
+                "out_of_stock": sum(r["out_of_stock"] for r in results),
+                "retries": sum(r["retries"] for r in results),
+                "failed": sum(r["failed"] for r in results),
+                "seconds": round(seconds, 3),
+                "orders_per_second": round(orders / seconds, 1),
+                "consistent": (
+                    sold == orders * self.quantity and
+                    sold + remaining == self.stock
+                ),
+            }
+        finally:
+            Order.objects.filter(lines__product=product).delete()
+            category.delete()
@@ -0,0 +1,381 @@
+from django.conf import settings
+from django.core.cache import caches
+from .models import Category, CategoryPriceBucket, Product
+from .profiling import Profiling
+from django.utils.http import urlencode
+import hashlib
+import time
+
+
+class CategoryTreeCache:
+    """
+    Keeps the categories tree, already serialized in tree order,
+    in the Django cache framework so that the menu query is not
+    executed on every request in every worker. Contains only static
+    methods so serves just as a namespace for this group of methods.
+
+    Two cache levels are used:
+    1) A local-memory cache per worker process, holding the tree for
+    the current version.
+    2) A shared (file-based by default) cache, holding the tree version
+    counter and the serialized tree, so that all the workers see the same
+    data and a single invalidation reaches all of them.
+
+    The product stats of the categories (product_count, the price range
+    and histogram) have their own version counter, moved forward on the
+    product changes, so that these don't invalidate what depends on the
+    categories only, like the cached pages keys.
+    """
+
+    VERSION_KEY = "category_tree_version"
+    STATS_VERSION_KEY = "category_stats_version"
+    TREE_KEY = "category_tree_{version}_{stats_version}"
+    # The last read (key, rows, {id: row position}), so that the rows
+    # read several times per request are not unpickled from the local
+    # cache every time nor scanned to find a category. The rows of a
+    # version never change, so they are shared read-only
+    memo = (None, None, None)
+    FIELDS = ("id", "name", "slug", "url", "parent_id", "last_update",
+              "lft", "rght", "tree_id", "level", "is_leaf",
+              "product_count", "min_price", "max_price")
+
+    @staticmethod
+    def local_cache():
+        return caches[settings.CATEGORY_TREE_LOCAL_CACHE]
+
+    @staticmethod
+    def shared_cache():
+        return caches[settings.CATEGORY_TREE_SHARED_CACHE]
+
+    @staticmethod
+    def get_version(key=VERSION_KEY):
+        """
+        Returns the current tree version from the shared cache,
+        initializing it if it's missing. The initial value is
+        time based so that a cleared shared cache never hands out
+        a version number already used before.
+
+        :param key: VERSION_KEY or STATS_VERSION_KEY
+        :type key: str
+        """
+        shared_cache = CategoryTreeCache.shared_cache()
+        version = shared_cache.get(key)
+        if version is None:
+            shared_cache.add(key, int(time.time() * 1000), timeout=None)
+            version = shared_cache.get(key)
+        return version
+
+    @staticmethod
+    def get_stats_version():
+        return CategoryTreeCache.get_version(
+            CategoryTreeCache.STATS_VERSION_KEY
+        )
+
+    @staticmethod
+    def invalidate(key=VERSION_KEY):
+        """
+        Moves the tree version forward. The cached trees of the
+        previous versions are not deleted but just never read again
+        and expire from the caches.
+
+        :param key: VERSION_KEY or STATS_VERSION_KEY
+        :type key: str
+        """
+        shared_cache = CategoryTreeCache.shared_cache()
+        try:
+            shared_cache.incr(key)
+        except ValueError:
+            CategoryTreeCache.get_version(key)
+            shared_cache.incr(key)
+
+    @staticmethod
+    def invalidate_stats():
+        """
+        Moves the stats version forward, so that the tree is read
+        again with the new product stats, while the tree version
+        stays the same.
+        """
+        CategoryTreeCache.invalidate(CategoryTreeCache.STATS_VERSION_KEY)
+
+    @staticmethod
+    def serialize():
+        """
+        Returns the categories tree from the DB as a list of
+        dicts, ordered by tree_id and lft as expected by
+        mptt's recursetree template tag. Every category has its
+        price ranges histogram (see CategoryPriceBucket) as a list
+        of product counts in "price_histogram".
+        """
+        rows = list(
+            Category.objects.order_by("tree_id", "lft").values(
+                *CategoryTreeCache.FIELDS
+            )
+        )
+        histograms = {row["id"]: [] for row in rows}
+        for category_id, product_count in \
+                CategoryPriceBucket.objects.order_by(
+                    "category_id", "bucket").values_list(
+                    "category_id", "product_count"):
+            histograms[category_id].append(product_count)
+        for row in rows:
+            row["price_histogram"] = histograms[row["id"]]
+        return rows
+
+    @staticmethod
+    def build_node(row):
+        """
+        Returns an unsaved Category instance built from a cached
+        row, with the histogram in the price_histogram attribute.
+        """
+        node = Category(**{
+            field: row[field] for field in CategoryTreeCache.FIELDS
+        })
+        node.price_histogram = row["price_histogram"]
+        return node
+
+    @staticmethod
+    def get_rows():
+        """
+        Returns the serialized categories tree, looking for it first
+        in the local cache, then in the shared one and eventually
+        rebuilding it from the DB.
+        """
+        return CategoryTreeCache.get_tree()[0]
+
+    @staticmethod
+    def get_tree():
+        """
+        Returns (the serialized categories tree, {category id: row
+        position}), the positions being indexed once per tree version
+        and process, when the rows are read from the caches.
+        """
+        key = CategoryTreeCache.TREE_KEY.format(
+            version=CategoryTreeCache.get_version(),
+            stats_version=CategoryTreeCache.get_stats_version()
+        )
+        memo_key, rows, positions = CategoryTreeCache.memo
+        if memo_key == key:
+            Profiling.cache_lookup("category_tree_local", 1, 0)
+            return rows, positions
+        local_cache = CategoryTreeCache.local_cache()
+        rows = local_cache.get(key)
+        if rows is not None:
+            Profiling.cache_lookup("category_tree_local", 1, 0)
+        else:
+            Profiling.cache_lookup("category_tree_local", 0, 1)
+            shared_cache = CategoryTreeCache.shared_cache()
+            rows = shared_cache.get(key)
+            Profiling.cache_lookup(
+                "category_tree_shared",
+                int(rows is not None),
+                int(rows is None)
+            )
+            if rows is None:
+                rows = CategoryTreeCache.serialize()
+                shared_cache.set(
+                    key, rows, timeout=settings.CATEGORY_TREE_CACHE_TIMEOUT
+                )
+            local_cache.set(
+                key, rows, timeout=settings.CATEGORY_TREE_CACHE_TIMEOUT
+            )
+        positions = {row["id"]: position for position, row in enumerate(rows)}
+        CategoryTreeCache.memo = (key, rows, positions)
+        return rows, positions
+
+    @staticmethod
+    def get_nodes():
+        """
+        Returns the categories tree as a list of unsaved Category
+        instances built from the cached rows, ready to be passed
+        to the recursetree template tag without hitting the DB.
+        """
+        return [
+            CategoryTreeCache.build_node(row)
+            for row in CategoryTreeCache.get_rows()
+        ]
+
+    @staticmethod
+    def get_node(pk):
+        """
+        Returns the category with the given id as an unsaved
+        Category instance built from the cached rows or None
+        if there is no such category.
+
+        :param pk: The category id
+        :type pk: int
+        """
+        rows, positions = CategoryTreeCache.get_tree()
+        position = positions.get(pk)
+        if position is None:
+            return None
+        return CategoryTreeCache.build_node(rows[position])
+
+    @staticmethod
+    def get_descendants(node):
+        """
+        Returns the category and its descendants in tree order,
+        built from the cached rows like get_node(). The rows are
+        ordered by tree_id and lft, so the subtree is the slice
+        starting at the category, one row per descendant.
+
+        :param node: The category
+        :type node: Category
+        """
+        rows, positions = CategoryTreeCache.get_tree()
+        position = positions.get(node.pk)
+        if position is None:
+            return []
+        row = rows[position]
+        end = position + 1 + (row["rght"] - row["lft"] - 1) // 2
+        return [
+            CategoryTreeCache.build_node(row) for row in rows[position:end]
+        ]
+
+
+class ProductCache:
+    """
+    Keeps the products data in the shared cache, so that the
+    cart can be hydrated from the product ids stored in the session
+    without hitting the DB. Contains only static methods so serves
+    just as a namespace for this group of methods.
+    """
+
+    # Renamed when the format of the cached data changes, so that
+    # the entries cached by the previous release are not read
+    KEY = "product_v2_{id}"
+
+    @staticmethod
+    def cache():
+        return caches[settings.PRODUCT_CACHE]
+
+    @staticmethod
+    def get_many(product_ids):
+        """
+        Returns a dict with the data of the products with the
+        given ids, keyed by the integer product id. The values are
+        converted to strings, as they are used in the cart, except
+        the stock, an int or None if it's not tracked. The
+        products missing from the cache are loaded with a single
+        query and cached. Unexisting products are omitted.
+
+        :param product_ids: The product ids
+        :type product_ids: iterable of int
+        """
+        keys = {
+            ProductCache.KEY.format(id=product_id): product_id
+            for product_id in product_ids
+        }
+        if not keys:
+            return {}
+        cache = ProductCache.cache()
+        products = {
+            keys[key]: product for key, product in
+            cache.get_many(list(keys)).items()
+        }
+        missing = set(keys.values()) - set(products)
+        Profiling.cache_lookup("product", len(products), len(missing))
+        if missing:
+            loaded = {}
+            for product in Product.objects.filter(id__in=missing).values():
+                stock = product.pop("stock")
+                loaded[product["id"]] = dict(
+                    {k: str(v) for k, v in product.items()}, stock=stock
+                )
+            cache.set_many(
+                {
+                    ProductCache.KEY.format(id=product_id): product
+                    for product_id, product in loaded.items()
+                },
+                timeout=settings.PRODUCT_CACHE_TIMEOUT
+            )
+            products.update(loaded)
+        return products
+
+    @staticmethod
+    def invalidate(product_id):
+        ProductCache.cache().delete(ProductCache.KEY.format(id=product_id))
+
+    @staticmethod
+    def invalidate_many(product_ids):
+        ProductCache.cache().delete_many([
+            ProductCache.KEY.format(id=product_id)
+            for product_id in product_ids
+        ])
+
+
+class PageCache:
+    """
+    Keeps the whole rendered home and category pages for the visitors
+    with an empty cart (see GeneralContextMixin.page_cache). Their pages
+    differ only by the CSRF token, which is then loaded by JavaScript
+    from the cart_widget view. A page is rendered once per catalogue
+    change: the key contains the categories tree and stats versions and
+    the pages version, which is moved forward on every product change.
+    Contains only static methods so serves just as a namespace for
+    this group of methods.
+    """
+
+    VERSION_KEY = "page_cache_version"
+    KEY = ("page_{template_version}_{tree_version}_{stats_version}_"
+           "{version}_{url}")
+
+    @staticmethod
+    def cache():
+        return caches[settings.FULL_PAGE_CACHE_ALIAS]
+
+    @staticmethod
+    def get_version():
+        cache = PageCache.cache()
+        version = cache.get(PageCache.VERSION_KEY)
+        if version is None:
+            cache.add(PageCache.VERSION_KEY, int(time.time() * 1000), None)
+            version = cache.get(PageCache.VERSION_KEY)
+        return version
+
+    @staticmethod
+    def invalidate():
+        try:
+            PageCache.cache().incr(PageCache.VERSION_KEY)
+        except ValueError:
+            PageCache.get_version()
+            PageCache.cache().incr(PageCache.VERSION_KEY)
+
+    @staticmethod
+    def key(request, params):
+        """
+        Returns the cache key of the requested page.
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        :param params: The normalized query parameters the page
+                       depends on, as (name, value) pairs, instead
+                       of the requested ones
+        :type params: list
+        """
+        url = request.path + "?" + urlencode(params)
+        return PageCache.KEY.format(
+            template_version=settings.ETAG_VERSION,
+            tree_version=CategoryTreeCache.get_version(),
+            stats_version=CategoryTreeCache.get_stats_version(),
+            version=PageCache.get_version(),
+            url=hashlib.md5(url.encode()).hexdigest()
+        )
+
+    @staticmethod
+    def get(key):
+        """
+        Returns the cached (content, content type) or None.
+        """
+        page = PageCache.cache().get(key)
+        Profiling.cache_lookup(
+            "page", int(page is not None), int(page is None)
+        )
+        return page
+
+    @staticmethod
+    def set(key, response):
+        PageCache.cache().set(
+            key,
+            (response.content, response["Content-Type"]),
+            timeout=settings.FULL_PAGE_CACHE_TIMEOUT
+        )
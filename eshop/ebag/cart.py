@@ -0,0 +1,241 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from .caching import ProductCache
+import json
+import uuid
+
+
+class Cart:
+    """
+    Helpers for the cart, which is stored in a compact format:
+    {product_id: quantity}. The product data is joined only when
+    the cart is displayed. Contains only static methods so serves
+    just as a namespace for this group of methods.
+    """
+
+    @staticmethod
+    def storage(request):
+        """
+        Returns the cart storage of the request, creating it on
+        first use from the backend set in settings.CART_STORAGE.
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        """
+        if getattr(request, "cart_storage", None) is None:
+            request.cart_storage = import_string(
+                settings.CART_STORAGE
+            )(request)
+        return request.cart_storage
+
+    @staticmethod
+    def hydrate(cart):
+        """
+        Returns the cart items with the products data, loaded with
+        a single cached lookup, in the format:
+        {product_id: {"quantity": quantity, "product_data": {...}}}
+        The products which no longer exist are omitted.
+
+        :param cart: The compact cart
+        :type cart: dict
+        """
+        products = ProductCache.get_many(
+            int(product_id) for product_id in cart
+        )
+        return {
+            product_id: {
+                "quantity": quantity,
+                "product_data": products[int(product_id)]
+            }
+            for product_id, quantity in cart.items()
+            if int(product_id) in products
+        }
+
+
+class CartStorage:
+    """
+    Base class for the cart storage backends. A backend is
+    created per request by Cart.storage(). load() always returns
+    a new dict, so the caller can modify it and pass it to save().
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def load(self):
+        """
+        Returns the cart or an empty dict if there is no cart.
+        """
+        raise NotImplementedError
+
+    def save(self, cart):
+        """
+        Stores the cart. An empty cart is deleted. The backends
+        write nothing if the cart is not changed.
+
+        :param cart: The compact cart
+        :type cart: dict
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        self.save({})
+
+    def process_response(self, response):
+        """
+        Called by CartStorageMiddleware, lets the backend
+        update the response, e.g. set a cookie.
+
+        :param response: The view response
+        :type response: HttpResponse
+        """
+        pass
+
+
+class SessionCartStorage(CartStorage):
+    """
+    Keeps the cart in the session, hence in the
+    django_session table with the default session engine.
+    """
+
+    def load(self):
+        """
+        Carts saved in the old format, containing the whole product
+        data for each item, are converted and written back to the session.
+        """
+        cart = self.request.session.get("cart", {})
+        if any(isinstance(item, dict) for item in cart.values()):
+            cart = {
+                product_id: item["quantity"]
+                if isinstance(item, dict) else item
+                for product_id, item in cart.items()
+            }
+            self.request.session["cart"] = cart
+        return dict(cart)
+
+    def save(self, cart):
+        """
+        Modifies the session only if the cart is changed, so that
+        the session is not saved after no-op cart updates.
+        """
+        if cart == self.request.session.get("cart", {}):
+            return
+        if cart:
+            self.request.session["cart"] = cart
+        elif "cart" in self.request.session:
+            del self.request.session["cart"]
+
+
+class SignedCookieCartStorage(CartStorage):
+    """
+    Keeps the cart in a signed cookie, so no server-side writes
+    are needed. The cookie is limited to about 4KB, which is
+    enough for a few hundred cart items.
+    """
+
+    SALT = "ebag.cart"
+
+    def __init__(self, request):
+        super(__class__, self).__init__(request)
+        self.cart = None
+        self.modified = False
+
+    def load(self):
+        if self.cart is None:
+            value = self.request.get_signed_cookie(
+                settings.CART_COOKIE_NAME,
+                default=None,
+                salt=self.SALT,
+                max_age=settings.CART_COOKIE_AGE
+            )
+            try:
+                self.cart = json.loads(value) if value else {}
+            except ValueError:
+                self.cart = {}
+            if not isinstance(self.cart, dict):
+                self.cart = {}
+        return dict(self.cart)
+
+    def save(self, cart):
+        if cart == self.load():
+            return
+        self.cart = dict(cart)
+        self.modified = True
+
+    def process_response(self, response):
+        if not self.modified:
+            return
+        if self.cart:
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME,
+                json.dumps(self.cart, separators=(",", ":")),
+                salt=self.SALT,
+                max_age=settings.CART_COOKIE_AGE,
+                httponly=True
+            )
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME)
+
+
+class KeyValueCartStorage(CartStorage):
+    """
+    Keeps the cart in a key-value store, accessed through the
+    Django cache set in settings.CART_KV_CACHE, under a random
+    cart id kept in a signed cookie. Locally the cache is
+    file-based, in production it can point to a network store
+    such as Memcached.
+    """
+
+    SALT = "ebag.cart.id"
+    KEY = "cart_{id}"
+
+    def __init__(self, request):
+        super(__class__, self).__init__(request)
+        self.cart_id = request.get_signed_cookie(
+            settings.CART_COOKIE_NAME,
+            default=None,
+            salt=self.SALT,
+            max_age=settings.CART_COOKIE_AGE
+        )
+        self.new_cart_id = False
+        self.cart = None
+
+    def cache(self):
+        return caches[settings.CART_KV_CACHE]
+
+    def load(self):
+        if self.cart is None:
+            self.cart = {}
+            if self.cart_id is not None:
+                self.cart = self.cache().get(
+                    self.KEY.format(id=self.cart_id), {}
+                )
+        return dict(self.cart)
+
+    def save(self, cart):
+        if cart == self.load():
+            return
+        self.cart = dict(cart)
+        if not cart:
+            if self.cart_id is not None:
+                self.cache().delete(self.KEY.format(id=self.cart_id))
+            return
+        if self.cart_id is None:
+            self.cart_id = uuid.uuid4().hex
+            self.new_cart_id = True
+        self.cache().set(
+            self.KEY.format(id=self.cart_id),
+            cart,
+            timeout=settings.CART_COOKIE_AGE
+        )
+
+    def process_response(self, response):
+        if self.new_cart_id:
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME,
+                self.cart_id,
+                salt=self.SALT,
+                max_age=settings.CART_COOKIE_AGE,
+                httponly=True
+            )
@@ -0,0 +1,234 @@
+from django.conf import settings
+from xml.sax.saxutils import escape
+from .caching import CategoryTreeCache
+from .importing import CategoryIndex
+from .models import Product
+import csv
+import io
+import json
+import re
+import zlib
+
+# The characters which are not allowed in XML 1.0
+XML_INVALID = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+class ProductFeed:
+    """
+    Streams the whole catalogue as CSV, JSON lines or a Google Merchant
+    style RSS 2.0 feed, for the marketing partners. The products are
+    read in keyset chunks (WHERE id > the last id ORDER BY id LIMIT
+    chunk_size), so that the memory stays flat whatever the catalogue
+    size and no query stays open while the feed is sent. Their category
+    paths come from an index of the cached categories tree, so they
+    cost no query. Every chunk of products is yielded as one piece,
+    gzipped on the fly if asked. The products have no page of their
+    own, so their link is their category page.
+    """
+
+    CONTENT_TYPES = {
+        "csv": "text/csv; charset=utf-8",
+        "jsonl": "application/x-ndjson; charset=utf-8",
+        "xml": "application/rss+xml; charset=utf-8",
+    }
+    FIELDS = ("id", "sku", "name", "category", "description", "price",
+              "stock", "availability", "link", "image_link")
+    XML_HEADER = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n'
+        '<channel>\n<title>Ebag.bg</title>\n<link>{link}</link>\n'
+        '<description>Ebag.bg products</description>\n'
+    )
+    XML_FOOTER = "</channel>\n</rss>\n"
+    # The <g:...> element of each field
+    XML_ELEMENTS = (
+        ("id", "id"),
+        ("name", "title"),
+        ("description", "description"),
+        ("link", "link"),
+        ("image_link", "image_link"),
+        ("price", "price"),
+        ("availability", "availability"),
+        ("category", "product_type"),
+        ("sku", "mpn"),
+    )
+
+    def __init__(self, format, base_url, chunk_size=None):
+        """
+        :param format: csv, jsonl or xml
+        :type format: str
+        :param base_url: The site URL the links start with,
+                         e.g. https://ebag.bg
+        :type base_url: str
+        :param chunk_size: The products read per query, by default
+                           settings.PRODUCT_FEED_CHUNK_SIZE
+        :type chunk_size: int
+        """
+        if format not in self.CONTENT_TYPES:
+            raise ValueError("Unknown feed format %s." % format)
+        self.format = format
+        self.base_url = base_url.rstrip("/")
+        self.chunk_size = chunk_size or settings.PRODUCT_FEED_CHUNK_SIZE
+        self.count = 0
+
+    @property
+    def content_type(self):
+        return self.CONTENT_TYPES[self.format]
+
+    def categories(self):
+        """
+        Returns {category id: (path, link)} of all the categories,
+        the path being the names from the root separated by " > ",
+        as the products import expects them.
+        """
+        categories = {}
+        separator = " %s " % CategoryIndex.SEPARATOR
+        # The rows are in tree order, so the parents come first
+        for row in CategoryTreeCache.get_rows():
+            parent = categories.get(row["parent_id"])
+            categories[row["id"]] = (
+                parent[0] + separator + row["name"] if parent
+                else row["name"],
+                "%s/%s/" % (self.base_url, row["url"])
+            )
+        return categories
+
+    def products(self):
+        """
+        Yields the lists of the product dicts in id order,
+        each read with one query.
+        """
+        last_id = 0
+        while True:
+            chunk = list(
+                Product.objects.filter(id__gt=last_id).order_by("id").values(
+                    "id", "sku", "name", "category_id", "description",
+                    "price", "stock", "image"
+                )[:self.chunk_size]
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            last_id = chunk[-1]["id"]
+
+    def items(self, chunk, categories):
+        """
+        Returns the feed fields of the products of a chunk.
+        """
+        items = []
+        for product in chunk:
+            path, link = categories.get(product["category_id"], ("", ""))
+            items.append({
+                "id": product["id"],
+                "sku": product["sku"] or "",
+                "name": product["name"],
+                "category": path,
+                "description": product["description"],
+                "price": str(product["price"]),
+                "stock": product["stock"],
+                "availability": "out_of_stock" if product["stock"] == 0
+                else "in_stock",
+                "link": link,
+                "image_link": "%s%s%s" % (
+                    self.base_url, settings.MEDIA_URL, product["image"]
+                ) if product["image"] else "",
+            })
+        return items
+
+    def format_csv(self, items):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, self.FIELDS, lineterminator="\n")
+        for item in items:
+            writer.writerow(item)
+        return output.getvalue()
+
+    def format_jsonl(self, items):
+        return "".join(
+            json.dumps(item, ensure_ascii=False) + "\n" for item in items
+        )
+
+    def format_xml(self, items):
+        lines = []
+        for item in items:
+            item = dict(item, price="%s %s" % (
+                item["price"], settings.PRODUCT_FEED_CURRENCY
+            ))
+            lines.append("<item>%s</item>\n" % "".join(
+                "<g:%s>%s</g:%s>" % (
+                    element,
+                    escape(XML_INVALID.sub("", str(item[field]))),
+                    element
+                )
+                for field, element in self.XML_ELEMENTS
+                if item[field] != ""
+            ))
+        return "".join(lines)
+
+    def chunks(self):
+        """
+        Yields the feed as strings, one per chunk of products.
+        """
+        if self.format == "csv":
+            yield ",".join(self.FIELDS) + "\n"
+        elif self.format == "xml":
+            yield self.XML_HEADER.format(link=escape(self.base_url + "/"))
+        categories = self.categories()
+        formatter = getattr(self, "format_" + self.format)
+        self.count = 0
+        for chunk in self.products():
+            self.count += len(chunk)
+            yield formatter(self.items(chunk, categories))
+        if self.format == "xml":
+            yield self.XML_FOOTER
+
+    def stream(self, compress=False):
+        """
+        Returns an iterator of the feed UTF-8 bytes,
+        gzipped if compress is set.
+
+        :param compress: Gzip the feed
+        :type compress: bool
+        """
+        chunks = (chunk.encode() for chunk in self.chunks())
+        return ProductFeed.gzip(chunks) if compress else chunks
+
+    @staticmethod
+    def accepts_gzip(accept_encoding):
+        """
+        Checks if an Accept-Encoding header accepts gzip: listed, or
+        matched by *, with a quality above 0 (e.g. not gzip;q=0).
+
+        :param accept_encoding: The header value
+        :type accept_encoding: str
+        """
+        qualities = {}
+        for coding in accept_encoding.split(","):
+            name, *params = [part.strip() for part in coding.split(";")]
+            quality = 1.0
+            for param in params:
+                key, separator, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if name:
+                qualities[name.lower()] = quality
+        for name in ("gzip", "x-gzip", "*"):
+            if name in qualities:
+                return qualities[name] > 0
+        return False
+
+    @staticmethod
+    def gzip(chunks):
+        """
+        Gzips the bytes chunks on the fly, yielding the compressed
+        data as soon as zlib outputs any.
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -1,6 +1,5 @@
-from django.conf import settings
 from django import forms
-from .models import Category
+from .models import Category, Order
 
 
 class CategoryForm(forms.ModelForm):
@@ -12,35 +11,14 @@ class CategoryForm(forms.ModelForm):
         model = Category
         fields = '__all__'
 
-    def clean_name(self):
-        """
-        Doesn't allow the PK_PLACEHOLDER specified in the settings
-        to be included in the category name as it has a special function.
-        It will be later replaced in the slug URL with the category id.
-        The slug can not be created with id during the
-        category creation as the object still doesn't exist so is not assigned
-        any id, hence the need of the placeholder.
-        """
-        name = self.cleaned_data["name"]
-        if settings.PK_PLACEHOLDER in name:
-            raise forms.ValidationError(f"{settings.PK_PLACEHOLDER} is a "
-                                        "reserved placeholder, you can't "
-                                        "use it in the category name.")
-        return name
-
 
 class CheckoutForm(forms.Form):
     """
-    Dummy Checkout form without performed action on successful validation,
-    just checks for field errors.
+    The checkout form, its fields are saved as the Order
+    customer details, see ebag.orders.Orders.place().
     """
 
-    COUNTRIES = (
-        ('', 'Choose a country'),
-        ('1', 'Bulgaria'),
-        ('2', 'Serbia'),
-        ('3', 'USA')
-    )
+    COUNTRIES = (('', 'Choose a country'),) + Order.COUNTRIES
     country = forms.ChoiceField(label='Country',
                                 widget=forms.Select(
                                     attrs={
@@ -0,0 +1,323 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from PIL import Image, features
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    A dict keeping only its `size` most recently used items, so that
+    it doesn't grow with the catalogue. Used from the request threads
+    and the thread pool, hence the lock.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ProductImages:
+    """
+    Generates the derivatives of the uploaded product images: the
+    image resized to each of settings.PRODUCT_IMAGE_WIDTHS, in the
+    original format family (JPEG, or PNG for the transparent images)
+    and in WebP, so that the browser downloads the smallest one fitting
+    the layout (see the product_image template tag). The derivatives
+    of an image are stored in MEDIA_ROOT/derivatives/ with a manifest
+    listing them, written last. Every upload gets a new file name (see
+    Product.save_file_with_id_name), so the derivatives never change
+    and the manifests are kept in memory once read. A missing manifest
+    is remembered for settings.PRODUCT_IMAGE_MISS_TIMEOUT seconds, so
+    that the pages listing the images whose derivatives are still being
+    generated, or failed, don't look for it on every render. Both are
+    kept for the settings.PRODUCT_IMAGE_CACHE_SIZE most recently used
+    images only. Contains only static methods so serves just as a
+    namespace for this group of methods.
+    """
+
+    DIRECTORY = "derivatives"
+    IMPORT_DIRECTORY = "imports"
+    # The errors of an unreadable or invalid image file
+    ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+    lock = threading.Lock()
+    pool = None
+    pool_pid = None
+    # {image name: manifest} of the images with generated derivatives
+    manifests = LRUCache(settings.PRODUCT_IMAGE_CACHE_SIZE)
+    # {image name: time.monotonic() of the check} of the images
+    # found without a manifest
+    misses = LRUCache(settings.PRODUCT_IMAGE_CACHE_SIZE)
+
+    @staticmethod
+    def derivative_name(name, width, extension):
+        """
+        Returns the derivative file name, relative to MEDIA_ROOT,
+        e.g. derivatives/<uuid>-300w.webp
+
+        :param name: The original image name
+        :type name: str
+        :param width: The derivative width
+        :type width: int
+        :param extension: The derivative file extension
+        :type extension: str
+        """
+        stem = posixpath.splitext(name)[0]
+        return posixpath.join(
+            ProductImages.DIRECTORY, "%s-%dw.%s" % (stem, width, extension)
+        )
+
+    @staticmethod
+    def manifest_path(name):
+        stem = posixpath.splitext(name)[0]
+        return os.path.join(
+            settings.MEDIA_ROOT, ProductImages.DIRECTORY, stem + ".json"
+        )
+
+    @staticmethod
+    def manifest(name):
+        """
+        Returns {"widths": [...], "formats": [...]} of the generated
+        derivatives of the image, or None if they are not generated yet.
+
+        :param name: The original image name
+        :type name: str
+        """
+        manifest = ProductImages.manifests.get(name)
+        if manifest is None:
+            now = time.monotonic()
+            checked = ProductImages.misses.get(name)
+            if checked is not None and \
+                    now - checked < settings.PRODUCT_IMAGE_MISS_TIMEOUT:
+                return None
+            try:
+                with open(ProductImages.manifest_path(name)) as file_:
+                    manifest = json.load(file_)
+            except (OSError, ValueError):
+                ProductImages.misses.set(name, now)
+                return None
+            ProductImages.manifests.set(name, manifest)
+        ProductImages.misses.pop(name, None)
+        return manifest
+
+    @staticmethod
+    def write(path, save):
+        """
+        Writes a file with save(file path) through a temporary file,
+        so that a half written file is never served.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            save(temporary)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    @staticmethod
+    def generate(name, force=False):
+        """
+        Generates the derivatives of the image and returns their
+        manifest, or None if they were already generated. The image
+        is never upscaled: the widths above the image width are
+        replaced with the image width.
+
+        :param name: The original image name, relative to MEDIA_ROOT
+        :type name: str
+        :param force: Regenerate the existing derivatives
+        :type force: bool
+        """
+        manifest_path = ProductImages.manifest_path(name)
+        if not force and os.path.exists(manifest_path):
+            return None
+        with Image.open(os.path.join(settings.MEDIA_ROOT, name)) as image:
+            width, height = image.size
+            widths = sorted({
+                min(derivative_width, width)
+                for derivative_width in settings.PRODUCT_IMAGE_WIDTHS
+            })
+            # Lets the JPEG decoder downscale while decoding
+            image.draft("RGB", (widths[-1], height * widths[-1] // width))
+            transparent = image.mode in ("RGBA", "LA") or (
+                image.mode == "P" and "transparency" in image.info
+            )
+            image = image.convert("RGBA" if transparent else "RGB")
+        formats = ["png" if transparent else "jpg"]
+        if features.check("webp"):
+            formats.append("webp")
+        options = {
+            "jpg": {
+                "format": "JPEG",
+                "quality": settings.PRODUCT_IMAGE_QUALITY,
+                "optimize": True,
+                "progressive": True,
+            },
+            "png": {"format": "PNG", "optimize": True},
+            "webp": {
+                "format": "WEBP",
+                "quality": settings.PRODUCT_IMAGE_WEBP_QUALITY,
+            },
+        }
+        for derivative_width in widths:
+            derivative = image.resize(
+                (
+                    derivative_width,
+                    max(1, round(height * derivative_width / width))
+                ),
+                Image.LANCZOS
+            )
+            for extension in formats:
+                ProductImages.write(
+                    os.path.join(
+                        settings.MEDIA_ROOT,
+                        ProductImages.derivative_name(
+                            name, derivative_width, extension
+                        )
+                    ),
+                    lambda path: derivative.save(path, **options[extension])
+                )
+        manifest = {"widths": widths, "formats": formats}
+        ProductImages.write(
+            manifest_path,
+            lambda path: ProductImages.save_manifest(path, manifest)
+        )
+        ProductImages.manifests.set(name, manifest)
+        return manifest
+
+    @staticmethod
+    def save_manifest(path, manifest):
+        with open(path, "w") as file_:
+            json.dump(manifest, file_)
+
+    @staticmethod
+    def backfill(name, force=False):
+        """
+        Calls generate() and returns (manifest, error message), for
+        the management command worker processes. An invalid image is
+        logged and reported, so that it doesn't stop the others.
+        """
+        try:
+            return ProductImages.generate(name, force), None
+        except ProductImages.ERRORS as error:
+            logger.warning("Generating the derivatives of %s failed: %s",
+                           name, error)
+            return None, str(error)
+
+    @staticmethod
+    def ingest(source):
+        """
+        Copies an image of the products import to MEDIA_ROOT/imports/,
+        named by the hash of its content, so that an image shared by
+        many products or imported again is stored once, generates its
+        derivatives and returns (name, error message), for the import
+        worker processes.
+
+        :param source: The image file path
+        :type source: str
+        """
+        try:
+            digest = hashlib.sha1()
+            with open(source, "rb") as file_:
+                for chunk in iter(lambda: file_.read(1 << 16), b""):
+                    digest.update(chunk)
+            name = posixpath.join(
+                ProductImages.IMPORT_DIRECTORY,
+                digest.hexdigest() + os.path.splitext(source)[1].lower()
+            )
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            if os.path.exists(path):
+                ProductImages.generate(name)
+                return name, None
+            ProductImages.write(
+                path, lambda temporary: shutil.copyfile(source, temporary)
+            )
+            try:
+                ProductImages.generate(name)
+            except ProductImages.ERRORS:
+                # Not an image, so it is not kept
+                os.remove(path)
+                raise
+            return name, None
+        except ProductImages.ERRORS as error:
+            return None, str(error)
+
+    @staticmethod
+    def executor():
+        """
+        Returns the thread pool of the current process, a forked
+        worker process creates its own.
+        """
+        with ProductImages.lock:
+            if ProductImages.pool is None or \
+                    ProductImages.pool_pid != os.getpid():
+                ProductImages.pool = ThreadPoolExecutor(
+                    max_workers=settings.PRODUCT_IMAGE_WORKERS,
+                    thread_name_prefix="product-images"
+                )
+                ProductImages.pool_pid = os.getpid()
+            return ProductImages.pool
+
+    @staticmethod
+    def schedule(name):
+        """
+        Generates the derivatives of a new image in the background
+        thread pool, or right away if PRODUCT_IMAGE_WORKERS is 0.
+        Pillow releases the GIL while resizing and encoding, so the
+        requests are not blocked meanwhile. The products saved with the
+        name of a missing file (e.g. loaded from fixtures) are skipped.
+
+        :param name: The original image name, relative to MEDIA_ROOT
+        :type name: str
+        """
+        if not name or ProductImages.manifest(name) is not None:
+            return
+        if not os.path.isfile(os.path.join(settings.MEDIA_ROOT, name)):
+            return
+        if not settings.PRODUCT_IMAGE_WORKERS:
+            ProductImages.run(name)
+            return
+        ProductImages.executor().submit(ProductImages.run, name)
+
+    @staticmethod
+    def run(name):
+        try:
+            ProductImages.generate(name)
+        except Exception:
+            logger.exception("Generating the derivatives of %s failed", name)
@@ -0,0 +1,498 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+from .caching import CategoryTreeCache, PageCache, ProductCache
+from .images import ProductImages
+from .models import Category, Product, StockReservation
+from .search import SearchIndex
+from .stats import CategoryStats
+import csv
+import json
+import os
+import time
+
+
+class CategoryIndex:
+    """
+    Resolves the category paths of the imported products, e.g.
+    "Food > Dairy > Milk", to category ids through an index of the
+    whole tree, read with a single query, so that resolving a row costs
+    no query. The categories are matched by their slug under the parent,
+    as they are unique by it. The missing ones are created, if allowed,
+    with Category.save(), which keeps the MPTT fields.
+    """
+
+    SEPARATOR = ">"
+
+    def __init__(self, create=False):
+        """
+        :param create: Create the missing categories
+        :type create: bool
+        """
+        self.create = create
+        # {(parent id, slug): category id}
+        self.children = {
+            (parent_id, slug): pk for pk, parent_id, slug in
+            Category.objects.values_list("id", "parent_id", "slug")
+        }
+        # {path: category id} of the resolved paths
+        self.paths = {}
+
+    def resolve(self, path):
+        """
+        Returns the id of the category, or raises ValidationError
+        if it does not exist and is not created.
+
+        :param path: The category names from the root, separated by >
+        :type path: str
+        """
+        category_id = self.paths.get(path)
+        if category_id is not None:
+            return category_id
+        names = [name.strip() for name in path.split(self.SEPARATOR)]
+        if not all(slugify(name) for name in names):
+            raise ValidationError("Invalid category %s." % path)
+        parent_id = None
+        for name in names:
+            key = (parent_id, slugify(name))
+            category_id = self.children.get(key)
+            if category_id is None:
+                if not self.create:
+                    raise ValidationError("Unknown category %s." % path)
+                category_id = Category.objects.create(
+                    name=name, parent_id=parent_id
+                ).pk
+                self.children[key] = category_id
+            parent_id = category_id
+        self.paths[path] = category_id
+        return category_id
+
+
+class ProductImport:
+    """
+    Imports the products of a CSV (with a header) or a JSON lines
+    feed, with the columns sku, name, category, description and price,
+    plus the optional image (a file path, relative to the images
+    directory) and stock (empty to stop tracking it). The feed stock is
+    the stock on hand: the quantities still reserved by the carts are
+    subtracted from it, as they were already taken from Product.stock
+    and are given back when they expire. The products are
+    matched by their SKU: the rows of a known SKU update the product,
+    the others create one. The feed is streamed in batches, so the
+    memory does not grow with its size, and every batch is written in
+    one transaction with a single SELECT of the known SKUs, a bulk
+    INSERT, a CASE UPDATE and, if the batch has a stock column, a SUM
+    of the reserved quantities. The images of the next batch are copied
+    and resized by the worker processes meanwhile. The position after
+    the last written batch is kept in a checkpoint file, so that a
+    failed import resumes from there. Writing a batch again is
+    harmless, as the rows are upserts. The invalid rows are reported
+    and skipped. The bulk writes send no signals, so the category
+    stats, the caches and the search index are refreshed at the end.
+    """
+
+    REQUIRED = ("sku", "name", "category", "description", "price")
+    # Seconds between the progress reports
+    PROGRESS_INTERVAL = 5
+    # The ingested images remembered, so that an image shared by many
+    # rows is ingested once
+    IMAGES_MEMO_SIZE = 10000
+
+    def __init__(self, path, format=None, batch_size=1000, images_dir=None,
+                 workers=0, checkpoint=None, create_categories=False,
+                 progress=None, error=None):
+        """
+        :param path: The feed file path
+        :type path: str
+        :param format: csv or jsonl, by default the file extension
+        :type format: str
+        :param batch_size: The rows written per transaction
+        :type batch_size: int
+        :param images_dir: The directory of the relative image paths,
+                           by default the directory of the feed
+        :type images_dir: str
+        :param workers: The image worker processes, 0 to process the
+                        images in this process
+        :type workers: int
+        :param checkpoint: The checkpoint file path, by default the
+                           feed path with .checkpoint appended
+        :type checkpoint: str
+        :param create_categories: Create the missing categories
+        :type create_categories: bool
+        :param progress: Called with the results every
+                         PROGRESS_INTERVAL seconds
+        :type progress: function
+        :param error: Called with the line number and the error
+                      message of every invalid row
+        :type error: function
+        """
+        self.path = os.path.abspath(path)
+        if format is None:
+            format = "csv" if path.lower().endswith(".csv") else "jsonl"
+        self.format = format
+        self.batch_size = batch_size
+        self.images_dir = images_dir or os.path.dirname(self.path)
+        self.workers = workers
+        self.checkpoint = checkpoint or self.path + ".checkpoint"
+        self.create_categories = create_categories
+        self.progress = progress
+        self.error = error
+        self.categories = None
+        self.executor = None
+        # {image path: (name, error message) or its future}
+        self.images = {}
+
+    def rows(self, offset, line):
+        """
+        Yields the (line number, row dict or None if malformed, offset
+        after the row) of the feed rows after the offset.
+
+        :param offset: The byte offset of the first row, 0 for the start
+        :type offset: int
+        :param line: The number of the lines before the offset
+        :type line: int
+        """
+        with open(self.path, "rb") as file_:
+            if self.format == "csv":
+                header = file_.readline().decode("utf-8-sig")
+                fieldnames = [
+                    name.strip() for name in next(csv.reader([header]))
+                ]
+                if offset:
+                    file_.seek(offset)
+                else:
+                    line = 1
+                # Read in binary, as the offset of a text file is unknown
+                reader = csv.reader(raw.decode("utf-8") for raw in file_)
+                for values in reader:
+                    if not values:
+                        continue
+                    row = None
+                    if len(values) == len(fieldnames):
+                        row = dict(zip(fieldnames, values))
+                    yield line + reader.line_num, row, file_.tell()
+                return
+            file_.seek(offset)
+            for raw in file_:
+                line += 1
+                if not raw.strip():
+                    continue
+                try:
+                    row = json.loads(raw.decode("utf-8"))
+                except ValueError:
+                    row = None
+                if not isinstance(row, dict):
+                    row = None
+                yield line, row, file_.tell()
+
+    def clean(self, row):
+        """
+        Returns the product field values of a row and the path of its
+        image, or raises ValidationError if the row is invalid.
+
+        :param row: The feed row
+        :type row: dict
+        """
+        if row is None:
+            raise ValidationError("Malformed row.")
+        row = {
+            name: "" if value is None else str(value).strip()
+            for name, value in row.items()
+        }
+        missing = [name for name in self.REQUIRED if not row.get(name)]
+        if missing:
+            raise ValidationError("Missing %s." % ", ".join(missing))
+        values = {}
+        names = ("sku", "name", "description", "price")
+        if "stock" in row:
+            names += ("stock",)
+        for name in names:
+            try:
+                values[name] = Product._meta.get_field(name).clean(
+                    row[name] or None, None
+                )
+            except ValidationError as error:
+                raise ValidationError(
+                    "%s: %s" % (name, " ".join(error.messages))
+                )
+        values["category_id"] = self.categories.resolve(row["category"])
+        image = None
+        if row.get("image"):
+            image = os.path.join(self.images_dir, row["image"])
+        return values, image
+
+    def prepare(self, batch):
+        """
+        Cleans the batch rows and starts ingesting their images in the
+        worker processes. Returns the (line number, values, image
+        (name, error message) or its future, error message) of the rows.
+        """
+        if len(self.images) > self.IMAGES_MEMO_SIZE:
+            self.images = {}
+        prepared = []
+        for line, row, offset in batch:
+            try:
+                values, path = self.clean(row)
+            except ValidationError as error:
+                prepared.append((line, None, None, " ".join(error.messages)))
+                continue
+            image = None
+            if path is not None:
+                image = self.images.get(path)
+                if image is None and self.executor is None:
+                    image = ProductImages.ingest(path)
+                elif image is None:
+                    image = self.executor.submit(ProductImages.ingest, path)
+                self.images[path] = image
+            prepared.append((line, values, image, None))
+        return prepared
+
+    def update(self, products):
+        """
+        Updates the products with one UPDATE of CASE expressions per
+        field, split only by the DB parameters limit (e.g. of SQLite).
+        The fields missing from the values of a product are kept. The
+        SQL is written here, as compiling the thousands of When()
+        expressions of a batch takes much longer than running it.
+
+        :param products: The (product id, values) of the products
+        :type products: list
+        """
+        if not products:
+            return
+        fields = [
+            Product._meta.get_field(name) for name in sorted(set(
+                name for pk, values in products for name in values
+            ) - {"sku"})
+        ]
+        size = len(products)
+        if connection.features.max_query_params:
+            size = max(
+                1,
+                connection.features.max_query_params // (2 * len(fields) + 2)
+            )
+        quote = connection.ops.quote_name
+        pk_column = quote(Product._meta.pk.column)
+        last_update = Product._meta.get_field("last_update")
+        now = last_update.get_db_prep_save(timezone.now(), connection)
+        for start in range(0, len(products), size):
+            chunk = products[start:start + size]
+            assignments = ["%s = %%s" % quote(last_update.column)]
+            params = [now]
+            for field in fields:
+                whens = [
+                    (pk, values[field.attname]) for pk, values in chunk
+                    if field.attname in values
+                ]
+                if not whens:
+                    continue
+                column = quote(field.column)
+                assignments.append("%s = CASE %s %s ELSE %s END" % (
+                    column, pk_column, " ".join(["WHEN %s THEN %s"] * len(
+                        whens
+                    )), column
+                ))
+                for pk, value in whens:
+                    params += [pk, field.get_db_prep_save(value, connection)]
+            params += [pk for pk, values in chunk]
+            with connection.cursor() as cursor:
+                cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+                    quote(Product._meta.db_table),
+                    ", ".join(assignments),
+                    pk_column,
+                    ", ".join(["%s"] * len(chunk))
+                ), params)
+
+    def write(self, prepared, results):
+        """
+        Writes the valid rows of a batch in one transaction.
+        """
+        products = {}
+        for line, values, image, error in prepared:
+            if error is None and image is not None:
+                if not isinstance(image, tuple):
+                    image = image.result()
+                values["image"], error = image
+            if error is not None:
+                results["failed"] += 1
+                if self.error is not None:
+                    self.error(line, error)
+                continue
+            # The last row of a SKU repeated in the batch wins
+            products[values["sku"]] = values
+        with transaction.atomic():
+            # Locked in the order of the ids, as Stock.lock() does,
+            # so that no stock is reserved until the batch is written
+            existing = dict(
+                Product.objects.select_for_update().filter(
+                    sku__in=products
+                ).order_by("id").values_list("sku", "id")
+            )
+            self.subtract_reserved(products, existing)
+            Product.objects.bulk_create([
+                Product(**values) for sku, values in products.items()
+                if sku not in existing
+            ])
+            self.update([
+                (existing[sku], values) for sku, values in products.items()
+                if sku in existing
+            ])
+        ProductCache.invalidate_many(existing.values())
+        results["created"] += len(products) - len(existing)
+        results["updated"] += len(existing)
+
+    def subtract_reserved(self, products, existing):
+        """
+        Subtracts the quantities reserved by the carts from the stock
+        of the existing products, with a single query. The stock can't
+        go below 0.
+
+        :param products: {sku: values} of the batch
+        :type products: dict
+        :param existing: {sku: product id} of the existing products
+        :type existing: dict
+        """
+        tracked = {
+            existing[sku]: values for sku, values in products.items()
+            if sku in existing and values.get("stock") is not None
+        }
+        if not tracked:
+            return
+        reserved = StockReservation.objects.filter(
+            product_id__in=tracked
+        ).values("product_id").annotate(
+            quantity=Sum("quantity")
+        ).values_list("product_id", "quantity").order_by()
+        for product_id, quantity in reserved:
+            values = tracked[product_id]
+            values["stock"] = max(values["stock"] - quantity, 0)
+
+    def load_checkpoint(self, restart):
+        """
+        Returns the saved position and results of the feed import,
+        or the start position if there is no checkpoint or restart.
+        """
+        stat = os.stat(self.path)
+        state = {
+            "path": self.path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "offset": 0,
+            "line": 0,
+            "rows": 0,
+            "created": 0,
+            "updated": 0,
+            "failed": 0,
+        }
+        if restart or not os.path.exists(self.checkpoint):
+            return state
+        with open(self.checkpoint) as file_:
+            saved = json.load(file_)
+        if [saved.get(name) for name in ("path", "size", "mtime")] != \
+                [state["path"], state["size"], state["mtime"]]:
+            raise ValueError(
+                "The checkpoint %s is of another file or the file was "
+                "changed, restart the import." % self.checkpoint
+            )
+        state.update(saved)
+        return state
+
+    def save_checkpoint(self, state):
+        temporary = "%s.%d.tmp" % (self.checkpoint, os.getpid())
+        with open(temporary, "w") as file_:
+            json.dump(state, file_)
+        os.replace(temporary, self.checkpoint)
+
+    def finish(self):
+        """
+        Does what the signals of the saved products would do.
+        """
+        CategoryStats.rebuild()
+        CategoryTreeCache.invalidate()
+        PageCache.invalidate()
+        SearchIndex.build()
+
+    def run(self, restart=False):
+        """
+        Imports the feed, from the checkpoint if any, and returns the
+        results: the rows read, the created, updated and failed ones,
+        the line the import resumed from and the rows per second of
+        this run.
+
+        :param restart: Ignore the checkpoint
+        :type restart: bool
+        """
+        state = self.load_checkpoint(restart)
+        results = {
+            name: state[name]
+            for name in ("rows", "created", "updated", "failed")
+        }
+        first_row = results["rows"]
+        resumed_from_line = state["line"]
+        start = reported = time.perf_counter()
+        self.categories = CategoryIndex(self.create_categories)
+        if self.workers:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        pending = None
+        batch = []
+        try:
+            for item in self.rows(state["offset"], state["line"]):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+                pending = self.advance(pending, batch, state, results)
+                batch = []
+                if self.progress is not None and time.perf_counter() - \
+                        reported >= self.PROGRESS_INTERVAL:
+                    reported = time.perf_counter()
+                    self.progress(self.rate(results, first_row, start))
+            if batch:
+                pending = self.advance(pending, batch, state, results)
+            if pending is not None:
+                self.commit(pending, state, results)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if results["rows"] > first_row:
+                self.finish()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return dict(
+            self.rate(results, first_row, start),
+            resumed_from_line=resumed_from_line
+        )
+
+    def advance(self, pending, batch, state, results):
+        """
+        Prepares the batch, so that its images are processed while
+        the pending batch is written, then writes the pending batch
+        and returns the prepared one.
+        """
+        prepared = (self.prepare(batch), batch[-1])
+        if pending is not None:
+            self.commit(pending, state, results)
+        return prepared
+
+    def commit(self, prepared, state, results):
+        """
+        Writes a prepared batch and saves the checkpoint after it.
+        """
+        rows, (line, row, offset) = prepared
+        self.write(rows, results)
+        results["rows"] += len(rows)
+        state.update(results, offset=offset, line=line)
+        self.save_checkpoint(state)
+
+    @staticmethod
+    def rate(results, first_row, start):
+        seconds = time.perf_counter() - start
+        return dict(
+            results,
+            seconds=seconds,
+            rows_per_second=(results["rows"] - first_row) / seconds
+            if seconds else 0.0
+        )
@@ -0,0 +1,257 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from .models import Job
+from . import metrics
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Jobs:
+    """
+    A job queue in the DB, so no broker is needed: the jobs are
+    inserted in the transaction of the request which queues them,
+    hence only the committed work is done, and are run by the run_jobs
+    worker processes. A worker claims a batch of the due jobs with an
+    UPDATE conditional on their status, after selecting them with
+    SELECT ... FOR UPDATE SKIP LOCKED where the DB supports it, so
+    that the workers do not wait for each other. The claim is a lease:
+    the jobs of a worker which died are claimed again once it expires,
+    so a job may run more than once and the tasks must be idempotent.
+    A failed job is retried with an exponential backoff up to
+    settings.JOB_MAX_ATTEMPTS times. Contains only static methods so
+    serves just as a namespace for this group of methods.
+    """
+
+    # {task name: function}, see task()
+    tasks = {}
+
+    @staticmethod
+    def task(function):
+        """
+        Decorator.
+        Registers the function as a task, under its name.
+
+        :param function: The task, called with the job payload
+        as keyword arguments
+        :type function: function
+        """
+        if function.__name__ in Jobs.tasks:
+            raise ValueError(
+                "Task %s already registered." % function.__name__
+            )
+        Jobs.tasks[function.__name__] = function
+        return function
+
+    @staticmethod
+    def enqueue(jobs, delay=0):
+        """
+        Queues the jobs with a single INSERT.
+
+        :param jobs: The (task name, payload dict) of the jobs
+        :type jobs: iterable of tuples
+        :param delay: The seconds before the jobs are due
+        :type delay: float
+        """
+        run_at = timezone.now() + timedelta(seconds=delay)
+        Job.objects.bulk_create([
+            Job(
+                task=task,
+                payload=json.dumps(payload, separators=(",", ":")),
+                run_at=run_at
+            )
+            for task, payload in jobs
+        ])
+
+    @staticmethod
+    def claim(batch_size):
+        """
+        Claims and returns up to batch_size of the due jobs, the
+        oldest first, for settings.JOB_LEASE seconds.
+
+        :param batch_size: The maximum number of the claimed jobs
+        :type batch_size: int
+        """
+        now = timezone.now()
+        claimable = Job.objects.filter(
+            Q(status=Job.QUEUED, run_at__lte=now) |
+            Q(status=Job.RUNNING, lease_expires__lt=now)
+        )
+        claim = uuid.uuid4().hex
+        with transaction.atomic():
+            candidates = claimable
+            if connection.features.has_select_for_update_skip_locked:
+                candidates = candidates.select_for_update(skip_locked=True)
+            job_ids = list(candidates.order_by("run_at", "id").values_list(
+                "id", flat=True
+            )[:batch_size])
+            if not job_ids:
+                return []
+            # Without SKIP LOCKED another worker may have claimed
+            # some of the jobs meanwhile, they are not updated again
+            claimable.filter(id__in=job_ids).update(
+                status=Job.RUNNING,
+                claim=claim,
+                lease_expires=now + timedelta(seconds=settings.JOB_LEASE),
+                attempts=F("attempts") + 1
+            )
+        return list(Job.objects.filter(claim=claim).order_by("run_at", "id"))
+
+    @staticmethod
+    def release(jobs):
+        """
+        Queues the claimed jobs again without counting
+        the attempt, e.g. when the worker is stopped.
+        """
+        for job in jobs:
+            Job.objects.filter(pk=job.pk, claim=job.claim).update(
+                status=Job.QUEUED,
+                attempts=F("attempts") - 1,
+                lease_expires=None
+            )
+
+    @staticmethod
+    def backoff(attempts):
+        """
+        Returns the seconds before the next attempt of a job which
+        failed `attempts` times: JOB_RETRY_DELAY doubled with every
+        attempt, up to JOB_RETRY_MAX_DELAY, with a random jitter so
+        that the jobs failed together are not retried together.
+        """
+        delay = min(
+            settings.JOB_RETRY_DELAY * 2 ** (attempts - 1),
+            settings.JOB_RETRY_MAX_DELAY
+        )
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def run(job):
+        """
+        Runs a claimed job, then deletes it or, if it failed,
+        queues it again or marks it as failed after the last attempt.
+        Returns True if the job is done.
+
+        :param job: The claimed job
+        :type job: Job
+        """
+        start = time.perf_counter()
+        try:
+            function = Jobs.tasks.get(job.task)
+            if function is None:
+                raise LookupError("Unknown task %s." % job.task)
+            function(**json.loads(job.payload))
+        except Exception:
+            error = traceback.format_exc()
+            logger.warning("Job %d %s failed:\n%s", job.pk, job.task, error)
+            outcome = "retry"
+            changes = {
+                "status": Job.QUEUED,
+                "run_at": timezone.now() + timedelta(
+                    seconds=Jobs.backoff(job.attempts)
+                ),
+            }
+            if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+                outcome = "failed"
+                changes = {"status": Job.FAILED}
+            Job.objects.filter(pk=job.pk, claim=job.claim).update(
+                last_error=error, lease_expires=None, **changes
+            )
+        else:
+            outcome = "done"
+            Job.objects.filter(pk=job.pk, claim=job.claim).delete()
+        metrics.JOBS.inc(task=job.task, outcome=outcome)
+        metrics.JOB_DURATION.observe(
+            time.perf_counter() - start, task=job.task
+        )
+        if outcome == "done":
+            metrics.JOB_LATENCY.observe(
+                (timezone.now() - job.run_at).total_seconds(), task=job.task
+            )
+        return outcome == "done"
+
+    @staticmethod
+    def depth():
+        """
+        Returns the number of the jobs by task and status,
+        for the ebag_job_queue_depth metric.
+        """
+        statuses = dict(Job.STATUSES)
+        return {
+            (("status", statuses[row["status"]]), ("task", row["task"])):
+                row["count"]
+            for row in Job.objects.values("task", "status").annotate(
+                count=Count("id")
+            ).order_by()
+        }
+
+
+QUEUE_DEPTH = metrics.Gauge(
+    "ebag_job_queue_depth",
+    "Jobs in the queue by task and status.",
+    ("task", "status"),
+    function=Jobs.depth
+)
+
+
+class JobWorker:
+    """
+    Runs the queued jobs until stopped by SIGTERM or SIGINT,
+    which let the current job finish.
+    """
+
+    def __init__(self, batch_size, poll_interval):
+        """
+        :param batch_size: The jobs claimed at once
+        :type batch_size: int
+        :param poll_interval: The seconds to wait when no job is due
+        :type poll_interval: float
+        """
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopping = False
+        self.name = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self, once=False):
+        """
+        Runs the jobs and returns the number of the done ones.
+
+        :param once: Stop when no job is due, instead of waiting
+        :type once: bool
+        """
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        done = 0
+        try:
+            while not self.stopping:
+                jobs = Jobs.claim(self.batch_size)
+                if not jobs:
+                    if once:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                for position, job in enumerate(jobs):
+                    if self.stopping:
+                        Jobs.release(jobs[position:])
+                        break
+                    done += Jobs.run(job)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        logger.info("Worker %s stopped, %d jobs done.", self.name, done)
+        return done
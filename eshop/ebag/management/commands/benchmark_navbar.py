@@ -0,0 +1,103 @@
+from django.core.management.base import BaseCommand
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from ebag.models import Category
+import statistics
+import time
+
+
+def build_tree(size, branching):
+    """
+    Builds in memory (without touching the DB) a categories tree
+    with the given number of nodes, where every node has up to
+    `branching` children. Returns the nodes as unsaved Category
+    instances ordered by tree_id and lft, as the tree is returned
+    by CategoryTreeCache.get_nodes().
+
+    :param size: The number of nodes
+    :type size: int
+    :param branching: The number of children per node
+    :type branching: int
+    """
+    children = {pk: [] for pk in range(1, size + 1)}
+    roots = []
+    for pk in range(1, size + 1):
+        if pk <= branching:
+            roots.append(pk)
+        else:
+            children[(pk - branching - 1) // branching + 1].append(pk)
+    nodes = []
+
+    def add_node(pk, parent_id, tree_id, level, lft):
+        node = Category(
+            id=pk,
+            name="Category %d" % pk,
+            slug="category-%d" % pk,
+            parent_id=parent_id,
+            tree_id=tree_id,
+            level=level,
+            lft=lft
+        )
+        node.url = node.build_url()
+        nodes.append(node)
+        rght = lft + 1
+        for child in children[pk]:
+            rght = add_node(child, pk, tree_id, level + 1, rght) + 1
+        node.rght = rght
+        return rght
+
+    for tree_id, pk in enumerate(roots, 1):
+        add_node(pk, None, tree_id, 0, 1)
+    return nodes
+
+
+class Command(BaseCommand):
+    help = ("Measures the navbar render time for different categories "
+            "tree sizes with the fragment cache on and off.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[100, 1000, 10000],
+            help="Tree sizes (number of categories) to measure."
+        )
+        parser.add_argument(
+            "--branching", type=int, default=10,
+            help="Number of subcategories per category."
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=20,
+            help="Number of renders per measurement."
+        )
+
+    def measure(self, nodes, repeat, cached):
+        """
+        Returns the median render time in milliseconds. With the cache
+        off every render uses a new tree version, so it always misses
+        the fragment cache, as the first request after a category change.
+        """
+        timings = []
+        for i in range(repeat + 1):
+            ctx = {
+                "categories": nodes,
+                "category_tree_version": "bench-%d-%s" % (
+                    len(nodes), "on" if cached else i
+                ),
+            }
+            start = time.perf_counter()
+            render_to_string("navbar.html", ctx)
+            timings.append((time.perf_counter() - start) * 1000)
+        # The first render of the cached run only fills the cache
+        return statistics.median(timings[1:])
+
+    def handle(self, *args, **options):
+        caches["default"].clear()
+        self.stdout.write("%8s %14s %14s %10s" % (
+            "nodes", "cache off, ms", "cache on, ms", "speedup"
+        ))
+        for size in options["sizes"]:
+            nodes = build_tree(size, options["branching"])
+            off = self.measure(nodes, options["repeat"], cached=False)
+            on = self.measure(nodes, options["repeat"], cached=True)
+            self.stdout.write("%8d %14.3f %14.3f %9.1fx" % (
+                size, off, on, off / on
+            ))
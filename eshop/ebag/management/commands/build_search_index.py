@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from ebag.search import SearchIndex
+
+
+class Command(BaseCommand):
+    help = ("Builds the products search index from the DB, folding in "
+            "the changes logged by the workers since the last build.")
+
+    def handle(self, *args, **options):
+        count = SearchIndex.build()
+        self.stdout.write(self.style.SUCCESS(
+            "%d products indexed." % count
+        ))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from ebag.metrics import MetricsStore
+
+
+class Command(BaseCommand):
+    help = ("Resets the metrics counters, deleting the archive and the "
+            "files of the dead worker processes.")
+
+    def handle(self, *args, **options):
+        MetricsStore.clear()
+        self.stdout.write(self.style.SUCCESS("Metrics cleared."))
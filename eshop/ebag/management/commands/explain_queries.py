@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from ebag.models import Category, Product
+from ebag.caching import CategoryTreeCache
+from ebag.pagination import KeysetPaginator
+from ebag.views import CategoryView
+
+
+class Command(BaseCommand):
+    help = ("Prints the EXPLAIN output of the storefront queries, "
+            "so that missing indexes and full scans are visible.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--category", type=int,
+            help="Category id used in the queries, "
+                 "by default the leaf category with most products."
+        )
+
+    def get_category_id(self, options):
+        if options["category"] is not None:
+            return options["category"]
+        category = Category.objects.filter(is_leaf=True).annotate(
+            products_count=Count("product")
+        ).order_by("-products_count").first()
+        if category is None:
+            raise CommandError("There are no categories.")
+        return category.pk
+
+    def get_queries(self, category_id):
+        """
+        Returns a list of (description, queryset) with the
+        queries executed by the storefront views.
+        """
+        product = Product.objects.filter(category_id=category_id).first()
+        products = Product.objects.filter(
+            category_id=category_id
+        ).values(*CategoryView.product_fields)
+        page_size = settings.CATEGORY_PAGE_SIZE
+        queries = [
+            ("Categories tree (CategoryTreeCache)",
+             Category.objects.order_by("tree_id", "lft").values(
+                 *CategoryTreeCache.FIELDS)),
+            ("Category by URL path",
+             Category.objects.filter(url="category/%d/x" % category_id)),
+            ("Admin leaf categories",
+             Category.objects.filter(is_leaf=True)),
+            ("Category products, rows counted by page number pagination",
+             products.order_by().values("id")),
+        ]
+        for sort, ordering in CategoryView.sort_orderings.items():
+            queries.append((
+                "Category page, sort=%s, page 2" % sort,
+                products.order_by(*ordering)[page_size:page_size * 2]
+            ))
+            if product is not None:
+                paginator = KeysetPaginator(products, ordering, page_size)
+                queries.append((
+                    "Category page, sort=%s, after cursor" % sort,
+                    products.order_by(*ordering).filter(paginator.after(
+                        [str(getattr(product, f)) for f in ordering]
+                    ))[:page_size + 1]
+                ))
+        category = Category.objects.get(pk=category_id)
+        root = category.get_root()
+        queries.append((
+            "Category subtree page, sort=price, price range 1",
+            Product.objects.filter(
+                category_id__in=list(root.get_descendants(
+                    include_self=True
+                ).values_list("id", flat=True)),
+                price__gte=settings.PRICE_FACET_BOUNDS[0],
+                price__lt=settings.PRICE_FACET_BOUNDS[1]
+            ).values(*CategoryView.product_fields).order_by(
+                "price", "id"
+            )[:page_size]
+        ))
+        queries.append((
+            "Cart products (ProductCache)",
+            Product.objects.filter(
+                id__in=list(range(1, 51))
+            ).values()
+        ))
+        return queries
+
+    def explain(self, queryset):
+        """
+        Returns the query SQL and the EXPLAIN output rows,
+        starting with the column names.
+
+        :param queryset: The explained query
+        :type queryset: QuerySet
+        """
+        sql, params = queryset.query.sql_with_params()
+        prefix = "EXPLAIN QUERY PLAN " \
+            if connection.vendor == "sqlite" else "EXPLAIN "
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            columns = [col[0] for col in cursor.description]
+            rows = cursor.fetchall()
+        return sql % tuple(repr(p) for p in params), [columns] + rows
+
+    def handle(self, *args, **options):
+        for description, queryset in self.get_queries(
+                self.get_category_id(options)):
+            sql, rows = self.explain(queryset)
+            self.stdout.write(self.style.MIGRATE_HEADING(description))
+            self.stdout.write(sql)
+            for row in rows:
+                self.stdout.write("  " + " | ".join(str(v) for v in row))
+            self.stdout.write("")
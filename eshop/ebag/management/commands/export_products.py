@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ebag.exporting import ProductFeed
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = ("Exports all the products to a CSV, JSON lines or XML "
+            "(Google Merchant) feed file, gzipped if it ends with .gz.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The feed file")
+        parser.add_argument(
+            "--format",
+            choices=sorted(ProductFeed.CONTENT_TYPES),
+            default=None,
+            help="The feed format (default: by the file extension)"
+        )
+        parser.add_argument(
+            "--base-url",
+            default="http://localhost:8000",
+            help="The site URL the product links start with"
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.PRODUCT_FEED_CHUNK_SIZE,
+            help="Products read per query"
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        compress = path.endswith(".gz")
+        format = options["format"]
+        if format is None:
+            extension = os.path.splitext(path[:-3] if compress else path)[1]
+            format = extension.lstrip(".").lower()
+        if format not in ProductFeed.CONTENT_TYPES:
+            raise CommandError(
+                "Unknown feed format %s, pass --format." % format
+            )
+        start = time.perf_counter()
+        feed = ProductFeed(
+            format, options["base_url"], chunk_size=options["chunk_size"]
+        )
+        # Written to a temporary file, so that the partners never
+        # download a half written feed
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temporary, "wb") as file_:
+                for data in feed.stream(compress):
+                    file_.write(data)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.stdout.write(self.style.SUCCESS(
+            "%d products exported in %.1f s." % (
+                feed.count, time.perf_counter() - start
+            )
+        ))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from ebag.benchmarks.catalogue import generate_catalogue
+import time
+
+
+class Command(BaseCommand):
+    help = ("Adds a synthetic catalogue (categories trees and products) "
+            "to the DB, used by the run_benchmark command.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--depth", type=int, default=3,
+            help="Number of category levels."
+        )
+        parser.add_argument(
+            "--branching", type=int, default=5,
+            help="Number of root categories and subcategories per category."
+        )
+        parser.add_argument(
+            "--products-per-leaf", type=int, default=50,
+            help="Number of products in every leaf category."
+        )
+        parser.add_argument(
+            "--images", type=int, default=0,
+            help="Number of distinct placeholder images, "
+                 "0 leaves the products without images."
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0,
+            help="Random numbers generator seed."
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of rows per INSERT."
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        categories, products = generate_catalogue(
+            options["depth"],
+            options["branching"],
+            options["products_per_leaf"],
+            images=options["images"],
+            seed=options["seed"],
+            batch_size=options["batch_size"]
+        )
+        self.stdout.write(self.style.SUCCESS(
+            "Created %d categories and %d products in %.1f s." % (
+                categories, products, time.perf_counter() - start
+            )
+        ))
@@ -0,0 +1,58 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from ebag.images import ProductImages
+from ebag.models import Product
+import functools
+import os
+
+
+class Command(BaseCommand):
+    help = ("Generates the resized and WebP derivatives of the product "
+            "images which have none yet, in parallel on all the CPU cores.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Number of worker processes (default: CPU cores)"
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Regenerate the existing derivatives too"
+        )
+
+    def handle(self, *args, **options):
+        names = list(
+            Product.objects.exclude(image="").order_by().values_list(
+                "image", flat=True
+            ).distinct()
+        )
+        backfill = functools.partial(
+            ProductImages.backfill, force=options["force"]
+        )
+        generated = skipped = failed = 0
+        if options["workers"] > 1:
+            executor = ProcessPoolExecutor(max_workers=options["workers"])
+            results = executor.map(backfill, names, chunksize=16)
+        else:
+            executor = None
+            results = map(backfill, names)
+        try:
+            for name, (manifest, error) in zip(names, results):
+                if error is not None:
+                    failed += 1
+                    self.stderr.write("%s: %s" % (name, error))
+                elif manifest is None:
+                    skipped += 1
+                else:
+                    generated += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.stdout.write(self.style.SUCCESS(
+            "%d images generated, %d skipped, %d failed." % (
+                generated, skipped, failed
+            )
+        ))
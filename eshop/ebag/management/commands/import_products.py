@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand, CommandError
+from ebag.importing import ProductImport
+import os
+
+
+class Command(BaseCommand):
+    help = ("Imports the products of a CSV or JSON lines feed, creating or "
+            "updating them by SKU, and resumes a failed import from its "
+            "checkpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The feed file")
+        parser.add_argument(
+            "--format",
+            choices=("csv", "jsonl"),
+            default=None,
+            help="The feed format (default: by the file extension)"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows written per transaction"
+        )
+        parser.add_argument(
+            "--images-dir",
+            default=None,
+            help="Directory of the image paths (default: the feed directory)"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Image worker processes, 0 for none (default: CPU cores)"
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=None,
+            help="Checkpoint file (default: the feed path + .checkpoint)"
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Import from the start, ignoring the checkpoint"
+        )
+        parser.add_argument(
+            "--create-categories",
+            action="store_true",
+            help="Create the missing categories"
+        )
+
+    def handle(self, *args, **options):
+        product_import = ProductImport(
+            options["path"],
+            format=options["format"],
+            batch_size=options["batch_size"],
+            images_dir=options["images_dir"],
+            workers=options["workers"],
+            checkpoint=options["checkpoint"],
+            create_categories=options["create_categories"],
+            progress=self.report,
+            error=lambda line, error: self.stderr.write(
+                "Line %d: %s" % (line, error)
+            )
+        )
+        try:
+            results = product_import.run(restart=options["restart"])
+        except (OSError, ValueError) as error:
+            raise CommandError(str(error))
+        if results["resumed_from_line"]:
+            self.stdout.write(
+                "Resumed after line %d." % results["resumed_from_line"]
+            )
+        self.report(results)
+        self.stdout.write(self.style.SUCCESS(
+            "Imported in %.1f s." % results["seconds"]
+        ))
+
+    def report(self, results):
+        self.stdout.write(
+            "%(rows)d rows: %(created)d created, %(updated)d updated, "
+            "%(failed)d failed, %(rows_per_second).0f rows/s" % results
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ebag.caching import CategoryTreeCache
+from ebag.stats import CategoryStats
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the product count and the price range of "
+            "every category subtree, e.g. after bulk product changes "
+            "which send no signals.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = CategoryStats.rebuild()
+            transaction.on_commit(CategoryTreeCache.invalidate_stats)
+        self.stdout.write(self.style.SUCCESS(
+            "%d categories updated." % updated
+        ))
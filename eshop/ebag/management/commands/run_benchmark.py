@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from ebag.benchmarks.runner import StorefrontBenchmark
+import json
+import os
+
+
+class Command(BaseCommand):
+    help = ("Measures the storefront views latency percentiles, queries "
+            "and memory and saves the results to a JSON file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat", type=int, default=100,
+            help="Number of timed requests per view."
+        )
+        parser.add_argument(
+            "--warmup", type=int, default=10,
+            help="Number of untimed requests per view."
+        )
+        parser.add_argument(
+            "--output", default="benchmark.json",
+            help="The results JSON file."
+        )
+        parser.add_argument(
+            "--baseline",
+            help="A results JSON file of a previous run to compare with."
+        )
+
+    def load_baseline(self, path):
+        if path is None:
+            return {}
+        if not os.path.isfile(path):
+            raise CommandError("Baseline file %s not found." % path)
+        with open(path) as file_:
+            return json.load(file_)["results"]
+
+    def handle(self, *args, **options):
+        baseline = self.load_baseline(options["baseline"])
+        try:
+            benchmark = StorefrontBenchmark(
+                repeat=options["repeat"], warmup=options["warmup"]
+            )
+            results = benchmark.run()
+        except ValueError as e:
+            raise CommandError(str(e))
+        with open(options["output"], "w") as file_:
+            json.dump(results, file_, indent=2)
+
+        self.stdout.write("%-24s %9s %9s %9s %8s %10s %9s" % (
+            "view", "p50 ms", "p95 ms", "p99 ms", "queries", "memory KB",
+            "p50 diff"
+        ))
+        for name, result in results["results"].items():
+            diff = ""
+            if name in baseline:
+                diff = "%+.1f%%" % (
+                    (result["p50_ms"] / baseline[name]["p50_ms"] - 1) * 100
+                )
+            self.stdout.write("%-24s %9.2f %9.2f %9.2f %8d %10.1f %9s" % (
+                name, result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                result["queries"], result["peak_memory_kb"], diff
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            "Results saved to %s." % options["output"]
+        ))
@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from ebag.jobs import JobWorker
+import multiprocessing
+import signal
+
+
+def work(batch_size, poll_interval, once):
+    return JobWorker(batch_size, poll_interval).run(once=once)
+
+
+class Command(BaseCommand):
+    help = ("Runs the queued jobs (order e-mails, metrics, ...) in one or "
+            "more worker processes until stopped with SIGTERM or Ctrl+C.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes (default: 1)"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.JOB_BATCH_SIZE,
+            help="Jobs claimed at once by a worker"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_POLL_INTERVAL,
+            help="Seconds to wait when no job is due"
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when no job is due, instead of waiting"
+        )
+
+    def handle(self, *args, **options):
+        arguments = (
+            options["batch_size"], options["poll_interval"], options["once"]
+        )
+        if options["processes"] <= 1:
+            done = work(*arguments)
+            self.stdout.write(self.style.SUCCESS("%d jobs done." % done))
+        else:
+            # The forked workers must not share the DB connections
+            connections.close_all()
+            processes = [
+                multiprocessing.Process(target=work, args=arguments)
+                for number in range(options["processes"])
+            ]
+            for process in processes:
+                process.start()
+
+            def stop(signum, frame):
+                for process in processes:
+                    process.terminate()
+
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            for process in processes:
+                process.join()
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from ebag.benchmarks.stress import CheckoutStress
+
+
+class Command(BaseCommand):
+    help = ("Checks out a hot product from many threads at once, verifies "
+            "that it is not oversold and reports the orders throughput. "
+            "Creates and deletes its own product and orders.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--stock", type=int, default=200)
+        parser.add_argument("--quantity", type=int, default=1)
+
+    def handle(self, *args, **options):
+        results = CheckoutStress(
+            threads=options["threads"],
+            stock=options["stock"],
+            quantity=options["quantity"]
+        ).run()
+        for name, value in results.items():
+            self.stdout.write("%-18s %s" % (name, value))
+        if not results["consistent"]:
+            raise CommandError("The product was oversold.")
+        self.stdout.write(self.style.SUCCESS(
+            "%d orders placed, %.1f orders/s." % (
+                results["orders"], results["orders_per_second"]
+            )
+        ))
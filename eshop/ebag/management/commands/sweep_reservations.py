@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from ebag.stock import StockReservations
+import time
+
+
+class Command(BaseCommand):
+    help = ("Gives the stock of the expired cart reservations back, once "
+            "or every --interval seconds as a background process.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="Sweep every INTERVAL seconds until stopped"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            released = StockReservations.sweep()
+            self.stdout.write(self.style.SUCCESS(
+                "%d reservations released." % released
+            ))
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,518 @@
+from contextlib import contextmanager
+from django.conf import settings
+import fcntl
+import glob
+import json
+import math
+import mmap
+import os
+import socket
+import struct
+import threading
+
+
+class MetricsFile:
+    """
+    The metric values of a single process, kept in a memory-mapped
+    file, so that the /metrics endpoint served by any worker can sum
+    up the values of all the workers. Only the owner process writes
+    to the file. Layout: the number of used bytes (8 bytes), followed
+    by the entries, each one being the key length (4 bytes), the
+    UTF-8 key padded to 8 bytes alignment and the value (a double).
+    The owner holds a shared lock on the file as long as it's open,
+    which tells the other processes that it's still alive.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+    HEADER = struct.Struct("q")
+    VALUE = struct.Struct("d")
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.file = open(path, "a+b")
+        fcntl.flock(self.file, fcntl.LOCK_SH)
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            self.size = self.INITIAL_SIZE
+            self.file.truncate(self.size)
+        self.mmap = mmap.mmap(self.file.fileno(), self.size)
+        self.used = self.HEADER.unpack_from(self.mmap, 0)[0]
+        if self.used == 0:
+            self.used = self.HEADER.size
+            self.HEADER.pack_into(self.mmap, 0, self.used)
+        self.positions = {
+            key: position
+            for key, value, position in self.read_entries(self.mmap)
+        }
+
+    @staticmethod
+    def read_entries(data):
+        """
+        Yields the (key, value, value position) of the file entries.
+
+        :param data: The file content
+        :type data: bytes / mmap
+        """
+        used = MetricsFile.HEADER.unpack_from(data, 0)[0]
+        position = MetricsFile.HEADER.size
+        while position < used:
+            length = struct.unpack_from("i", data, position)[0]
+            key = bytes(data[position + 4:position + 4 + length])
+            position += 4 + length + (-(4 + length) % 8)
+            yield (
+                key.decode(),
+                MetricsFile.VALUE.unpack_from(data, position)[0],
+                position
+            )
+            position += MetricsFile.VALUE.size
+
+    @staticmethod
+    def entry(key, value):
+        """
+        Returns the bytes of an entry.
+        """
+        encoded = key.encode()
+        return (
+            struct.pack("i", len(encoded)) + encoded +
+            b"\0" * (-(4 + len(encoded)) % 8) + MetricsFile.VALUE.pack(value)
+        )
+
+    @staticmethod
+    def pack(values):
+        """
+        Returns the content of a file holding the given values.
+
+        :param values: {key: value}
+        :type values: dict
+        """
+        data = b"".join(
+            MetricsFile.entry(key, value)
+            for key, value in sorted(values.items())
+        )
+        header = MetricsFile.HEADER.pack(MetricsFile.HEADER.size + len(data))
+        return header + data
+
+    def add_entry(self, key):
+        entry = self.entry(key, 0.0)
+        if self.used + len(entry) > self.size:
+            self.grow(self.used + len(entry))
+        self.mmap[self.used:self.used + len(entry)] = entry
+        self.used += len(entry)
+        self.positions[key] = self.used - self.VALUE.size
+        # The used size is updated after the entry is written,
+        # so that the readers never see a partial entry
+        self.HEADER.pack_into(self.mmap, 0, self.used)
+
+    def grow(self, size):
+        while self.size < size:
+            self.size *= 2
+        self.mmap.close()
+        self.file.truncate(self.size)
+        self.mmap = mmap.mmap(self.file.fileno(), self.size)
+
+    def close(self):
+        """
+        Closes the file, releasing its lock.
+        """
+        self.mmap.close()
+        self.file.close()
+
+    def add(self, key, amount):
+        if key not in self.positions:
+            self.add_entry(key)
+        position = self.positions[key]
+        value = self.VALUE.unpack_from(self.mmap, position)[0]
+        self.VALUE.pack_into(self.mmap, position, value + amount)
+
+
+class MetricsStore:
+    """
+    Gives access to the metrics file of the current process, created
+    in settings.METRICS_DIR, and sums up the values of all the files.
+    The files are named after the host too, as the web and the jobs
+    containers share the directory but not their process ids. The
+    files of the dead processes, of any host, are merged into the
+    archive file and deleted when the metrics are collected, like
+    Prometheus' multiprocess mark_process_dead, so that their number
+    doesn't grow with every restarted worker.
+    Contains only static methods so serves just as a namespace for
+    this group of methods.
+    """
+
+    FILE_NAME = "metrics_{host}_{pid}.db"
+    ARCHIVE_NAME = "metrics_archive.db"
+    LOCK_NAME = "metrics.lock"
+    lock = threading.Lock()
+    file = None
+
+    @staticmethod
+    def get_path(name):
+        return os.path.join(settings.METRICS_DIR, name)
+
+    @staticmethod
+    def get_file():
+        """
+        Returns the metrics file of the current process, opening
+        a new one in the worker processes forked after it's opened.
+        """
+        metrics_file = MetricsStore.file
+        if metrics_file is None or metrics_file.pid != os.getpid():
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            # Created with the lock file held, so that a collecting
+            # process doesn't take it for a dead one before it's locked
+            with MetricsStore.locked():
+                metrics_file = MetricsFile(MetricsStore.get_path(
+                    MetricsStore.FILE_NAME.format(
+                        host=socket.gethostname(), pid=os.getpid()
+                    )
+                ))
+            MetricsStore.file = metrics_file
+        return metrics_file
+
+    @staticmethod
+    @contextmanager
+    def locked():
+        """
+        Holds the lock file, serializing the processes which
+        create, merge or delete the metrics files.
+        """
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(MetricsStore.get_path(MetricsStore.LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def add(key, amount):
+        with MetricsStore.lock:
+            MetricsStore.get_file().add(key, amount)
+
+    @staticmethod
+    def get_paths():
+        """
+        Returns the paths of the process files.
+        """
+        return glob.glob(MetricsStore.get_path(
+            MetricsStore.FILE_NAME.format(host="*", pid="*")
+        ))
+
+    @staticmethod
+    def read(path):
+        """
+        Returns {key: value} of a file, empty if it's missing.
+        """
+        try:
+            with open(path, "rb") as file_:
+                data = file_.read()
+        except FileNotFoundError:
+            return {}
+        if len(data) < MetricsFile.HEADER.size:
+            return {}
+        return {
+            key: value
+            for key, value, position in MetricsFile.read_entries(data)
+        }
+
+    @staticmethod
+    def is_dead(path):
+        """
+        Checks if the process of a file is gone, i.e. nobody holds the
+        file lock any more. Unlike a pid check, this works for the
+        processes of the other containers sharing the directory too.
+        """
+        try:
+            file_ = open(path, "rb")
+        except FileNotFoundError:
+            return False
+        with file_:
+            try:
+                fcntl.flock(file_, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+
+    @staticmethod
+    def archive_dead():
+        """
+        Adds the values of the files of the dead processes to the
+        archive file and deletes them. The new archive is written
+        aside and replaces the old one after the merged files are
+        deleted, so that a crash loses their values, which Prometheus
+        treats as a counter reset, instead of counting them twice.
+        Called with the lock file held.
+        """
+        dead = list(filter(MetricsStore.is_dead, MetricsStore.get_paths()))
+        if not dead:
+            return
+        archive_path = MetricsStore.get_path(MetricsStore.ARCHIVE_NAME)
+        values = MetricsStore.read(archive_path)
+        for path in dead:
+            for key, value in MetricsStore.read(path).items():
+                values[key] = values.get(key, 0.0) + value
+        with open(archive_path + ".tmp", "wb") as file_:
+            file_.write(MetricsFile.pack(values))
+        for path in dead:
+            os.remove(path)
+        os.replace(archive_path + ".tmp", archive_path)
+
+    @staticmethod
+    def collect():
+        """
+        Returns the values of all the processes, dead ones included
+        so that the counters don't go back, summed up by key.
+        The workers collecting at the same time are serialized with
+        a lock file, so that none of them reads a file while another
+        one merges it into the archive.
+        """
+        values = {}
+        with MetricsStore.locked():
+            MetricsStore.archive_dead()
+            for path in MetricsStore.get_paths() + [
+                    MetricsStore.get_path(MetricsStore.ARCHIVE_NAME)]:
+                for key, value in MetricsStore.read(path).items():
+                    values[key] = values.get(key, 0.0) + value
+        return values
+
+    @staticmethod
+    def clear():
+        """
+        Deletes the files of the dead processes and the archive file,
+        resetting the counters. The files of the running processes are
+        kept, so it doesn't break the workers running meanwhile, the
+        file of the current process is closed and deleted though.
+        """
+        if MetricsStore.file is not None:
+            MetricsStore.file.close()
+            MetricsStore.file = None
+        with MetricsStore.locked():
+            for path in MetricsStore.get_paths():
+                if MetricsStore.is_dead(path):
+                    os.remove(path)
+            archive_path = MetricsStore.get_path(MetricsStore.ARCHIVE_NAME)
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+
+
+class Metric:
+    """
+    Base class of the metrics. A metric is declared once, at module
+    level, and is then registered for the /metrics endpoint.
+    """
+
+    TYPE = None
+    registry = []
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: The metric name, e.g. ebag_cart_errors_total
+        :type name: str
+        :param documentation: The metric help text
+        :type documentation: str
+        :param labelnames: The names of the metric labels
+        :type labelnames: tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        Metric.registry.append(self)
+
+    def key(self, sample, labels):
+        """
+        Returns the store key of a sample of this metric.
+        """
+        if set(labels) - {"le"} != set(self.labelnames):
+            raise ValueError("%s expects the labels %s, got %s." % (
+                self.name, self.labelnames, tuple(labels)
+            ))
+        return json.dumps(
+            [self.name, sample, {k: str(v) for k, v in labels.items()}],
+            sort_keys=True
+        )
+
+    def samples(self, values):
+        """
+        Yields the (sample suffix, labels, value) of this metric.
+
+        :param values: {(sample suffix, labels tuple): value} of
+                       this metric, summed up across the processes
+        :type values: dict
+        """
+        raise NotImplementedError
+
+    def expose(self, values):
+        """
+        Returns the metric lines in the Prometheus text format.
+        """
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.TYPE),
+        ]
+        for sample, labels, value in self.samples(values):
+            lines.append("%s%s%s %s" % (
+                self.name, sample, format_labels(labels), format_value(value)
+            ))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        MetricsStore.add(self.key("", labels), amount)
+
+    def samples(self, values):
+        for (sample, labels), value in sorted(values.items()):
+            yield sample, labels, value
+
+
+class Histogram(Metric):
+    """
+    A histogram with cumulative buckets, as Prometheus expects.
+    An observation is stored in its bucket only, the buckets are
+    accumulated when exposed.
+    """
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(__class__, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        bucket = next(b for b in self.buckets if value <= b)
+        with MetricsStore.lock:
+            metrics_file = MetricsStore.get_file()
+            metrics_file.add(self.key(
+                "_bucket", dict(labels, le=format_value(bucket))
+            ), 1)
+            metrics_file.add(self.key("_sum", labels), value)
+
+    def samples(self, values):
+        label_sets = sorted(set(
+            tuple(label for label in labels if label[0] != "le")
+            for (sample, labels) in values
+        ))
+        for labels in label_sets:
+            count = 0
+            for bucket in self.buckets:
+                le = format_value(bucket)
+                count += values.get(
+                    ("_bucket", tuple(sorted(labels + (("le", le),)))), 0
+                )
+                yield "_bucket", labels + (("le", le),), count
+            yield "_sum", labels, values.get(("_sum", labels), 0.0)
+            yield "_count", labels, count
+
+
+class Gauge(Metric):
+    """
+    A value read when the metrics are exposed, e.g. from the DB,
+    instead of being stored by the processes.
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        """
+        :param function: Returns {labels tuple: value}, e.g.
+                         {(("status", "queued"),): 5}
+        :type function: function
+        """
+        super(__class__, self).__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self, values):
+        for labels, value in sorted(self.function().items()):
+            yield "", labels, value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def expose():
+    """
+    Returns all the registered metrics in the Prometheus text format.
+    """
+    by_metric = {}
+    for key, value in MetricsStore.collect().items():
+        name, sample, labels = json.loads(key)
+        by_metric.setdefault(name, {})[
+            (sample, tuple(sorted(labels.items())))
+        ] = value
+    lines = []
+    for metric in Metric.registry:
+        lines += metric.expose(by_metric.get(metric.name, {}))
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "ebag_http_request_duration_seconds",
+    "Request latency by URL name.",
+    ("view",)
+)
+REQUESTS = Counter(
+    "ebag_http_requests_total",
+    "Requests by URL name and response status.",
+    ("view", "status")
+)
+DB_QUERIES = Counter(
+    "ebag_db_queries_total",
+    "SQL queries by URL name.",
+    ("view",)
+)
+CART_OPERATIONS = Counter(
+    "ebag_cart_operations_total",
+    "Cart items added, updated and removed.",
+    ("operation",)
+)
+CART_ERRORS = Counter(
+    "ebag_cart_errors_total",
+    "Rejected cart updates by error.",
+    ("error",)
+)
+ORDERS = Counter(
+    "ebag_orders_total",
+    "Placed orders.",
+)
+ORDER_LINES = Counter(
+    "ebag_order_lines_total",
+    "Lines of the placed orders.",
+)
+ORDER_REVENUE = Counter(
+    "ebag_order_revenue_total",
+    "Total of the placed orders.",
+)
+JOBS = Counter(
+    "ebag_jobs_total",
+    "Jobs run by task and outcome (done, retry or failed).",
+    ("task", "outcome")
+)
+JOB_DURATION = Histogram(
+    "ebag_job_duration_seconds",
+    "Job run time by task.",
+    ("task",)
+)
+JOB_LATENCY = Histogram(
+    "ebag_job_latency_seconds",
+    "Time from the job due time to its completion by task.",
+    ("task",),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
@@ -0,0 +1,176 @@
+from django.conf import settings
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+from .profiling import Profiling
+from .metrics import REQUEST_LATENCY, REQUESTS, DB_QUERIES
+from contextlib import ExitStack
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+logger = logging.getLogger("ebag.profiling")
+
+
+class CartStorageMiddleware:
+    """
+    Lets the cart storage backend used during the request
+    update the response, e.g. set the cart cookie.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        storage = getattr(request, "cart_storage", None)
+        if storage is not None:
+            storage.process_response(response)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests if settings.PROFILING_ENABLED is set or the
+    request has the X-Profile header, containing the token set in
+    settings.PROFILING_HEADER_TOKEN. Records the wall and CPU time,
+    the SQL queries, the session load/save and template render time
+    and the cache hits/misses, adds them to the Server-Timing
+    response header and logs them as JSON to the "ebag.profiling"
+    logger. A settings.PROFILING_CPROFILE_RATE fraction of the profiled
+    requests is also run under cProfile, saving the stats to
+    settings.PROFILING_CPROFILE_DIR.
+    Must be the first middleware, so it covers all the others.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def is_profiled(self, request):
+        if settings.PROFILING_ENABLED:
+            return True
+        token = request.META.get("HTTP_X_PROFILE")
+        return bool(
+            token and settings.PROFILING_HEADER_TOKEN and
+            constant_time_compare(token, settings.PROFILING_HEADER_TOKEN)
+        )
+
+    def __call__(self, request):
+        if not self.is_profiled(request):
+            return self.get_response(request)
+        profiler = None
+        if random.random() < settings.PROFILING_CPROFILE_RATE:
+            profiler = cProfile.Profile()
+        profile = Profiling.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(self.time_query)
+                    )
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            Profiling.stop()
+        response["Server-Timing"] = profile.server_timing()
+        data = profile.as_dict()
+        data.update({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+        })
+        if profiler is not None:
+            data["cprofile"] = self.save_stats(profiler)
+        logger.info(json.dumps(data), extra={"profile": data})
+        return response
+
+    def time_query(self, execute, sql, params, many, context):
+        """
+        Wraps the SQL queries execution (see connection.execute_wrapper).
+        """
+        profile = Profiling.current()
+        if profile is None:
+            return execute(sql, params, many, context)
+        with profile.timed("db"):
+            return execute(sql, params, many, context)
+
+    def save_stats(self, profiler):
+        """
+        Saves the cProfile stats, to be read with the pstats module
+        or a viewer such as snakeviz, and returns the file path.
+        """
+        os.makedirs(settings.PROFILING_CPROFILE_DIR, exist_ok=True)
+        path = os.path.join(
+            settings.PROFILING_CPROFILE_DIR,
+            "%s-%s.prof" % (time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex)
+        )
+        profiler.dump_stats(path)
+        return path
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, the response status and the number of SQL
+    queries of every request, labelled by the URL name (see
+    ebag.metrics). The requests not matching any URL are labelled
+    "unmatched", so that the labels don't grow with random paths.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match and match.url_name else "unmatched"
+        REQUEST_LATENCY.observe(duration, view=view)
+        REQUESTS.inc(view=view, status=response.status_code)
+        if queries[0]:
+            DB_QUERIES.inc(queries[0], view=view)
+        return response
+
+
+class ProfilingSessionMiddleware(SessionMiddleware):
+    """
+    The session middleware, timing the session load and save
+    of the requests profiled by ProfilingMiddleware.
+    """
+
+    def process_request(self, request):
+        super(__class__, self).process_request(request)
+        profile = Profiling.current()
+        if profile is not None:
+            load = request.session.load
+
+            def timed_load():
+                with profile.timed("session_load"):
+                    return load()
+
+            request.session.load = timed_load
+
+    def process_response(self, request, response):
+        profile = Profiling.current()
+        if profile is None:
+            return super(__class__, self).process_response(request, response)
+        with profile.timed("session_save"):
+            return super(__class__, self).process_response(request, response)
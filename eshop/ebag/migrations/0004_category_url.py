@@ -0,0 +1,45 @@
+# Generated by Django 2.0 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.template.defaultfilters import slugify
+
+
+def backfill_urls(apps, schema_editor):
+    """
+    Replaces the old slugs, containing the category id placeholder,
+    with the plain slugified names and stores the complete URL paths.
+    """
+    Category = apps.get_model('ebag', 'Category')
+    for cat in Category.objects.only('id', 'name').iterator():
+        slug = slugify(cat.name)
+        Category.objects.filter(pk=cat.pk).update(
+            slug=slug,
+            url='/'.join(['category', str(cat.pk), slug])
+        )
+
+
+def restore_slugs(apps, schema_editor):
+    """
+    Restores the old slugs, containing the category id placeholder.
+    """
+    Category = apps.get_model('ebag', 'Category')
+    for cat in Category.objects.only('id', 'name').iterator():
+        Category.objects.filter(pk=cat.pk).update(
+            slug='/'.join(['category', '{%pk%}', slugify(cat.name)])
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0003_remove_product_slug'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='url',
+            field=models.CharField(editable=False, max_length=255, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_urls, restore_slugs),
+    ]
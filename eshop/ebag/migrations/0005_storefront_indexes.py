@@ -0,0 +1,36 @@
+# Generated by Django 2.0 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def set_leaf_flags(apps, schema_editor):
+    Category = apps.get_model('ebag', 'Category')
+    Category.objects.filter(rght__gt=models.F('lft') + 1).update(is_leaf=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0004_category_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='is_leaf',
+            field=models.BooleanField(db_index=True, default=True, editable=False),
+        ),
+        migrations.RunPython(set_leaf_flags, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['tree_id', 'lft'], name='ebag_cat_tree_lft_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price', 'id'], name='ebag_prod_cat_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'name', 'id'], name='ebag_prod_cat_name_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.0 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+def backfill_stats(apps, schema_editor):
+    """
+    Computes the product count and the price range of every category
+    subtree, one aggregate per category. The running application keeps
+    them with ebag.stats.CategoryStats, see the rebuild_category_stats
+    command.
+    """
+    Category = apps.get_model('ebag', 'Category')
+    Product = apps.get_model('ebag', 'Product')
+    for cat in Category.objects.only('id', 'tree_id', 'lft', 'rght').iterator():
+        stats = Product.objects.filter(
+            category__tree_id=cat.tree_id,
+            category__lft__gte=cat.lft,
+            category__lft__lte=cat.rght
+        ).aggregate(
+            product_count=models.Count('id'),
+            min_price=models.Min('price'),
+            max_price=models.Max('price')
+        )
+        Category.objects.filter(pk=cat.pk).update(**stats)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0006_product_last_update'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='min_price',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='max_price',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
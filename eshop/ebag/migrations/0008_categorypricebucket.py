@@ -0,0 +1,64 @@
+# Generated by Django 2.0 on 2026-10-18 16:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_buckets(apps, schema_editor):
+    """
+    Creates the price ranges histogram of every category subtree,
+    one aggregate per category. The running application keeps them
+    with ebag.stats.CategoryStats, see the rebuild_category_stats
+    command.
+    """
+    Category = apps.get_model('ebag', 'Category')
+    Product = apps.get_model('ebag', 'Product')
+    CategoryPriceBucket = apps.get_model('ebag', 'CategoryPriceBucket')
+    bounds = (None,) + tuple(settings.PRICE_FACET_BOUNDS) + (None,)
+    ranges = {}
+    for bucket, (low, high) in enumerate(zip(bounds, bounds[1:])):
+        condition = models.Q()
+        if low is not None:
+            condition &= models.Q(price__gte=low)
+        if high is not None:
+            condition &= models.Q(price__lt=high)
+        ranges['bucket_%d' % bucket] = models.Count('id', filter=condition)
+    for cat in Category.objects.only('id', 'tree_id', 'lft', 'rght').iterator():
+        counts = Product.objects.filter(
+            category__tree_id=cat.tree_id,
+            category__lft__gte=cat.lft,
+            category__lft__lte=cat.rght
+        ).aggregate(**ranges)
+        CategoryPriceBucket.objects.bulk_create([
+            CategoryPriceBucket(
+                category_id=cat.pk,
+                bucket=bucket,
+                product_count=counts['bucket_%d' % bucket]
+            )
+            for bucket in range(len(ranges))
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0007_category_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryPriceBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.PositiveSmallIntegerField()),
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_buckets', to='ebag.Category')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorypricebucket',
+            unique_together={('category', 'bucket')},
+        ),
+        migrations.RunPython(backfill_buckets, migrations.RunPython.noop),
+    ]
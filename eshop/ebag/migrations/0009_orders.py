@@ -0,0 +1,58 @@
+# Generated by Django 2.0 on 2026-10-18 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_order_sequence(apps, schema_editor):
+    NumberSequence = apps.get_model('ebag', 'NumberSequence')
+    NumberSequence.objects.create(name='order')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0008_categorypricebucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NumberSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_number', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(editable=False, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('country', models.CharField(choices=[('1', 'Bulgaria'), ('2', 'Serbia'), ('3', 'USA')], max_length=2)),
+                ('first_name', models.CharField(max_length=30)),
+                ('last_name', models.CharField(max_length=30)),
+                ('company_name', models.CharField(blank=True, max_length=100)),
+                ('address_1', models.CharField(max_length=100)),
+                ('address_2', models.CharField(blank=True, max_length=200)),
+                ('state_region', models.CharField(max_length=50)),
+                ('post_code', models.CharField(max_length=20)),
+                ('email', models.EmailField(max_length=50)),
+                ('phone', models.CharField(max_length=20)),
+                ('order_notes', models.TextField(blank=True)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=100)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity', models.PositiveIntegerField()),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='ebag.Order')),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='ebag.Product')),
+            ],
+        ),
+        migrations.RunPython(create_order_sequence, migrations.RunPython.noop),
+    ]
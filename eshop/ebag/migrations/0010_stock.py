@@ -0,0 +1,37 @@
+# Generated by Django 2.0 on 2026-10-18 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0009_orders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holder', models.CharField(max_length=32)),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires', models.DateTimeField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='ebag.Product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['expires'], name='ebag_res_expires_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stockreservation',
+            unique_together={('holder', 'product')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ebag', '0012_product_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='metrics_recorded',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+    ]
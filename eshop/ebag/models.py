@@ -1,13 +1,32 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 from django.template.defaultfilters import slugify
-from django.conf import settings
 import uuid
 import os
 # Create your models here.
 
 
 class Product(models.Model):
+    class Meta:
+        # The category page filters by category and sorts by (price, id)
+        # or (name, id), see CategoryView.sort_orderings
+        indexes = [
+            models.Index(
+                fields=['category', 'price', 'id'],
+                name='ebag_prod_cat_price_idx'
+            ),
+            models.Index(
+                fields=['category', 'name', 'id'],
+                name='ebag_prod_cat_name_idx'
+            ),
+            # The latest product change in a category, see category_etag()
+            models.Index(
+                fields=['category', 'last_update'],
+                name='ebag_prod_cat_updated_idx'
+            ),
+        ]
+
     def save_file_with_id_name(self, filename):
         """
         Changes the file name to a random generated uuid
@@ -28,15 +47,57 @@ class Product(models.Model):
     description = models.TextField(blank=False, max_length=500)
     price = models.DecimalField(blank=False, max_digits=10, decimal_places=2)
     image = models.ImageField(upload_to=save_file_with_id_name)
+    last_update = models.DateTimeField(auto_now=True)
+    # The units in stock, not tracked if empty. Changed only with
+    # conditional UPDATEs, see ebag.stock.Stock
+    stock = models.PositiveIntegerField(null=True, blank=True)
+    # The product code of the supplier feeds, which the products are
+    # matched by when imported again, see ebag.importing
+    sku = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        blank=True,
+        editable=False
+    )
 
     def __str__(self):
         return self.name
 
 
+class StockReservation(models.Model):
+    """
+    The stock of a product held for a cart (the holder) since the
+    product was added to the cart, until the order or the expiry,
+    see ebag.stock.StockReservations.
+    """
+    class Meta:
+        unique_together = (('holder', 'product',))
+        indexes = [
+            models.Index(fields=['expires'], name='ebag_res_expires_idx'),
+        ]
+
+    holder = models.CharField(max_length=32)
+    product = models.ForeignKey(
+        'Product',
+        related_name='reservations',
+        on_delete=models.CASCADE
+    )
+    quantity = models.PositiveIntegerField()
+    expires = models.DateTimeField()
+
+
 class Category(MPTTModel):
     class Meta:
         unique_together = (('parent', 'slug',))
         verbose_name_plural = "Categories"
+        # The categories tree is read ordered by (tree_id, lft)
+        indexes = [
+            models.Index(
+                fields=['tree_id', 'lft'],
+                name='ebag_cat_tree_lft_idx'
+            ),
+        ]
 
     name = models.CharField(max_length=100)
     parent = TreeForeignKey(
@@ -49,21 +110,214 @@ class Category(MPTTModel):
     )
     last_update = models.DateTimeField(auto_now=True)
     slug = models.SlugField(blank=True)
+    url = models.CharField(
+        max_length=255,
+        unique=True,
+        null=True,
+        editable=False
+    )
+    # Denormalized rght == lft + 1, kept by update_leaf_flags()
+    is_leaf = models.BooleanField(default=True, db_index=True, editable=False)
+    # The products of the category subtree, kept by ebag.stats.CategoryStats
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+    min_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        editable=False
+    )
+    max_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        editable=False
+    )
 
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
+    @staticmethod
+    def update_leaf_flags(category_ids=None):
+        """
+        Updates the is_leaf flag of the categories whose flag
+        no longer matches their position in the tree, e.g. the
+        parent of a new category or the old parent of a moved one.
+        A category change can only change the flag of its parents,
+        so it passes their ids instead of checking the whole table.
+
+        :param category_ids: The ids of the checked categories,
+                             all of them if None
+        :type category_ids: iterable of int
+        """
+        categories = Category.objects.all()
+        if category_ids is not None:
+            category_ids = [pk for pk in category_ids if pk is not None]
+            if not category_ids:
+                return
+            categories = categories.filter(pk__in=category_ids)
+        categories.filter(
+            is_leaf=True, rght__gt=models.F('lft') + 1
+        ).update(is_leaf=False)
+        categories.filter(
+            is_leaf=False, rght=models.F('lft') + 1
+        ).update(is_leaf=True)
+
+    def build_url(self):
         """
-        Auto-generates a slug, containing a defined in the settings
-        placeholder for the category id, which will be later replaced
-        in the templates. The category id can not be included in the
-        slug by the time of the creation as the category and its id
-        still does not exist.
+        Returns the category URL path, containing the category id
+        and the slug, e.g. category/5/fruits
         """
-        self.slug = "/".join([
+        return "/".join([
             slugify(__class__.__name__.lower()),
-            settings.PK_PLACEHOLDER,
-            slugify(self.name)
+            str(self.pk),
+            self.slug
         ])
-        super(__class__, self).save(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        """
+        Auto-generates the slug and stores the complete category URL
+        path, so that it's not built on every render. The category id
+        does not exist before the first save, so a new category is saved
+        in two phases: the INSERT and an UPDATE of the URL, both in the
+        same transaction.
+        """
+        self.slug = slugify(self.name)
+        if self.pk is not None:
+            self.url = self.build_url()
+            super(__class__, self).save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            self.url = None
+            super(__class__, self).save(*args, **kwargs)
+            self.url = self.build_url()
+            __class__.objects.filter(pk=self.pk).update(url=self.url)
+
+
+class CategoryPriceBucket(models.Model):
+    """
+    The number of products of a category subtree in one price range
+    (see settings.PRICE_FACET_BOUNDS), so that the price facet counts
+    are read instead of grouped on every request. Every category has
+    a row per range, kept by ebag.stats.CategoryStats.
+    """
+    class Meta:
+        unique_together = (('category', 'bucket',))
+
+    category = models.ForeignKey(
+        'Category',
+        related_name='price_buckets',
+        on_delete=models.CASCADE
+    )
+    bucket = models.PositiveSmallIntegerField()
+    product_count = models.PositiveIntegerField(default=0)
+
+
+class NumberSequence(models.Model):
+    """
+    A named counter, e.g. of the order numbers, handed out in blocks
+    by ebag.orders.OrderNumbers (hi-lo), so that a number is allocated
+    without a query and without SELECT MAX on the numbered table.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    # The last number handed out in a block
+    last_number = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
+class Order(models.Model):
+    """
+    An order placed at the checkout, with the customer details
+    of the CheckoutForm and the lines of the cart.
+    """
+    COUNTRIES = (
+        ('1', 'Bulgaria'),
+        ('2', 'Serbia'),
+        ('3', 'USA')
+    )
+
+    number = models.PositiveIntegerField(unique=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    country = models.CharField(max_length=2, choices=COUNTRIES)
+    first_name = models.CharField(max_length=30)
+    last_name = models.CharField(max_length=30)
+    company_name = models.CharField(max_length=100, blank=True)
+    address_1 = models.CharField(max_length=100)
+    address_2 = models.CharField(max_length=200, blank=True)
+    state_region = models.CharField(max_length=50)
+    post_code = models.CharField(max_length=20)
+    email = models.EmailField(max_length=50)
+    phone = models.CharField(max_length=20)
+    order_notes = models.TextField(blank=True)
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    # Set by the record_order_metrics job before it counts the
+    # order, so that a job run again doesn't count it twice
+    metrics_recorded = models.BooleanField(default=False, editable=False)
+
+    def __str__(self):
+        return str(self.number)
+
+
+class OrderLine(models.Model):
+    """
+    An order product, with its name and price at the time of the
+    order, so that the order does not change with the product.
+    """
+    order = models.ForeignKey(
+        'Order',
+        related_name='lines',
+        on_delete=models.CASCADE
+    )
+    product = models.ForeignKey(
+        'Product',
+        null=True,
+        on_delete=models.SET_NULL
+    )
+    product_name = models.CharField(max_length=100)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+    def __str__(self):
+        return self.product_name
+
+
+class Job(models.Model):
+    """
+    A task queued to run outside of the request, e.g. after the
+    checkout, by the run_jobs worker processes, see ebag.jobs.
+    A job is deleted once it's done.
+    """
+    class Meta:
+        # The due jobs are claimed by status and run time
+        indexes = [
+            models.Index(
+                fields=['status', 'run_at'],
+                name='ebag_job_status_run_idx'
+            ),
+        ]
+
+    QUEUED = 0
+    RUNNING = 1
+    FAILED = 2
+    STATUSES = (
+        (QUEUED, 'queued'),
+        (RUNNING, 'running'),
+        (FAILED, 'failed'),
+    )
+
+    task = models.CharField(max_length=100)
+    # The task keyword arguments, as JSON
+    payload = models.TextField(default='{}')
+    status = models.PositiveSmallIntegerField(choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    run_at = models.DateTimeField(default=timezone.now)
+    # The random id of the worker claim of a running job, which
+    # is claimed again by another worker after lease_expires
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.task
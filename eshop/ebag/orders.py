@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from .jobs import Jobs
+from .models import NumberSequence, Order, OrderLine, Product
+from .stock import Stock, StockReservations
+import os
+import threading
+
+
+class OrderNumbers:
+    """
+    Hands out the order numbers with the hi-lo algorithm: every
+    process reserves a block of settings.ORDER_NUMBER_BLOCK_SIZE numbers
+    with an UPDATE of the "order" NumberSequence, then hands them out
+    from memory. The numbers are unique, but not ordered by the order
+    time across the processes, and the unused numbers of a block are
+    skipped when the process exits. Contains only static methods so
+    serves just as a namespace for this group of methods.
+    """
+
+    SEQUENCE = "order"
+    lock = threading.Lock()
+    # (process id, next number, last number) of the current block
+    block = None
+
+    @staticmethod
+    def allocate(size):
+        """
+        Reserves the next block of numbers and returns its last number.
+        Called outside the order transaction, so that the sequence row
+        is locked only for the duration of this short transaction.
+
+        :param size: The number of reserved numbers
+        :type size: int
+        """
+        with transaction.atomic():
+            sequence = NumberSequence.objects.filter(
+                name=OrderNumbers.SEQUENCE
+            )
+            if not sequence.update(last_number=F("last_number") + size):
+                NumberSequence.objects.get_or_create(
+                    name=OrderNumbers.SEQUENCE
+                )
+                sequence.update(last_number=F("last_number") + size)
+            return sequence.values_list("last_number", flat=True).get()
+
+    @staticmethod
+    def next():
+        """
+        Returns the next order number, reserving a new
+        block when the block of the process is used up.
+        """
+        with OrderNumbers.lock:
+            pid = os.getpid()
+            block = OrderNumbers.block
+            if block is None or block[0] != pid or block[1] > block[2]:
+                size = settings.ORDER_NUMBER_BLOCK_SIZE
+                last = OrderNumbers.allocate(size)
+                block = (pid, last - size + 1, last)
+            OrderNumbers.block = (pid, block[1] + 1, block[2])
+            return block[1]
+
+
+class Orders:
+    """
+    Places the orders of the checkout. Contains only static methods
+    so serves just as a namespace for this group of methods.
+    """
+
+    # The tasks (see ebag.tasks) queued with every placed order
+    JOBS = (
+        "send_order_confirmation",
+        "record_order_metrics",
+        "refresh_ordered_products",
+    )
+
+    @staticmethod
+    def place(cart, customer, holder=None):
+        """
+        Saves the order of the cart, with the current name and price
+        of its products, takes the ordered quantities from the stock
+        and returns the order, or None if none of the products exists
+        anymore. Raises OutOfStock if the stock is not enough. Whatever
+        the cart size, the order is written in one transaction with the
+        products query, the stock UPDATE (if any of the products stock
+        is tracked), the order INSERT, the lines bulk INSERT (split in
+        batches only by the SQLite parameters limit) and the INSERT of the
+        Orders.JOBS, run afterwards by the workers, plus the order
+        numbers block reservation once per ORDER_NUMBER_BLOCK_SIZE orders
+        and three queries for the stock reservations, if any.
+
+        :param cart: The compact cart, {product_id: quantity}
+        :type cart: dict
+        :param customer: The cleaned data of the CheckoutForm
+        :type customer: dict
+        :param holder: The stock reservations holder id of the cart
+        :type holder: str
+        """
+        quantities = {
+            int(product_id): int(quantity)
+            for product_id, quantity in cart.items()
+        }
+        number = OrderNumbers.next()
+        with transaction.atomic():
+            reserved_ids = (
+                StockReservations.product_ids(holder) if holder else set()
+            )
+            # Locks the rows of the ordered and of the reserved products
+            # in the order of their ids, as Stock.lock() does, before
+            # the reservations
+            products = list(
+                Product.objects.select_for_update().filter(
+                    id__in=set(quantities) | reserved_ids
+                ).order_by("id").values_list("id", "name", "price", "stock")
+            )
+            lines = [
+                OrderLine(
+                    product_id=product_id,
+                    product_name=name,
+                    price=price,
+                    quantity=quantities[product_id]
+                )
+                for product_id, name, price, stock in products
+                if product_id in quantities
+            ]
+            if not lines:
+                return None
+            reserved = StockReservations.consume(holder) if holder else {}
+            changes = {
+                product_id: quantities[product_id] - reserved.pop(
+                    product_id, 0
+                )
+                for product_id, name, price, stock in products
+                if stock is not None and product_id in quantities
+            }
+            # The reservations of the products which are not ordered
+            for product_id, quantity in reserved.items():
+                changes[product_id] = changes.get(product_id, 0) - quantity
+            Stock.take(changes, {
+                product_id: stock
+                for product_id, name, price, stock in products
+            })
+            order = Order.objects.create(
+                number=number,
+                total=sum(line.price * line.quantity for line in lines),
+                **customer
+            )
+            for line in lines:
+                line.order = order
+            OrderLine.objects.bulk_create(lines)
+            Jobs.enqueue([
+                (task, {"order_id": order.pk}) for task in Orders.JOBS
+            ])
+        return order
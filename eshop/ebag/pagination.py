@@ -0,0 +1,110 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+import base64
+import json
+
+
+class KeysetPage:
+    """
+    A page returned by KeysetPaginator.
+    """
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginates a values() queryset by the ordering fields values of the
+    last row of the previous page (the cursor), so that no OFFSET scan
+    is needed however deep the page is. The last ordering field must
+    be unique, e.g. ("price", "id"), so the order is stable.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        """
+        :param queryset: values() queryset, including the ordering fields
+        :type queryset: QuerySet
+        :param ordering: The ordering fields, all ascending
+        :type ordering: tuple
+        :param per_page: Number of rows per page
+        :type per_page: int
+        """
+        self.queryset = queryset
+        self.ordering = ordering
+        self.per_page = per_page
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(
+            json.dumps([str(v) for v in values]).encode()
+        ).decode()
+
+    def decode_cursor(self, cursor):
+        """
+        Returns the values list encoded in the cursor or None
+        if the cursor is empty or invalid.
+
+        :param cursor: The cursor from the request
+        :type cursor: str
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            return None
+        if (not isinstance(values, list) or
+                len(values) != len(self.ordering) or
+                not all(isinstance(v, str) for v in values)):
+            return None
+        return values
+
+    def after(self, values):
+        """
+        Returns the Q object filtering the rows after the given
+        ordering fields values (a row value comparison, which is
+        written out as OR-ed conditions for portability):
+        a >= x AND ((a > x) OR (a = x AND b > y) OR ...)
+        The redundant a >= x lets the DB seek the index range.
+
+        :param values: The ordering fields values
+        :type values: list
+        """
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            equal = {f: v for f, v in zip(self.ordering[:i], values)}
+            condition |= Q(**equal) & Q(**{field + "__gt": values[i]})
+        return Q(**{self.ordering[0] + "__gte": values[0]}) & condition
+
+    def page(self, cursor):
+        """
+        Returns the page after the given cursor, the first
+        page if the cursor is empty or invalid.
+
+        :param cursor: The cursor from the request
+        :type cursor: str
+        """
+        queryset = self.queryset.order_by(*self.ordering)
+        values = self.decode_cursor(cursor) if cursor else None
+        if values is not None:
+            try:
+                queryset = queryset.filter(self.after(values))
+            except (ValidationError, ValueError):
+                pass
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = self.encode_cursor(
+                rows[-1][field] for field in self.ordering
+            )
+        return KeysetPage(rows, next_cursor)
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from django.template.backends.django import DjangoTemplates, Template
+import threading
+import time
+
+# CPU time of the current thread, the whole process on Python 3.6
+thread_time = getattr(time, "thread_time", time.process_time)
+
+
+class RequestProfile:
+    """
+    Collects the timings and the cache lookups of a single request,
+    see ProfilingMiddleware.
+    """
+
+    def __init__(self):
+        # {name: [count, seconds]}
+        self.timings = {}
+        # {cache name: [hits, misses]}
+        self.caches = {}
+        self.wall = self.cpu = None
+        self.wall_start = time.perf_counter()
+        self.cpu_start = thread_time()
+
+    def add_timing(self, name, duration):
+        """
+        :param name: The timing name, e.g. "db"
+        :type name: str
+        :param duration: The duration in seconds
+        :type duration: float
+        """
+        timing = self.timings.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += duration
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.perf_counter() - start)
+
+    def add_cache_lookup(self, name, hits, misses):
+        lookups = self.caches.setdefault(name, [0, 0])
+        lookups[0] += hits
+        lookups[1] += misses
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = thread_time() - self.cpu_start
+
+    def as_dict(self):
+        """
+        Returns the profile data, with the durations in milliseconds.
+        """
+        data = {
+            "wall_ms": round(self.wall * 1000, 3),
+            "cpu_ms": round(self.cpu * 1000, 3),
+        }
+        for name, (count, duration) in sorted(self.timings.items()):
+            data[name + "_count"] = count
+            data[name + "_ms"] = round(duration * 1000, 3)
+        for name, (hits, misses) in sorted(self.caches.items()):
+            data[name + "_cache_hits"] = hits
+            data[name + "_cache_misses"] = misses
+        return data
+
+    def server_timing(self):
+        """
+        Returns the Server-Timing header value, e.g.
+        total;dur=12.5, cpu;dur=9.1, db;dur=1.2;desc="3 queries"
+        """
+        metrics = [
+            "total;dur=%.3f" % (self.wall * 1000),
+            "cpu;dur=%.3f" % (self.cpu * 1000),
+        ]
+        for name, (count, duration) in sorted(self.timings.items()):
+            metrics.append('%s;dur=%.3f;desc="%d %s"' % (
+                name, duration * 1000, count,
+                "queries" if name == "db" else "calls"
+            ))
+        for name, (hits, misses) in sorted(self.caches.items()):
+            metrics.append('cache-%s;desc="%d hits, %d misses"' % (
+                name.replace("_", "-"), hits, misses
+            ))
+        return ", ".join(metrics)
+
+
+class Profiling:
+    """
+    Keeps the profile of the request handled by the current thread,
+    so that code without access to the request (e.g. the caches) can
+    record into it. Contains only static methods so serves just as a
+    namespace for this group of methods.
+    """
+
+    local = threading.local()
+
+    @staticmethod
+    def current():
+        """
+        Returns the current RequestProfile or None
+        if the current request is not profiled.
+        """
+        return getattr(Profiling.local, "profile", None)
+
+    @staticmethod
+    def start():
+        Profiling.local.profile = RequestProfile()
+        return Profiling.local.profile
+
+    @staticmethod
+    def stop():
+        profile = Profiling.current()
+        Profiling.local.profile = None
+        if profile is not None:
+            profile.finish()
+        return profile
+
+    @staticmethod
+    def cache_lookup(name, hits, misses):
+        """
+        Records cache hits and misses if the request is profiled.
+
+        :param name: The cached data name, e.g. "product"
+        :type name: str
+        :param hits: Number of the found keys
+        :type hits: int
+        :param misses: Number of the missing keys
+        :type misses: int
+        """
+        profile = Profiling.current()
+        if profile is not None:
+            profile.add_cache_lookup(name, hits, misses)
+
+
+class ProfilingTemplate(Template):
+    def render(self, context=None, request=None):
+        profile = Profiling.current()
+        if profile is None:
+            return super(__class__, self).render(context, request)
+        with profile.timed("template"):
+            return super(__class__, self).render(context, request)
+
+
+class ProfilingDjangoTemplates(DjangoTemplates):
+    """
+    The Django templates backend, timing the template
+    rendering of the profiled requests.
+    """
+
+    def from_string(self, template_code):
+        return ProfilingTemplate(
+            self.engine.from_string(template_code), self
+        )
+
+    def get_template(self, template_name):
+        return ProfilingTemplate(
+            super(__class__, self).get_template(template_name).template, self
+        )
@@ -0,0 +1,181 @@
+from contextlib import ContextDecorator, ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+import logging
+import re
+
+logger = logging.getLogger("ebag.queries")
+
+NORMALIZE_RULES = (
+    # Quoted strings and numbers inlined in the SQL
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    # Placeholders lists of any length, e.g. IN (%s, %s, %s)
+    (re.compile(r"\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+def normalize_sql(sql):
+    """
+    Returns the query shape: the SQL with the literals replaced by ?
+    and the placeholders lists collapsed, so that the queries which
+    differ only by their parameters have the same shape.
+
+    :param sql: The SQL query
+    :type sql: str
+    """
+    for pattern, replacement in NORMALIZE_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class RepeatedQueriesError(AssertionError):
+    """
+    Raised when a query shape is repeated more times than allowed,
+    an AssertionError so that the tests report it as a failure.
+    """
+    pass
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a block executes more queries than its QueryBudget
+    allows, an AssertionError so that the tests report it as a failure.
+    """
+    pass
+
+
+class QueryDetector:
+    """
+    Context manager recording the queries executed on all the DB
+    connections, grouped by their shape (see normalize_sql).
+    """
+
+    def __init__(self):
+        self.shapes = {}
+        self.count = 0
+        self.stack = None
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for connection in connections.all():
+            self.stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stack.close()
+
+    def __call__(self, execute, sql, params, many, context):
+        shape = normalize_sql(sql)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def repeated(self, threshold):
+        """
+        Returns {shape: count} of the query shapes executed
+        more than `threshold` times.
+
+        :param threshold: The allowed number of executions
+        :type threshold: int
+        """
+        return {
+            shape: count for shape, count in self.shapes.items()
+            if count > threshold
+        }
+
+    @staticmethod
+    def describe(repeated):
+        return "\n".join(
+            "%d x %s" % (count, shape)
+            for shape, count in sorted(
+                repeated.items(), key=lambda item: -item[1]
+            )
+        )
+
+
+class QueryBudget(ContextDecorator):
+    """
+    Context manager and decorator for the tests, failing with
+    QueryBudgetExceeded if the block executes more than `max_queries`
+    queries or with RepeatedQueriesError if it executes any query
+    shape more than `max_repeats` times, e.g.
+
+        @QueryBudget(max_queries=2)
+        def test_home_view(self):
+            ...
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None):
+        """
+        :param max_queries: The allowed number of queries, None - any
+        :type max_queries: int / NoneType
+        :param max_repeats: The allowed executions of the same query
+                            shape, None - settings.QUERY_DETECTOR_THRESHOLD
+        :type max_repeats: int / NoneType
+        """
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.detector = None
+
+    def __enter__(self):
+        self.detector = QueryDetector().__enter__()
+        return self.detector
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detector.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return False
+        if self.max_queries is not None and \
+                self.detector.count > self.max_queries:
+            raise QueryBudgetExceeded(
+                "%d queries executed, the budget is %d:\n%s" % (
+                    self.detector.count,
+                    self.max_queries,
+                    QueryDetector.describe(self.detector.shapes)
+                )
+            )
+        max_repeats = self.max_repeats
+        if max_repeats is None:
+            max_repeats = settings.QUERY_DETECTOR_THRESHOLD
+        repeated = self.detector.repeated(max_repeats)
+        if repeated:
+            raise RepeatedQueriesError(
+                "Queries repeated more than %d times:\n%s" % (
+                    max_repeats, QueryDetector.describe(repeated)
+                )
+            )
+        return False
+
+
+class QueryDetectorMiddleware:
+    """
+    Detects the N+1 query patterns: the same query shape executed
+    more than settings.QUERY_DETECTOR_THRESHOLD times in a request.
+    Logs a warning to the "ebag.queries" logger, or raises
+    RepeatedQueriesError if settings.QUERY_DETECTOR_RAISE is set,
+    as it is when the tests run. Used only if
+    settings.QUERY_DETECTOR_ENABLED is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_DETECTOR_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryDetector() as detector:
+            response = self.get_response(request)
+        repeated = detector.repeated(settings.QUERY_DETECTOR_THRESHOLD)
+        if repeated:
+            message = "%s %s repeated queries:\n%s" % (
+                request.method,
+                request.path,
+                QueryDetector.describe(repeated)
+            )
+            if settings.QUERY_DETECTOR_RAISE:
+                raise RepeatedQueriesError(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,610 @@
+from django.conf import settings
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+TOKEN_RE = re.compile(r"\w+")
+STOP_WORDS = frozenset((
+    "a", "an", "and", "for", "in", "of", "on", "or", "the", "to", "with",
+))
+# The name terms weigh more than the description ones
+NAME_WEIGHT = 3
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """
+    Returns the lowercase words of the text, without
+    the stop words and the single characters.
+
+    :param text: The text
+    :type text: str
+    """
+    return [
+        token for token in TOKEN_RE.findall(text.lower())
+        if len(token) > 1 and token not in STOP_WORDS
+    ]
+
+
+def document_terms(name, description):
+    """
+    Returns ({term: weighted frequency}, weighted length)
+    of a product document.
+    """
+    terms = {}
+    for weight, text in ((NAME_WEIGHT, name), (1, description)):
+        for token in tokenize(text):
+            terms[token] = terms.get(token, 0) + weight
+    return terms, sum(terms.values())
+
+
+class IndexSegment:
+    """
+    An immutable index of the products, built by SearchIndex.build()
+    and memory-mapped read-only, so that all the workers share the
+    same pages. Layout, all the integers being unsigned 32 bits:
+
+    - the header: magic, generation, documents, terms, average
+      document length (a double) and the terms strings size
+    - the documents: (product id, length) sorted by product id
+    - the terms: (string offset, string length, first posting, postings)
+      sorted by the UTF-8 string, so a term and the terms with
+      a given prefix are found with a binary search
+    - the terms strings, UTF-8 encoded
+    - the postings: (document number, frequency) of every term
+    """
+
+    MAGIC = b"EBAGIDX1"
+    HEADER = struct.Struct("<8sIIIdI")
+    DOC = struct.Struct("<II")
+    TERM = struct.Struct("<IIII")
+    POSTING = struct.Struct("<II")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file_:
+            self.stat = os.fstat(file_.fileno())
+            self.mmap = mmap.mmap(
+                file_.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        (magic, self.generation, self.doc_count, self.term_count,
+         self.avg_length, strings_size) = self.HEADER.unpack_from(self.mmap)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a search index." % path)
+        self.docs_offset = self.HEADER.size
+        self.terms_offset = self.docs_offset + self.doc_count * self.DOC.size
+        self.strings_offset = (
+            self.terms_offset + self.term_count * self.TERM.size
+        )
+        self.postings_offset = self.strings_offset + strings_size
+
+    def close(self):
+        self.mmap.close()
+
+    def doc(self, number):
+        """
+        Returns the (product id, length) of a document.
+        """
+        return self.DOC.unpack_from(
+            self.mmap, self.docs_offset + number * self.DOC.size
+        )
+
+    def find_doc(self, product_id):
+        """
+        Returns the length of the product document
+        or None if the product is not in the segment.
+        """
+        low, high = 0, self.doc_count
+        while low < high:
+            middle = (low + high) // 2
+            found, length = self.doc(middle)
+            if found == product_id:
+                return length
+            if found < product_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def term_entry(self, number):
+        return self.TERM.unpack_from(
+            self.mmap, self.terms_offset + number * self.TERM.size
+        )
+
+    def term(self, number):
+        """
+        Returns the UTF-8 encoded term string.
+        """
+        offset, length, first, count = self.term_entry(number)
+        start = self.strings_offset + offset
+        return self.mmap[start:start + length]
+
+    def bisect(self, encoded):
+        """
+        Returns the number of the first term >= the encoded one.
+        """
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, term, prefix=False):
+        """
+        Yields the (term, first posting, postings) of the term,
+        or of all the terms starting with it if `prefix` is set.
+        """
+        encoded = term.encode()
+        number = self.bisect(encoded)
+        while number < self.term_count:
+            found = self.term(number)
+            if found != encoded and not (
+                    prefix and found.startswith(encoded)):
+                return
+            offset, length, first, count = self.term_entry(number)
+            yield found.decode(), first, count
+            number += 1
+
+    def postings(self, first, count):
+        """
+        Returns an iterator of the (document number,
+        frequency) of a term.
+        """
+        start = self.postings_offset + first * self.POSTING.size
+        return self.POSTING.iter_unpack(
+            self.mmap[start:start + count * self.POSTING.size]
+        )
+
+    @staticmethod
+    def write(path, generation, documents):
+        """
+        Writes a segment file with the given documents
+        and returns the number of the documents.
+
+        :param path: The file path
+        :type path: str
+        :param generation: The segment generation, see SearchIndex
+        :type generation: int
+        :param documents: (product id, {term: frequency}, length)
+                          sorted by product id
+        :type documents: iterable
+        """
+        docs = []
+        postings = {}
+        for number, (product_id, terms, length) in enumerate(documents):
+            docs.append(IndexSegment.DOC.pack(product_id, length))
+            for term, frequency in terms.items():
+                postings.setdefault(term.encode(), []).append(
+                    (number, frequency)
+                )
+        terms = []
+        strings = []
+        strings_size = 0
+        first = 0
+        for term in sorted(postings):
+            terms.append(IndexSegment.TERM.pack(
+                strings_size, len(term), first, len(postings[term])
+            ))
+            strings.append(term)
+            strings_size += len(term)
+            first += len(postings[term])
+        total_length = sum(
+            IndexSegment.DOC.unpack(doc)[1] for doc in docs
+        )
+        with open(path, "wb") as file_:
+            file_.write(IndexSegment.HEADER.pack(
+                IndexSegment.MAGIC,
+                generation,
+                len(docs),
+                len(terms),
+                total_length / len(docs) if docs else 0.0,
+                strings_size
+            ))
+            file_.write(b"".join(docs))
+            file_.write(b"".join(terms))
+            file_.write(b"".join(strings))
+            for term in sorted(postings):
+                file_.write(b"".join(
+                    IndexSegment.POSTING.pack(*posting)
+                    for posting in postings[term]
+                ))
+        return len(docs)
+
+
+class SearchIndex:
+    """
+    The products search index of the current process: the segment
+    built from the DB in settings.SEARCH_INDEX_DIR, plus the product
+    changes made since. The changes are appended by all the workers to
+    the changes log of the segment generation, and every process
+    replays the new log lines before a search, indexing the changed
+    products in memory and masking them in the segment. The log is
+    folded into a new segment generation by build(), which is queued
+    as a job whenever the log grows by settings.SEARCH_LOG_COMPACT_SIZE
+    bytes, so that neither the log nor the changes in memory grow
+    without limit. The document frequencies of the masked products are
+    still counted, which only slightly skews the ranking until the next
+    build. An index is never changed once it's searched: a refresh with
+    new changes returns a copy, so that the searches rank without the
+    lock, which is held only by the refresh.
+    """
+
+    SEGMENT_NAME = "products.idx"
+    LOG_NAME = "changes-{generation}.log"
+    BUILD_LOCK_NAME = "build.lock"
+    lock = threading.Lock()
+    instance = None
+
+    def __init__(self, segment=None, segment_key=None):
+        """
+        :param segment: The opened segment, None if never built
+        :type segment: IndexSegment / NoneType
+        :param segment_key: The segment file path and stat, which
+                            change when it's rebuilt
+        :type segment_key: tuple
+        """
+        self.segment = segment
+        self.segment_key = segment_key
+        self.log_position = 0
+        # {product id: ({term: frequency}, length) or None if deleted}
+        self.changes = {}
+        # {term: {product id: frequency}} of the changed products
+        self.postings = {}
+        # The terms whose postings were copied, see term_postings()
+        self.copied_terms = set()
+        self.doc_count = 0
+        self.total_length = 0.0
+        if segment is not None:
+            self.doc_count = segment.doc_count
+            self.total_length = segment.avg_length * segment.doc_count
+
+    @staticmethod
+    def path(name):
+        return os.path.join(settings.SEARCH_INDEX_DIR, name)
+
+    @staticmethod
+    def log_path(generation):
+        return SearchIndex.path(
+            SearchIndex.LOG_NAME.format(generation=generation)
+        )
+
+    @staticmethod
+    def current_generation():
+        """
+        Returns the generation of the segment on the
+        disk, 0 if the index was never built.
+        """
+        path = SearchIndex.path(SearchIndex.SEGMENT_NAME)
+        try:
+            with open(path, "rb") as file_:
+                header = file_.read(IndexSegment.HEADER.size)
+        except FileNotFoundError:
+            return 0
+        return IndexSegment.HEADER.unpack(header)[1]
+
+    def refresh(self):
+        """
+        Returns the index with the segment reopened if it was rebuilt
+        and the new lines of the changes log applied: the index itself
+        if there are none, otherwise a new one.
+        """
+        path = self.path(self.SEGMENT_NAME)
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            key = (path,)
+        index = self
+        if key != self.segment_key:
+            # The old segment is unmapped once the searches
+            # still using it are done
+            index = SearchIndex(
+                IndexSegment(path) if len(key) > 1 else None, key
+            )
+        generation = index.segment.generation if index.segment else 0
+        try:
+            with open(self.log_path(generation), "rb") as file_:
+                file_.seek(index.log_position)
+                data = file_.read()
+        except FileNotFoundError:
+            return index
+        # Only the complete lines, the last one may be still written
+        data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            return index
+        if index is self:
+            index = self.copy()
+        index.log_position += len(data)
+        for line in data.splitlines():
+            index.apply(json.loads(line.decode()))
+        return index
+
+    def copy(self):
+        """
+        Returns a copy of the index to apply new changes to. The
+        postings of a term are copied only when they are changed.
+        """
+        index = SearchIndex(self.segment, self.segment_key)
+        index.log_position = self.log_position
+        index.changes = dict(self.changes)
+        index.postings = dict(self.postings)
+        index.doc_count = self.doc_count
+        index.total_length = self.total_length
+        return index
+
+    def term_postings(self, term):
+        """
+        Returns the changed products postings of a term to modify,
+        copied first, as they may be shared with the previous index.
+        """
+        if term not in self.copied_terms:
+            self.postings[term] = dict(self.postings.get(term, ()))
+            self.copied_terms.add(term)
+        return self.postings[term]
+
+    def document_length(self, product_id):
+        """
+        Returns the current document length of the
+        product or None if it's not in the index.
+        """
+        if product_id in self.changes:
+            change = self.changes[product_id]
+            return None if change is None else change[1]
+        if self.segment is None:
+            return None
+        return self.segment.find_doc(product_id)
+
+    def apply(self, entry):
+        """
+        Applies a changes log entry: {"id", "name", "description"}
+        of a saved product or {"id", "deleted": true}.
+        """
+        product_id = entry["id"]
+        length = self.document_length(product_id)
+        if length is not None:
+            self.doc_count -= 1
+            self.total_length -= length
+        previous = self.changes.get(product_id)
+        if previous is not None:
+            for term in previous[0]:
+                postings = self.term_postings(term)
+                del postings[product_id]
+                if not postings:
+                    del self.postings[term]
+                    self.copied_terms.discard(term)
+        if entry.get("deleted"):
+            self.changes[product_id] = None
+            return
+        terms, length = document_terms(entry["name"], entry["description"])
+        self.changes[product_id] = (terms, length)
+        for term, frequency in terms.items():
+            self.term_postings(term)[product_id] = frequency
+        self.doc_count += 1
+        self.total_length += length
+
+    def terms(self, token, prefix):
+        """
+        Returns [(term, document frequency, segment postings)] of the
+        token, or of the most frequent terms starting with it if
+        `prefix` is set (up to settings.SEARCH_MAX_EXPANSIONS).
+        """
+        found = {}
+        if self.segment is not None:
+            for term, first, count in self.segment.lookup(token, prefix):
+                found[term] = [count, (first, count)]
+        for term, products in self.postings.items():
+            if term == token or prefix and term.startswith(token):
+                found.setdefault(term, [0, None])[0] += len(products)
+        terms = sorted(
+            ((term, df, postings) for term, (df, postings) in found.items()),
+            key=lambda item: -item[1]
+        )
+        return terms[:settings.SEARCH_MAX_EXPANSIONS]
+
+    def frequencies(self, term, postings):
+        """
+        Yields the (product id, frequency, document length) of
+        the current documents containing the term.
+        """
+        if postings is not None:
+            for number, frequency in self.segment.postings(*postings):
+                product_id, length = self.segment.doc(number)
+                if product_id not in self.changes:
+                    yield product_id, frequency, length
+        for product_id, frequency in self.postings.get(term, {}).items():
+            yield product_id, frequency, self.changes[product_id][1]
+
+    def rank(self, query, limit, prefix=False):
+        """
+        Returns [(product id, BM25 score)] of the products matching all
+        the query words, the best first. With `prefix` set, the last
+        word matches the terms starting with it, as while typing.
+        """
+        tokens = tokenize(query)
+        if not tokens or not self.doc_count:
+            return []
+        avg_length = self.total_length / self.doc_count
+        scores = None
+        for position, token in enumerate(tokens):
+            token_scores = {}
+            expand = prefix and position == len(tokens) - 1
+            for term, df, postings in self.terms(token, expand):
+                # The masked products may be still counted in df
+                df = min(df, self.doc_count)
+                idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+                for product_id, frequency, length in self.frequencies(
+                        term, postings):
+                    score = idf * frequency * (K1 + 1) / (
+                        frequency + K1 * (1 - B + B * length / avg_length)
+                    )
+                    # The best of the expanded terms counts
+                    if score > token_scores.get(product_id, -1.0):
+                        token_scores[product_id] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    product_id: scores[product_id] + score
+                    for product_id, score in token_scores.items()
+                    if product_id in scores
+                }
+            if not scores:
+                return []
+        return sorted(
+            scores.items(), key=lambda item: (-item[1], item[0])
+        )[:limit]
+
+    @staticmethod
+    def current():
+        """
+        Returns the refreshed index of the current process, which is
+        not changed afterwards, so it's searched without the lock.
+        """
+        with SearchIndex.lock:
+            index = SearchIndex.instance or SearchIndex()
+            SearchIndex.instance = index.refresh()
+            return SearchIndex.instance
+
+    @staticmethod
+    def search(query, limit, prefix=False):
+        """
+        Returns [(product id, score)] of the best matching products,
+        see rank().
+
+        :param query: The searched words
+        :type query: str
+        :param limit: The maximum number of results
+        :type limit: int
+        :param prefix: Match the last word as a prefix
+        :type prefix: bool
+        """
+        return SearchIndex.current().rank(query, limit, prefix)
+
+    @staticmethod
+    def complete(prefix, limit):
+        """
+        Returns the most frequent terms starting with the
+        last word of the prefix, for the autocomplete.
+        """
+        tokens = tokenize(prefix)
+        if not tokens:
+            return []
+        return [
+            term for term, df, postings in
+            SearchIndex.current().terms(tokens[-1], True)[:limit]
+        ]
+
+    @staticmethod
+    def append(generation, data):
+        """
+        Appends the data to the changes log of the generation
+        and returns the log size after it.
+        """
+        descriptor = os.open(
+            SearchIndex.log_path(generation),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644
+        )
+        try:
+            os.write(descriptor, data)
+            return os.fstat(descriptor).st_size
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def log(entry):
+        """
+        Appends an entry to the changes log, a single write of a whole
+        line, so that the lines of concurrent workers don't mix. If the
+        index was rebuilt meanwhile, the entry goes to the new log too.
+        The worker whose line crosses a multiple of
+        settings.SEARCH_LOG_COMPACT_SIZE queues a rebuild of the index.
+        """
+        from .jobs import Jobs
+
+        os.makedirs(settings.SEARCH_INDEX_DIR, exist_ok=True)
+        data = (json.dumps(entry) + "\n").encode()
+        generation = SearchIndex.current_generation()
+        size = SearchIndex.append(generation, data)
+        if SearchIndex.current_generation() != generation:
+            size = SearchIndex.append(SearchIndex.current_generation(), data)
+        compact_size = settings.SEARCH_LOG_COMPACT_SIZE
+        if (size - len(data)) // compact_size != size // compact_size:
+            Jobs.enqueue([("rebuild_search_index", {})])
+
+    @staticmethod
+    def update_product(product_id, name, description):
+        SearchIndex.log({
+            "id": product_id, "name": name, "description": description
+        })
+
+    @staticmethod
+    def delete_product(product_id):
+        SearchIndex.log({"id": product_id, "deleted": True})
+
+    @staticmethod
+    def build():
+        """
+        Builds the next segment generation from the DB, replacing the
+        current one, and returns the number of the indexed products.
+        The changes logged since the DB read started are copied to the
+        log of the new generation, replaying the ones already read from
+        the DB is harmless. The builds of concurrent processes, e.g.
+        a queued one and the build_search_index command, are run one
+        after the other.
+        """
+        from .models import Product
+
+        os.makedirs(settings.SEARCH_INDEX_DIR, exist_ok=True)
+        with open(SearchIndex.path(SearchIndex.BUILD_LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            generation = SearchIndex.current_generation()
+            old_log = SearchIndex.log_path(generation)
+            new_log = SearchIndex.log_path(generation + 1)
+            try:
+                position = os.path.getsize(old_log)
+            except FileNotFoundError:
+                position = 0
+            path = SearchIndex.path(SearchIndex.SEGMENT_NAME)
+            count = IndexSegment.write(path + ".tmp", generation + 1, (
+                (product_id,) + document_terms(name, description)
+                for product_id, name, description in
+                Product.objects.order_by("id").values_list(
+                    "id", "name", "description"
+                ).iterator()
+            ))
+            position = SearchIndex.copy_log(old_log, new_log, position)
+            os.replace(path + ".tmp", path)
+            # The lines appended while the segment was replaced
+            SearchIndex.copy_log(old_log, new_log, position)
+            if os.path.exists(old_log):
+                os.remove(old_log)
+        return count
+
+    @staticmethod
+    def copy_log(source, destination, position):
+        """
+        Appends the complete lines of the source log after
+        `position` to the destination log and returns the
+        position after the last copied line.
+        """
+        try:
+            with open(source, "rb") as file_:
+                file_.seek(position)
+                data = file_.read()
+        except FileNotFoundError:
+            data = b""
+        data = data[:data.rfind(b"\n") + 1]
+        with open(destination, "ab") as file_:
+            file_.write(data)
+        return position + len(data)
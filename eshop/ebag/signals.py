@@ -0,0 +1,161 @@
+from django.db import transaction
+from django.db.models.signals import (
+    post_init, post_save, post_delete, pre_save
+)
+from django.dispatch import receiver
+from mptt.signals import node_moved
+from .models import Category, Product
+from .caching import CategoryTreeCache, PageCache, ProductCache
+from .images import ProductImages
+from .search import SearchIndex
+from .stats import CategoryStats
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(node_moved, sender=Category)
+def invalidate_category_tree(sender, **kwargs):
+    """
+    Invalidates the cached categories tree on any category change.
+    The invalidation is repeated after the transaction commit, so that
+    a tree cached by another worker while the transaction was still
+    open (hence with the old data) is not served afterwards.
+    """
+    CategoryTreeCache.invalidate()
+    transaction.on_commit(CategoryTreeCache.invalidate)
+
+
+@receiver(post_init, sender=Category)
+def remember_category_parent(sender, instance, **kwargs):
+    """
+    Keeps the loaded parent of a category, so that the flags of the
+    old parent are updated when it is moved. Not read from the DB
+    in pre_save, as the mptt tree manager moves the node in the DB
+    before saving it. A deferred parent is not loaded.
+    """
+    instance._saved_parent_id = instance.__dict__.get("parent_id")
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(node_moved, sender=Category)
+def update_leaf_flags(sender, instance, **kwargs):
+    saved_parent_id = getattr(instance, "_saved_parent_id", None)
+    Category.update_leaf_flags({instance.parent_id, saved_parent_id})
+    if saved_parent_id != instance.parent_id:
+        # Kept for rebuild_category_stats(), as the tree manager
+        # saves a moved node before sending node_moved
+        instance._moved_from_id = saved_parent_id
+    instance._saved_parent_id = instance.parent_id
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    """
+    Removes the changed product from the cache and invalidates
+    the cached pages, again after the transaction commit for
+    the same reason as for the categories.
+    """
+    ProductCache.invalidate(instance.pk)
+    PageCache.invalidate()
+    transaction.on_commit(lambda: ProductCache.invalidate(instance.pk))
+    transaction.on_commit(PageCache.invalidate)
+
+
+@receiver(post_save, sender=Category)
+def create_category_stats(sender, instance, created, **kwargs):
+    """
+    A new category has no products, so it only gets an empty histogram.
+    """
+    if created:
+        CategoryStats.create_buckets(instance.pk)
+
+
+@receiver(node_moved, sender=Category)
+def rebuild_category_stats(sender, instance, **kwargs):
+    """
+    Rebuilds the stats of the old and the new ancestors of a moved
+    category, which lost or got the products of its subtree. Sent
+    once per move, either saved with a new parent or moved by the
+    tree manager, and not for the other category changes, which
+    don't change the stats.
+    """
+    category_ids = set()
+    for parent_id in {
+            instance.parent_id,
+            instance.__dict__.pop("_moved_from_id", None)} - {None}:
+        ancestors = CategoryStats.ancestors(parent_id)
+        if ancestors is not None:
+            category_ids.update(ancestors.values_list("id", flat=True))
+    CategoryStats.rebuild(category_ids)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_stats(sender, instance, **kwargs):
+    """
+    Keeps the saved category and price of a changed product,
+    so that its old category stats can be updated after the save.
+    """
+    instance._saved_stats = None
+    if instance.pk is not None:
+        instance._saved_stats = Product.objects.filter(
+            pk=instance.pk
+        ).values_list("category_id", "price").first()
+
+
+@receiver(post_save, sender=Product)
+def update_category_stats(sender, instance, **kwargs):
+    saved = getattr(instance, "_saved_stats", None)
+    current = (
+        instance.category_id,
+        Product._meta.get_field("price").to_python(instance.price)
+    )
+    if saved is not None and saved == current:
+        return
+    if saved is not None:
+        CategoryStats.remove_product(*saved)
+    CategoryStats.add_product(*current)
+    invalidate_category_stats()
+
+
+@receiver(post_delete, sender=Product)
+def remove_category_stats(sender, instance, **kwargs):
+    CategoryStats.remove_product(instance.category_id, instance.price)
+    invalidate_category_stats()
+
+
+def invalidate_category_stats():
+    """
+    Invalidates the stats of the cached categories tree, again
+    after the transaction commit like invalidate_category_tree(),
+    but not the tree version, as the categories didn't change.
+    """
+    CategoryTreeCache.invalidate_stats()
+    transaction.on_commit(CategoryTreeCache.invalidate_stats)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    """
+    Logs the saved product to the search index changes, after the
+    transaction commit, so that a rolled back change is not indexed.
+    """
+    product = (instance.pk, instance.name, instance.description)
+    transaction.on_commit(lambda: SearchIndex.update_product(*product))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: SearchIndex.delete_product(product_id))
+
+
+@receiver(post_save, sender=Product)
+def generate_product_images(sender, instance, **kwargs):
+    """
+    Generates the derivatives of an uploaded product image after the
+    transaction commit, as the image file is stored by the save.
+    """
+    name = instance.image.name
+    transaction.on_commit(lambda: ProductImages.schedule(name))
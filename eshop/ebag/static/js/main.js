@@ -167,6 +167,40 @@ jQuery(document).ready(function($) {
         });
     });
     
+    if (typeof cart_widget_url !== "undefined") {
+        /*
+        * The page is served from the full-page cache, so
+        * the CSRF token and the cart are loaded separately.
+        */
+        $.getJSON(cart_widget_url, function(data) {
+            csrf_token = data.csrf_token;
+            items_in_cart = data.items_in_cart;
+            $.each(data.cart, function(product_id, quantity) {
+                $("#quantity_"+product_id).val(quantity);
+            });
+            update_cart_count();
+        });
+    }
+    /*
+    * Suggests the matching products names while typing a search.
+    */
+    let autocomplete_timer = null;
+    $("#search_query").on("input", function() {
+        let input = $(this);
+        clearTimeout(autocomplete_timer);
+        if (input.val().trim().length < 2) {
+            return;
+        }
+        autocomplete_timer = setTimeout(function() {
+            $.getJSON(input.data("autocomplete-url"), {q: input.val()}, function(data) {
+                let suggestions = $("#search_suggestions").empty();
+                $.each(data.products, function(index, product) {
+                    suggestions.append($("<option>").attr("value", product.name));
+                });
+            });
+        }, 200);
+    });
+
     update_cart_count();
     if (window.location.pathname == "/cart/") {
         update_cart_prices_html();
@@ -0,0 +1,293 @@
+from bisect import bisect_right
+from django.conf import settings
+from django.db.models import (
+    Case, Count, DecimalField, F, IntegerField, Max, Min, Value, When
+)
+from django.db.models.functions import Cast, Coalesce, Greatest, Least
+from .models import Category, CategoryPriceBucket, Product
+
+
+class CategoryStats:
+    """
+    Maintains the denormalized Category.product_count, min_price and
+    max_price and the CategoryPriceBucket histograms, rolled up over
+    the category subtree, so that they are read with the category
+    instead of aggregated over the lft/rght range. Contains only
+    static methods so serves just as a namespace for this group
+    of methods.
+    """
+
+    @staticmethod
+    def price_bucket(price):
+        """
+        Returns the number of the price range of the price.
+
+        :param price: The product price
+        :type price: Decimal
+        """
+        return bisect_right(settings.PRICE_FACET_BOUNDS, price)
+
+    @staticmethod
+    def price_range(bucket):
+        """
+        Returns the (lowest price, highest price excluded) of the
+        price range, None standing for an unbounded side.
+
+        :param bucket: The price range number
+        :type bucket: int
+        """
+        bounds = (None,) + tuple(settings.PRICE_FACET_BOUNDS) + (None,)
+        return bounds[bucket], bounds[bucket + 1]
+
+    @staticmethod
+    def buckets_count():
+        return len(settings.PRICE_FACET_BOUNDS) + 1
+
+    @staticmethod
+    def ancestors(category_id):
+        """
+        Returns the queryset of the category and its ancestors
+        or None if the category does not exist.
+
+        :param category_id: The category id
+        :type category_id: int
+        """
+        node = Category.objects.filter(pk=category_id).values(
+            "tree_id", "lft", "rght"
+        ).first()
+        if node is None:
+            return None
+        return Category.objects.filter(
+            tree_id=node["tree_id"],
+            lft__lte=node["lft"],
+            rght__gte=node["rght"]
+        )
+
+    @staticmethod
+    def add_product(category_id, price):
+        """
+        Adds a product to the stats of its category and the
+        ancestors, with an UPDATE of the categories and one
+        of their price ranges.
+
+        :param category_id: The product category id
+        :type category_id: int
+        :param price: The product price
+        :type price: Decimal
+        """
+        ancestors = CategoryStats.ancestors(category_id)
+        if ancestors is None:
+            return
+        CategoryStats.update_bucket(ancestors, price, 1)
+        # Cast, as SQLite would compare the parameter as text
+        price = Cast(
+            Value(price), DecimalField(max_digits=10, decimal_places=2)
+        )
+        ancestors.update(
+            product_count=F("product_count") + 1,
+            min_price=Least(Coalesce(F("min_price"), price), price),
+            max_price=Greatest(Coalesce(F("max_price"), price), price)
+        )
+
+    @staticmethod
+    def remove_product(category_id, price):
+        """
+        Removes a product from the stats of its category and the
+        ancestors. The price range is recomputed only for the
+        categories where the product had the lowest or highest price.
+
+        :param category_id: The product category id
+        :type category_id: int
+        :param price: The product price
+        :type price: Decimal
+        """
+        ancestors = CategoryStats.ancestors(category_id)
+        if ancestors is None:
+            return
+        CategoryStats.update_bucket(ancestors, price, -1)
+        ancestors.update(product_count=F("product_count") - 1)
+        for node in ancestors.filter(min_price=price) | \
+                ancestors.filter(max_price=price):
+            CategoryStats.update_price_range(node)
+
+    @staticmethod
+    def update_bucket(ancestors, price, change):
+        """
+        Adds `change` to the product count of the price's
+        range in the histograms of the ancestors.
+        """
+        CategoryPriceBucket.objects.filter(
+            category__in=ancestors,
+            bucket=CategoryStats.price_bucket(price)
+        ).update(product_count=F("product_count") + change)
+
+    @staticmethod
+    def update_price_range(node):
+        """
+        Recomputes the price range of a category from its subtree.
+
+        :param node: The category
+        :type node: Category
+        """
+        prices = Product.objects.filter(
+            category__tree_id=node.tree_id,
+            category__lft__gte=node.lft,
+            category__lft__lte=node.rght
+        ).aggregate(min_price=Min("price"), max_price=Max("price"))
+        Category.objects.filter(pk=node.pk).update(**prices)
+
+    @staticmethod
+    def create_buckets(category_id):
+        """
+        Creates the empty histogram of a new category.
+        """
+        CategoryPriceBucket.objects.bulk_create([
+            CategoryPriceBucket(category_id=category_id, bucket=bucket)
+            for bucket in range(CategoryStats.buckets_count())
+        ])
+
+    @staticmethod
+    def bucket_expression():
+        """
+        Returns the SQL expression of the price range number of a product.
+        """
+        bounds = settings.PRICE_FACET_BOUNDS
+        return Case(
+            *[
+                When(price__lt=bound, then=Value(number))
+                for number, bound in enumerate(bounds)
+            ],
+            default=Value(len(bounds)),
+            output_field=IntegerField()
+        )
+
+    @staticmethod
+    def compute():
+        """
+        Returns {category id: [product_count, min_price, max_price,
+        histogram]} computed with two queries: one for the stats of
+        every category's own products by price range and one for the
+        tree, which is then walked in tree order to roll the stats up.
+        """
+        bucket = CategoryStats.bucket_expression()
+        own = {}
+        for row in Product.objects.annotate(bucket=bucket).values(
+                "category_id", "bucket").annotate(
+                product_count=Count("id"),
+                min_price=Min("price"),
+                max_price=Max("price")).order_by():
+            own.setdefault(row["category_id"], []).append(row)
+        stats = {}
+        path = []
+        for node in Category.objects.order_by("tree_id", "lft").values(
+                "id", "tree_id", "lft", "rght"):
+            while path and not (
+                    path[-1]["tree_id"] == node["tree_id"] and
+                    path[-1]["rght"] > node["lft"]):
+                path.pop()
+            path.append(node)
+            stats[node["id"]] = [
+                0, None, None, [0] * CategoryStats.buckets_count()
+            ]
+            for row in own.get(node["id"], ()):
+                for ancestor in path:
+                    CategoryStats.merge(stats[ancestor["id"]], row)
+        return stats
+
+    @staticmethod
+    def compute_subtree(node):
+        """
+        Returns the [product_count, min_price, max_price, histogram]
+        of a category, aggregated over its subtree with a query.
+
+        :param node: The category id, tree_id, lft and rght
+        :type node: dict
+        """
+        values = [0, None, None, [0] * CategoryStats.buckets_count()]
+        for row in Product.objects.filter(
+                category__tree_id=node["tree_id"],
+                category__lft__gte=node["lft"],
+                category__lft__lte=node["rght"]).annotate(
+                bucket=CategoryStats.bucket_expression()).values(
+                "bucket").annotate(
+                product_count=Count("id"),
+                min_price=Min("price"),
+                max_price=Max("price")).order_by():
+            CategoryStats.merge(values, row)
+        return values
+
+    @staticmethod
+    def merge(values, row):
+        values[0] += row["product_count"]
+        if values[1] is None or row["min_price"] < values[1]:
+            values[1] = row["min_price"]
+        if values[2] is None or row["max_price"] > values[2]:
+            values[2] = row["max_price"]
+        values[3][row["bucket"]] += row["product_count"]
+
+    @staticmethod
+    def rebuild(category_ids=None):
+        """
+        Recomputes the stats and the histograms of all the categories
+        and updates the ones which differ. Returns the number of the
+        updated categories.
+
+        :param category_ids: Recomputes only these categories, e.g. the
+                             old and the new ancestors of a moved one,
+                             with a query per category
+        :type category_ids: set / NoneType by default
+        """
+        updated = set()
+        categories = Category.objects.all()
+        buckets = CategoryPriceBucket.objects.all()
+        if category_ids is not None:
+            categories = categories.filter(pk__in=category_ids)
+            buckets = buckets.filter(category_id__in=category_ids)
+        current = {
+            row[0]: tuple(row[1:]) for row in
+            categories.values_list(
+                "id", "product_count", "min_price", "max_price"
+            )
+        }
+        # {(category id, bucket): (row id, product count)}
+        buckets = {
+            row[:2]: row[2:] for row in
+            buckets.values_list(
+                "category_id", "bucket", "id", "product_count"
+            )
+        }
+        if category_ids is None:
+            computed = CategoryStats.compute()
+        else:
+            computed = {
+                node["id"]: CategoryStats.compute_subtree(node)
+                for node in categories.values("id", "tree_id", "lft", "rght")
+            }
+        missing = []
+        for pk, values in computed.items():
+            if current.get(pk) != tuple(values[:3]):
+                Category.objects.filter(pk=pk).update(
+                    product_count=values[0],
+                    min_price=values[1],
+                    max_price=values[2]
+                )
+                updated.add(pk)
+            for bucket, count in enumerate(values[3]):
+                row = buckets.pop((pk, bucket), None)
+                if row is None:
+                    missing.append(CategoryPriceBucket(
+                        category_id=pk, bucket=bucket, product_count=count
+                    ))
+                    updated.add(pk)
+                elif row[1] != count:
+                    CategoryPriceBucket.objects.filter(pk=row[0]).update(
+                        product_count=count
+                    )
+                    updated.add(pk)
+        CategoryPriceBucket.objects.bulk_create(missing)
+        # The rows of the ranges beyond the current bounds
+        if buckets:
+            CategoryPriceBucket.objects.filter(
+                pk__in=[row[0] for row in buckets.values()]
+            ).delete()
+        return len(updated)
@@ -0,0 +1,282 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Value, When
+from django.utils import timezone
+from .models import Product, StockReservation
+import uuid
+
+
+class OutOfStock(Exception):
+    """
+    Raised when there is not enough stock of some of the products,
+    so that the transaction changing the stock is rolled back.
+    """
+
+    def __init__(self, product_ids):
+        """
+        :param product_ids: The ids of the products out of stock
+        :type product_ids: list
+        """
+        super(__class__, self).__init__(
+            "Not enough stock of the products %s." % ", ".join(
+                str(product_id) for product_id in product_ids
+            )
+        )
+        self.product_ids = product_ids
+
+
+class Stock:
+    """
+    Changes Product.stock only with conditional UPDATEs
+    (stock = stock - quantity WHERE stock >= quantity), so the stock
+    read by a request is never written back and cannot be oversold.
+    Contains only static methods so serves just as a namespace for
+    this group of methods.
+    """
+
+    @staticmethod
+    def lock(product_ids):
+        """
+        Locks the product rows, always in the order of their ids, so
+        that two transactions changing the stock of the same products
+        cannot deadlock, and returns {product id: stock}. Must be
+        called in a transaction, before any other row is locked.
+
+        :param product_ids: The product ids
+        :type product_ids: iterable of int
+        """
+        return dict(
+            Product.objects.select_for_update().filter(
+                pk__in=product_ids
+            ).order_by("pk").values_list("pk", "stock")
+        )
+
+    @staticmethod
+    def take(changes, stocks):
+        """
+        Takes the quantities from the stock with a single UPDATE,
+        or raises OutOfStock if any of the products does not have
+        enough stock. The stock of the products which are not tracked
+        stays empty.
+
+        :param changes: {product id: quantity}, negative to give back
+        :type changes: dict
+        :param stocks: The stocks of the products locked with lock()
+        :type stocks: dict
+        """
+        changes = {
+            product_id: change for product_id, change in changes.items()
+            if change
+        }
+        if not changes:
+            return
+        change = Case(
+            *[
+                When(pk=product_id, then=Value(change))
+                for product_id, change in changes.items()
+            ],
+            output_field=PositiveIntegerField()
+        )
+        updated = Product.objects.filter(
+            Q(stock__isnull=True) | Q(stock__gte=change),
+            pk__in=changes
+        ).update(stock=F("stock") - change)
+        if updated != len(changes):
+            raise OutOfStock(sorted(
+                product_id for product_id, change in changes.items()
+                if product_id not in stocks or (
+                    stocks[product_id] is not None and
+                    stocks[product_id] < change
+                )
+            ))
+
+
+class StockReservations:
+    """
+    Holds the stock of the products added to a cart, so that it is
+    not sold to others meanwhile. The reserved quantities are taken
+    from Product.stock and given back when the reservations expire,
+    settings.STOCK_RESERVATION_TIMEOUT seconds after the last cart
+    change, by sweep() (see the sweep_reservations command), or taken
+    over by the order. The reservations holder is a random id in a
+    signed cookie, whatever the cart storage. Contains only static
+    methods so serves just as a namespace for this group of methods.
+    """
+
+    SALT = "ebag.stock"
+
+    @staticmethod
+    def holder(request):
+        """
+        Returns the reservations holder id of the
+        request, or None if it has no reservations.
+        """
+        return request.get_signed_cookie(
+            settings.STOCK_RESERVATION_COOKIE,
+            default=None,
+            salt=StockReservations.SALT,
+            max_age=settings.CART_COOKIE_AGE
+        )
+
+    @staticmethod
+    def new_holder():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def set_holder(response, holder):
+        response.set_signed_cookie(
+            settings.STOCK_RESERVATION_COOKIE,
+            holder,
+            salt=StockReservations.SALT,
+            max_age=settings.CART_COOKIE_AGE,
+            httponly=True
+        )
+
+    @staticmethod
+    def reserve(holder, quantities):
+        """
+        Sets the reserved quantities of the products, taking the
+        differences from the stock or giving them back, and extends the
+        expiry of all the holder reservations. Raises OutOfStock, with
+        the reservations unchanged, if the stock is not enough. The
+        products which are not tracked are not reserved.
+
+        :param holder: The reservations holder id
+        :type holder: str
+        :param quantities: {product id: quantity}, 0 to release
+        :type quantities: dict
+        """
+        with transaction.atomic():
+            stocks = Stock.lock(quantities)
+            reservations = StockReservation.objects.filter(holder=holder)
+            reserved = dict(
+                reservations.select_for_update().filter(
+                    product_id__in=quantities
+                ).values_list("product_id", "quantity")
+            )
+            quantities = {
+                product_id: quantity
+                for product_id, quantity in quantities.items()
+                if stocks.get(product_id) is not None or
+                product_id in reserved
+            }
+            Stock.take(
+                {
+                    product_id: quantity - reserved.get(product_id, 0)
+                    for product_id, quantity in quantities.items()
+                },
+                stocks
+            )
+            released = [
+                product_id for product_id, quantity in quantities.items()
+                if not quantity and product_id in reserved
+            ]
+            if released:
+                reservations.filter(product_id__in=released).delete()
+            changed = {
+                product_id: quantity
+                for product_id, quantity in quantities.items()
+                if quantity and product_id in reserved
+            }
+            expires = timezone.now() + timedelta(
+                seconds=settings.STOCK_RESERVATION_TIMEOUT
+            )
+            reservations.update(
+                expires=expires,
+                quantity=Case(
+                    *[
+                        When(product_id=product_id, then=Value(quantity))
+                        for product_id, quantity in changed.items()
+                    ],
+                    default=F("quantity"),
+                    output_field=PositiveIntegerField()
+                )
+            )
+            StockReservation.objects.bulk_create([
+                StockReservation(
+                    holder=holder,
+                    product_id=product_id,
+                    quantity=quantity,
+                    expires=expires
+                )
+                for product_id, quantity in quantities.items()
+                if quantity and product_id not in reserved
+            ])
+
+    @staticmethod
+    def product_ids(holder):
+        """
+        Returns the ids of the products reserved by the holder, read
+        without locking, so that they are locked in the order of their
+        ids with the ordered products before consume().
+
+        :param holder: The reservations holder id
+        :type holder: str
+        """
+        return set(StockReservation.objects.filter(
+            holder=holder
+        ).values_list("product_id", flat=True))
+
+    @staticmethod
+    def consume(holder):
+        """
+        Deletes the holder reservations and returns {product id:
+        quantity} of the reserved stock, to be taken over by the
+        order. Called in the order transaction, with the product
+        rows already locked.
+
+        :param holder: The reservations holder id
+        :type holder: str
+        """
+        reservations = StockReservation.objects.filter(holder=holder)
+        reserved = dict(
+            reservations.select_for_update().values_list(
+                "product_id", "quantity"
+            )
+        )
+        if reserved:
+            reservations.delete()
+        return reserved
+
+    @staticmethod
+    def sweep(batch_size=500):
+        """
+        Gives the stock of the expired reservations back, in
+        transactions of up to batch_size reservations, and returns
+        the number of the released reservations.
+
+        :param batch_size: The reservations released per transaction
+        :type batch_size: int
+        """
+        released = 0
+        while True:
+            now = timezone.now()
+            expired = list(
+                StockReservation.objects.filter(expires__lt=now).values_list(
+                    "pk", "product_id"
+                )[:batch_size]
+            )
+            if not expired:
+                return released
+            with transaction.atomic():
+                stocks = Stock.lock(
+                    set(product_id for pk, product_id in expired)
+                )
+                # The reservations extended meanwhile are kept
+                reservations = list(
+                    StockReservation.objects.select_for_update().filter(
+                        pk__in=[pk for pk, product_id in expired],
+                        expires__lt=now
+                    ).values_list("pk", "product_id", "quantity")
+                )
+                changes = {}
+                for pk, product_id, quantity in reservations:
+                    changes[product_id] = changes.get(product_id, 0) - quantity
+                Stock.take(changes, stocks)
+                StockReservation.objects.filter(
+                    pk__in=[pk for pk, product_id, quantity in reservations]
+                ).delete()
+            released += len(reservations)
+            if len(expired) < batch_size:
+                return released
@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from .caching import ProductCache
+from .jobs import Jobs
+from .models import Order
+from .search import SearchIndex
+from . import metrics
+
+
+@Jobs.task
+def send_order_confirmation(order_id):
+    """
+    E-mails the order lines and total to the customer.
+    """
+    order = Order.objects.get(pk=order_id)
+    lines = [
+        "%s x %d - BGN %s" % (line.product_name, line.quantity, line.price)
+        for line in order.lines.order_by("id")
+    ]
+    send_mail(
+        settings.ORDER_EMAIL_SUBJECT % order.number,
+        "\n".join(
+            ["Dear %s %s," % (order.first_name, order.last_name), ""] +
+            lines +
+            ["", "Total: BGN %s" % order.total]
+        ),
+        settings.DEFAULT_FROM_EMAIL,
+        [order.email]
+    )
+
+
+@Jobs.task
+def record_order_metrics(order_id):
+    """
+    Counts the order in the orders analytics metrics, once: the order
+    is flagged first, with a conditional update, so that a job run
+    again after its lease expired doesn't count it twice.
+    """
+    if not Order.objects.filter(
+            pk=order_id, metrics_recorded=False).update(
+                metrics_recorded=True):
+        return
+    order = Order.objects.get(pk=order_id)
+    metrics.ORDERS.inc()
+    metrics.ORDER_LINES.inc(order.lines.count())
+    metrics.ORDER_REVENUE.inc(float(order.total))
+
+
+@Jobs.task
+def refresh_ordered_products(order_id):
+    """
+    Removes the ordered products from the cache, as their stock
+    was changed by the order without sending signals.
+    """
+    for product_id in Order.objects.get(pk=order_id).lines.exclude(
+            product=None).values_list("product_id", flat=True):
+        ProductCache.invalidate(product_id)
+
+
+@Jobs.task
+def rebuild_search_index():
+    """
+    Folds the search changes log into a new index segment,
+    queued when the log grows (see SearchIndex.log).
+    """
+    SearchIndex.build()
@@ -0,0 +1,62 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+from ..images import ProductImages
+
+register = template.Library()
+
+
+def srcset(name, manifest, extension):
+    return format_html_join(
+        ", ", "{}{} {}w", (
+            (
+                settings.MEDIA_URL,
+                ProductImages.derivative_name(name, width, extension),
+                width
+            )
+            for width in manifest["widths"]
+        )
+    )
+
+
+@register.simple_tag
+def product_image(image, alt, sizes=None, css_class="img-fluid"):
+    """
+    Renders the product image as a <picture> with the WebP and the
+    original format srcset of its derivatives, or as the original
+    <img> if they are not generated yet.
+
+    :param image: The product image or its name
+    :type image: ImageFieldFile or str
+    :param alt: The image alternative text
+    :type alt: str
+    :param sizes: The image sizes attribute, by default
+    settings.PRODUCT_IMAGE_SIZES
+    :type sizes: str
+    :param css_class: The image class attribute
+    :type css_class: str
+    """
+    name = str(image)
+    src = settings.MEDIA_URL + name
+    manifest = ProductImages.manifest(name) if name else None
+    if manifest is None:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}">', src, alt, css_class
+        )
+    sizes = sizes or settings.PRODUCT_IMAGE_SIZES
+    sources = format_html_join(
+        "", '<source type="image/{}" srcset="{}" sizes="{}">', (
+            (extension, srcset(name, manifest, extension), sizes)
+            for extension in manifest["formats"][1:]
+        )
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" '
+        'class="{}"></picture>',
+        sources,
+        src,
+        srcset(name, manifest, manifest["formats"][0]),
+        sizes,
+        alt,
+        css_class
+    )
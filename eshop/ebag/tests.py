@@ -1,27 +1,83 @@
 import os
 import json
 import unittest
-from datetime import datetime
-from django.test import TestCase, Client
+import tempfile
+from unittest import mock
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.test import TestCase as DjangoTestCase, TransactionTestCase
+from django.test import Client
+from django.core.cache import caches
 from django.test.client import RequestFactory
 from django.test.utils import setup_test_environment, teardown_test_environment
 from django.urls import reverse
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.conf import settings
 from django.template.defaultfilters import slugify
 from django.contrib import admin
-from .templatetags import add_pk_to_slug
-from .models import Category, Product
+from django.core import mail
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from .models import (
+    Category, CategoryPriceBucket, Job, NumberSequence, Order, Product,
+    StockReservation
+)
 from .forms import CategoryForm, CheckoutForm
 from .admin import CategoryDraggableMPTTAdmin, ProductModelAdmin
-from . import views
+from .caching import CategoryTreeCache, ProductCache
+from .pagination import KeysetPaginator
+from .stats import CategoryStats
+from .benchmarks.catalogue import generate_catalogue
+from .benchmarks.runner import StorefrontBenchmark, percentile
+from .benchmarks.stress import CheckoutStress
+from .metrics import MetricsFile, MetricsStore
+from .search import IndexSegment, SearchIndex, tokenize
+from .images import LRUCache, ProductImages
+from .exporting import ProductFeed
+from .importing import ProductImport
+from .jobs import Jobs, JobWorker
+from .orders import OrderNumbers, Orders
+from .stock import OutOfStock, Stock, StockReservations
+from .querydetector import (
+    QueryBudget, QueryBudgetExceeded, QueryDetector,
+    QueryDetectorMiddleware, RepeatedQueriesError, normalize_sql
+)
+from . import metrics, views
 from mptt.admin import DraggableMPTTAdmin
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.template import Context, Template
+from io import StringIO
+from xml.etree import ElementTree
+import csv
+import gzip
+from PIL import Image, features
 
 
 # Create your tests here.
 
 
+class TestCase(DjangoTestCase):
+    """
+    Clears the caches before each test: the DB changes of the previous
+    tests are rolled back without sending signals, so the caches would
+    still contain their data. The categories tree memo is cleared too,
+    as the tree version of a cleared cache is only time based.
+    """
+    def _pre_setup(self):
+        super(__class__, self)._pre_setup()
+        for cache in caches.all():
+            cache.clear()
+        CategoryTreeCache.memo = (None, None, None)
+        ProductImages.manifests.clear()
+        ProductImages.misses.clear()
+        OrderNumbers.block = None
+
+
 class TestingHelper(object):
     """
     Contains helper methods, used on many places
@@ -58,32 +114,6 @@ class TestingHelper(object):
         self.product.image.delete()
 
 
-##############################
-#     Template tags tests
-#############################
-
-
-class TemplateTagsTestCase(TestCase):
-    """
-    Tests for the custom template tags
-    """
-
-    def setUp(self):
-        Category.objects.create()
-        self.category_nodes = Category.objects.all()[:1]
-
-    def test_add_pk_to_slug(self):
-        """
-        Tests add_pk_to_slug() in templatetags/add_pk_to_slug.py
-        """
-        func_res = add_pk_to_slug.add_pk_to_slug(self.category_nodes[0])
-        expected_res = self.category_nodes[0].slug.replace(
-            settings.PK_PLACEHOLDER,
-            str(self.category_nodes[0].pk)
-        )
-        self.assertEqual(expected_res, func_res)
-
-
 ##############################
 #        Admin tests
 #############################
@@ -203,23 +233,13 @@ class CategoryFormTestCase(TestCase):
         self.assertEqual(cat.name, cat_name)
         self.assertEqual(cat.parent, None)
         self.assertIsInstance(cat.last_update, datetime)
-        self.assertEqual(cat.slug, "/".join([
+        self.assertEqual(cat.slug, slugify(cat.name))
+        self.assertEqual(cat.url, "/".join([
             slugify(CategoryForm._meta.model.__name__.lower()),
-            settings.PK_PLACEHOLDER,
+            str(cat.pk),
             slugify(cat.name)
         ]))
 
-    def test_pk_placeholder_error(self):
-        """
-        Tests if the forms prevents the PK_PLACEHOLDER
-        to be included in the category name.
-        """
-        form = CategoryForm({
-            'name':  settings.PK_PLACEHOLDER,
-            'parent': None,
-        })
-        self.assertFalse(form.is_valid())
-
     def test_blank_data(self):
         required_err = 'This field is required.'
         form = CategoryForm({})
@@ -229,64 +249,1872 @@ class CategoryFormTestCase(TestCase):
         })
 
 
-##############################
-#        Models tests
-#############################
+##############################
+#        Models tests
+#############################
+
+
+class ProductTestCase(TestCase, TestingHelper):
+    def test_string_representation(self):
+        product = Product(name="Milk")
+        self.assertEqual(str(product), product.name)
+
+    def test_model_save_fields(self):
+        """
+        Tests the model fields after model saving
+        and tests if the image is uploaded.
+        """
+        self.create_cat_and_product()
+        product = self.product
+        product.save()
+        uploaded_img = settings.MEDIA_ROOT + os.sep + str(product.image)
+
+        self.assertEqual(product.name, "Honey")
+        self.assertIsInstance(product.name, str)
+        self.assertIsInstance(product.category, Category)
+        self.assertEqual(product.description, "Honey is good")
+        self.assertIsInstance(product.description, str)
+        self.assertEqual(product.price, self.product_data["price"])
+        self.assertIsInstance(
+            product.image,
+            models.fields.files.ImageFieldFile
+        )
+        self.assertTrue(os.path.isfile(uploaded_img))
+        product.image.delete()
+
+
+class CategoryTestCase(TestCase):
+    def test_string_representation(self):
+        cat = Category(name="Milk")
+        self.assertEqual(str(cat), cat.name)
+
+    def test_parent_category_options(self):
+        """
+        Tests if category can be created both
+        with parent category and non parent category.
+        """
+        parents = {
+            None: None,
+            Category: Category.objects.create(),
+        }
+        for instance, parent in parents.items():
+            cat = Category(**{
+                "name": "Dairy",
+                "parent": parent,
+            })
+            cat.save()
+            if instance is not None:
+                self.assertIsInstance(cat.parent, instance)
+            else:
+                self.assertIs(cat.parent, None)
+
+    def test_url(self):
+        """
+        Tests if the category URL is stored on creation
+        and updated on rename.
+        """
+        cat = Category.objects.create(name="Dairy products")
+        expected_url = "category/%d/dairy-products" % cat.pk
+        self.assertEqual(cat.url, expected_url)
+        self.assertEqual(Category.objects.get(pk=cat.pk).url, expected_url)
+        cat.name = "Milk"
+        cat.save()
+        self.assertEqual(
+            Category.objects.get(pk=cat.pk).url,
+            "category/%d/milk" % cat.pk
+        )
+
+    def test_get_by_url(self):
+        """
+        Tests if a category can be found by its URL path
+        with a single query.
+        """
+        cat = Category.objects.create(name="Dairy")
+        with self.assertNumQueries(1):
+            self.assertEqual(Category.objects.get(url=cat.url), cat)
+
+    def test_is_leaf(self):
+        """
+        Tests if the is_leaf flag follows the tree changes.
+        """
+        parent = Category.objects.create(name="Dairy")
+        self.assertTrue(Category.objects.get(pk=parent.pk).is_leaf)
+        child = Category.objects.create(name="Milk", parent=parent)
+        self.assertFalse(Category.objects.get(pk=parent.pk).is_leaf)
+        self.assertTrue(Category.objects.get(pk=child.pk).is_leaf)
+        child.delete()
+        self.assertTrue(Category.objects.get(pk=parent.pk).is_leaf)
+
+    def test_is_leaf_move(self):
+        """
+        Tests that the flags of the old and the new parent follow the
+        moves and that only they are checked.
+        """
+        first = Category.objects.create(name="Dairy")
+        second = Category.objects.create(name="Bakery")
+        other = Category.objects.create(name="Drinks")
+        child = Category.objects.create(name="Milk", parent=first)
+        Category.objects.filter(pk=other.pk).update(is_leaf=False)
+        child = Category.objects.get(pk=child.pk)
+        child.parent = second
+        child.save()
+        self.assertTrue(Category.objects.get(pk=first.pk).is_leaf)
+        self.assertFalse(Category.objects.get(pk=second.pk).is_leaf)
+        child = Category.objects.get(pk=child.pk)
+        Category.objects.move_node(
+            child, Category.objects.get(pk=first.pk)
+        )
+        self.assertFalse(Category.objects.get(pk=first.pk).is_leaf)
+        self.assertTrue(Category.objects.get(pk=second.pk).is_leaf)
+        self.assertFalse(Category.objects.get(pk=other.pk).is_leaf)
+
+
+class CategoryStatsTestCase(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(name="Food")
+        self.dairy = Category.objects.create(name="Dairy", parent=self.root)
+        self.fruits = Category.objects.create(name="Fruits", parent=self.root)
+
+    def add_product(self, category, price):
+        return Product.objects.create(
+            name="Product",
+            category=category,
+            description="Product",
+            price=Decimal(price),
+            image="product.png"
+        )
+
+    def assertStats(self, category, product_count, min_price, max_price):
+        category = Category.objects.get(pk=category.pk)
+        self.assertEqual(
+            (category.product_count, category.min_price, category.max_price),
+            (
+                product_count,
+                None if min_price is None else Decimal(min_price),
+                None if max_price is None else Decimal(max_price)
+            )
+        )
+
+    def test_add_and_remove(self):
+        milk = self.add_product(self.dairy, "2.50")
+        self.add_product(self.dairy, "1.20")
+        apple = self.add_product(self.fruits, "3.00")
+        self.assertStats(self.dairy, 2, "1.20", "2.50")
+        self.assertStats(self.fruits, 1, "3.00", "3.00")
+        self.assertStats(self.root, 3, "1.20", "3.00")
+        apple.delete()
+        self.assertStats(self.fruits, 0, None, None)
+        self.assertStats(self.root, 2, "1.20", "2.50")
+        milk.delete()
+        self.assertStats(self.root, 1, "1.20", "1.20")
+
+    def test_product_change(self):
+        milk = self.add_product(self.dairy, "2.50")
+        self.add_product(self.dairy, "1.20")
+        milk.price = Decimal("0.80")
+        milk.save()
+        self.assertStats(self.dairy, 2, "0.80", "1.20")
+        milk.category = self.fruits
+        milk.save()
+        self.assertStats(self.dairy, 1, "1.20", "1.20")
+        self.assertStats(self.fruits, 1, "0.80", "0.80")
+        self.assertStats(self.root, 2, "0.80", "1.20")
+
+    def test_category_move(self):
+        self.add_product(self.fruits, "3.00")
+        self.fruits.move_to(self.dairy)
+        self.assertStats(self.dairy, 1, "3.00", "3.00")
+        other = Category.objects.create(name="Other")
+        Category.objects.get(pk=self.fruits.pk).move_to(other)
+        self.assertStats(self.dairy, 0, None, None)
+        self.assertStats(self.root, 0, None, None)
+        self.assertStats(other, 1, "3.00", "3.00")
+
+    def test_rebuilt_on_move_only(self):
+        """
+        Tests if the stats of the old and the new ancestors are
+        rebuilt once per move and not on the other category changes.
+        """
+        chains = {self.root.pk, self.fruits.pk}
+        with mock.patch.object(CategoryStats, "rebuild") as rebuild:
+            self.dairy.name = "Milk"
+            self.dairy.save()
+            self.assertEqual(rebuild.call_count, 0)
+            self.dairy.parent = self.fruits
+            self.dairy.save()
+            self.assertEqual(rebuild.call_count, 1)
+            rebuild.assert_called_with(chains)
+            Category.objects.move_node(
+                Category.objects.get(pk=self.dairy.pk),
+                Category.objects.get(pk=self.root.pk)
+            )
+            self.assertEqual(rebuild.call_count, 2)
+            rebuild.assert_called_with(chains)
+
+    def test_rebuild(self):
+        self.add_product(self.dairy, "2.50")
+        self.add_product(self.fruits, "3.00")
+        Category.objects.update(product_count=0, min_price=None)
+        self.assertEqual(CategoryStats.rebuild(), 3)
+        self.assertStats(self.root, 2, "2.50", "3.00")
+        self.assertStats(self.dairy, 1, "2.50", "2.50")
+        self.assertEqual(CategoryStats.rebuild(), 0)
+
+    def histogram(self, category):
+        return list(CategoryPriceBucket.objects.filter(
+            category=category
+        ).order_by("bucket").values_list("product_count", flat=True))
+
+    def test_price_histogram(self):
+        """
+        Tests if the price ranges histograms follow the product
+        changes and if the rebuild fixes them.
+        """
+        apple = self.add_product(self.fruits, "3.00")
+        self.add_product(self.dairy, "5.00")
+        self.add_product(self.dairy, "12.00")
+        self.assertEqual(self.histogram(self.root), [1, 1, 1, 0, 0, 0])
+        self.assertEqual(self.histogram(self.dairy), [0, 1, 1, 0, 0, 0])
+        apple.price = Decimal("7.00")
+        apple.save()
+        self.assertEqual(self.histogram(self.root), [0, 2, 1, 0, 0, 0])
+        self.assertEqual(self.histogram(self.fruits), [0, 1, 0, 0, 0, 0])
+        apple.delete()
+        self.assertEqual(self.histogram(self.root), [0, 1, 1, 0, 0, 0])
+        CategoryPriceBucket.objects.filter(category=self.root).delete()
+        CategoryPriceBucket.objects.filter(bucket=0).update(product_count=5)
+        self.assertEqual(CategoryStats.rebuild(), 3)
+        self.assertEqual(self.histogram(self.root), [0, 1, 1, 0, 0, 0])
+        self.assertEqual(self.histogram(self.fruits), [0, 0, 0, 0, 0, 0])
+        with override_settings(PRICE_FACET_BOUNDS=(10,)):
+            CategoryStats.rebuild()
+        self.assertEqual(self.histogram(self.root), [1, 1])
+
+    def test_read_from_tree_cache(self):
+        self.add_product(self.dairy, "2.50")
+        CategoryTreeCache.get_rows()
+        with self.assertNumQueries(0):
+            node = CategoryTreeCache.get_node(self.root.pk)
+        self.assertEqual(node.product_count, 1)
+        self.assertEqual(sum(node.price_histogram), 1)
+
+
+class OrderTestingHelper(object):
+    CUSTOMER = {
+        "country": "1",
+        "first_name": "John",
+        "last_name": "Doe",
+        "address_1": "1 Main Street",
+        "state_region": "Sofia",
+        "post_code": "1000",
+        "email": "john@example.com",
+        "phone": "359888123456",
+    }
+
+    def create_products(self, count):
+        """
+        Creates the products priced 1, 2, ... with a single
+        query and returns their ids.
+        """
+        category = Category.objects.create(name="Food")
+        Product.objects.bulk_create([
+            Product(
+                name="Product %d" % i,
+                category=category,
+                description="Product",
+                price=i + 1,
+                image="product.png"
+            ) for i in range(count)
+        ])
+        CategoryStats.rebuild()
+        return list(Product.objects.order_by("id").values_list(
+            "id", flat=True
+        ))
+
+
+class OrdersTestCase(TestCase, OrderTestingHelper):
+    def test_order_numbers(self):
+        with override_settings(ORDER_NUMBER_BLOCK_SIZE=3):
+            # The UPDATE and the SELECT in a savepoint
+            with self.assertNumQueries(4):
+                self.assertEqual(OrderNumbers.next(), 1)
+            with self.assertNumQueries(0):
+                self.assertEqual(OrderNumbers.next(), 2)
+                self.assertEqual(OrderNumbers.next(), 3)
+            # Another process reserves the next block
+            self.assertEqual(OrderNumbers.allocate(3), 6)
+            self.assertEqual(OrderNumbers.next(), 7)
+        self.assertEqual(
+            NumberSequence.objects.get(name=OrderNumbers.SEQUENCE).last_number,
+            9
+        )
+
+    def test_order_numbers_missing_sequence(self):
+        NumberSequence.objects.all().delete()
+        self.assertEqual(OrderNumbers.next(), 1)
+        self.assertEqual(OrderNumbers.next(), 2)
+
+    def test_place(self):
+        first, second = self.create_products(2)
+        order = Orders.place({str(first): "2", str(second): "3"}, dict(
+            self.CUSTOMER, post_code=1000
+        ))
+        order.refresh_from_db()
+        self.assertEqual(order.total, Decimal("8"))
+        self.assertEqual(order.post_code, "1000")
+        self.assertEqual(order.get_country_display(), "Bulgaria")
+        self.assertEqual(
+            list(order.lines.values_list(
+                "product_id", "product_name", "price", "quantity"
+            )),
+            [
+                (first, "Product 0", Decimal("1"), 2),
+                (second, "Product 1", Decimal("2"), 3),
+            ]
+        )
+        # The lines keep the price and name of the time of the order
+        Product.objects.filter(pk=first).update(name="Honey", price=5)
+        Product.objects.filter(pk=second).delete()
+        self.assertEqual(
+            list(order.lines.values_list("product_id", "product_name")),
+            [(first, "Product 0"), (None, "Product 1")]
+        )
+
+    def test_place_missing_products(self):
+        product_id, = self.create_products(1)
+        order = Orders.place({str(product_id): "1", "0": "1"}, self.CUSTOMER)
+        self.assertEqual(order.lines.count(), 1)
+        self.assertIsNone(Orders.place({"0": "1"}, self.CUSTOMER))
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_place_queries(self):
+        """
+        Tests that the order is written with the same
+        number of queries whatever the cart size.
+        """
+        product_ids = self.create_products(100)
+        OrderNumbers.next()
+        for count in (1, 10, 100):
+            cart = {str(pk): "1" for pk in product_ids[:count]}
+            with CaptureQueriesContext(connection) as queries:
+                Orders.place(cart, self.CUSTOMER)
+            statements = [
+                query["sql"] for query in queries.captured_queries
+                if "SAVEPOINT" not in query["sql"]
+            ]
+            # The products, the order, the lines and the jobs
+            self.assertEqual(len(statements), 4, statements)
+
+
+class StockTestCase(TestCase, OrderTestingHelper):
+    def setUp(self):
+        self.hot, self.other, self.untracked = self.create_products(3)
+        Product.objects.filter(pk=self.hot).update(stock=5)
+        Product.objects.filter(pk=self.other).update(stock=1)
+
+    def stock(self, product_id):
+        return Product.objects.values_list("stock", flat=True).get(
+            pk=product_id
+        )
+
+    def reserved(self, holder):
+        return dict(StockReservation.objects.filter(
+            holder=holder
+        ).values_list("product_id", "quantity"))
+
+    def test_take(self):
+        changes = {self.hot: 3, self.other: 1, self.untracked: 7}
+        with transaction.atomic():
+            Stock.take(changes, Stock.lock(changes))
+        self.assertEqual(self.stock(self.hot), 2)
+        self.assertEqual(self.stock(self.other), 0)
+        self.assertIsNone(self.stock(self.untracked))
+        with self.assertRaises(OutOfStock) as context:
+            with transaction.atomic():
+                Stock.take(changes, Stock.lock(changes))
+        self.assertEqual(
+            context.exception.product_ids, [self.hot, self.other]
+        )
+        self.assertEqual(self.stock(self.hot), 2)
+        with transaction.atomic():
+            Stock.take({self.hot: -2}, Stock.lock([self.hot]))
+        self.assertEqual(self.stock(self.hot), 4)
+
+    def test_place(self):
+        cart = {str(self.hot): "2", str(self.untracked): "1"}
+        Orders.place(cart, self.CUSTOMER)
+        self.assertEqual(self.stock(self.hot), 3)
+        cart[str(self.other)] = "2"
+        with self.assertRaises(OutOfStock):
+            Orders.place(cart, self.CUSTOMER)
+        self.assertEqual(self.stock(self.hot), 3)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_reserve(self):
+        StockReservations.reserve("cart", {self.hot: 2, self.untracked: 1})
+        self.assertEqual(self.stock(self.hot), 3)
+        self.assertEqual(self.reserved("cart"), {self.hot: 2})
+        StockReservations.reserve("cart", {self.hot: 4, self.other: 1})
+        self.assertEqual(self.stock(self.hot), 1)
+        self.assertEqual(self.stock(self.other), 0)
+        with self.assertRaises(OutOfStock):
+            StockReservations.reserve("other", {self.hot: 1, self.other: 1})
+        self.assertEqual(self.stock(self.hot), 1)
+        self.assertEqual(self.reserved("other"), {})
+        StockReservations.reserve("cart", {self.other: 0})
+        self.assertEqual(self.stock(self.other), 1)
+        self.assertEqual(self.reserved("cart"), {self.hot: 4})
+
+    def test_place_reserved(self):
+        """
+        Tests that the order takes over the reserved stock.
+        """
+        StockReservations.reserve("cart", {self.hot: 2, self.other: 1})
+        with CaptureQueriesContext(connection) as queries:
+            Orders.place({str(self.hot): "3"}, self.CUSTOMER, "cart")
+        # The reserved product which is not ordered is locked
+        # in the order of the ids with the ordered one
+        locked = [
+            query["sql"] for query in queries.captured_queries
+            if query["sql"].startswith('SELECT "ebag_product"."id"')
+        ][0]
+        self.assertIn("IN (%d, %d)" % (self.hot, self.other), locked)
+        self.assertEqual(self.stock(self.hot), 2)
+        self.assertEqual(self.stock(self.other), 1)
+        self.assertEqual(self.reserved("cart"), {})
+
+    def test_sweep(self):
+        StockReservations.reserve("expired", {self.hot: 2, self.other: 1})
+        StockReservations.reserve("active", {self.hot: 1})
+        StockReservation.objects.filter(holder="expired").update(
+            expires=timezone.now() - timedelta(seconds=1)
+        )
+        stdout = StringIO()
+        call_command("sweep_reservations", stdout=stdout)
+        self.assertIn("2 reservations released.", stdout.getvalue())
+        self.assertEqual(self.stock(self.hot), 4)
+        self.assertEqual(self.stock(self.other), 1)
+        self.assertEqual(self.reserved("active"), {self.hot: 1})
+        self.assertEqual(StockReservations.sweep(batch_size=1), 0)
+
+
+class CheckoutStressTestCase(TransactionTestCase):
+    def setUp(self):
+        # The numbers handed out in the tests rolled back before
+        OrderNumbers.block = None
+
+    def test_no_oversell(self):
+        results = CheckoutStress(threads=4, stock=20).run()
+        self.assertTrue(results["consistent"])
+        self.assertEqual(results["orders"], 20)
+        self.assertEqual(results["remaining_stock"], 0)
+        self.assertEqual(results["out_of_stock"], 4)
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+
+##############################
+#        Jobs tests
+#############################
+
+
+@Jobs.task
+def flaky_task(fail):
+    if fail:
+        raise RuntimeError("Failed")
+
+
+@override_settings(JOB_RETRY_DELAY=10, JOB_MAX_ATTEMPTS=2)
+class JobsTestCase(TestCase, OrderTestingHelper):
+    def setUp(self):
+        MetricsStore.clear()
+
+    def test_enqueue_and_claim(self):
+        Jobs.enqueue([
+            ("flaky_task", {"fail": False}), ("flaky_task", {"fail": True})
+        ])
+        Jobs.enqueue([("flaky_task", {"fail": False})], delay=60)
+        first, second = Jobs.claim(5)
+        self.assertEqual(first.payload, '{"fail":false}')
+        self.assertEqual((first.status, first.attempts), (Job.RUNNING, 1))
+        self.assertEqual(first.claim, second.claim)
+        # The claimed jobs and the jobs not due yet are not claimed
+        self.assertEqual(Jobs.claim(5), [])
+
+    def test_run(self):
+        Jobs.enqueue([("flaky_task", {"fail": False})])
+        job, = Jobs.claim(1)
+        self.assertTrue(Jobs.run(job))
+        self.assertFalse(Job.objects.exists())
+
+    def test_retry(self):
+        Jobs.enqueue([("flaky_task", {"fail": True})])
+        job, = Jobs.claim(1)
+        with self.assertLogs("ebag.jobs", "WARNING"):
+            self.assertFalse(Jobs.run(job))
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertIn("RuntimeError: Failed", job.last_error)
+        delay = (job.run_at - timezone.now()).total_seconds()
+        self.assertTrue(4 < delay <= 10, delay)
+        Job.objects.update(run_at=timezone.now())
+        job, = Jobs.claim(1)
+        self.assertEqual(job.attempts, 2)
+        with self.assertLogs("ebag.jobs", "WARNING"):
+            self.assertFalse(Jobs.run(job))
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        self.assertEqual(Jobs.claim(1), [])
+
+    @override_settings(JOB_RETRY_MAX_DELAY=60)
+    def test_backoff(self):
+        with mock.patch("random.uniform", return_value=1.0):
+            self.assertEqual(
+                [Jobs.backoff(attempts) for attempts in range(1, 6)],
+                [10, 20, 40, 60, 60]
+            )
+
+    def test_unknown_task(self):
+        Jobs.enqueue([("no_such_task", {})])
+        job, = Jobs.claim(1)
+        with self.assertLogs("ebag.jobs", "WARNING"):
+            self.assertFalse(Jobs.run(job))
+        self.assertIn("Unknown task", Job.objects.get().last_error)
+
+    def test_expired_lease(self):
+        """
+        Tests that the jobs of a dead worker are claimed again
+        once their lease expires, and that the dead worker cannot
+        change them anymore.
+        """
+        Jobs.enqueue([("flaky_task", {"fail": False})])
+        dead, = Jobs.claim(1)
+        self.assertEqual(Jobs.claim(1), [])
+        Job.objects.update(lease_expires=timezone.now() - timedelta(1))
+        job, = Jobs.claim(1)
+        self.assertNotEqual(job.claim, dead.claim)
+        self.assertEqual(job.attempts, 2)
+        Jobs.run(dead)
+        self.assertTrue(Job.objects.exists())
+        Jobs.run(job)
+        self.assertFalse(Job.objects.exists())
+
+    def test_release(self):
+        Jobs.enqueue([("flaky_task", {"fail": False})])
+        Jobs.release(Jobs.claim(1))
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 0))
+
+    def test_worker(self):
+        Jobs.enqueue([("flaky_task", {"fail": False})] * 3)
+        Jobs.enqueue([("flaky_task", {"fail": True})])
+        with self.assertLogs("ebag.jobs"):
+            self.assertEqual(JobWorker(batch_size=2, poll_interval=0).run(
+                once=True
+            ), 3)
+        self.assertEqual(Job.objects.get().attempts, 1)
+        out = StringIO()
+        Job.objects.update(run_at=timezone.now())
+        Jobs.enqueue([("flaky_task", {"fail": False})])
+        with self.assertLogs("ebag.jobs"):
+            call_command("run_jobs", "--once", stdout=out)
+        self.assertIn("1 jobs done.", out.getvalue())
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    def test_metrics(self):
+        Jobs.enqueue([("flaky_task", {"fail": False})] * 2)
+        Jobs.enqueue([("flaky_task", {"fail": True})], delay=60)
+        for job in Jobs.claim(1):
+            Jobs.run(job)
+        text = metrics.expose()
+        self.assertIn(
+            'ebag_job_queue_depth{status="queued",task="flaky_task"} 2', text
+        )
+        self.assertIn(
+            'ebag_jobs_total{outcome="done",task="flaky_task"} 1', text
+        )
+        self.assertIn(
+            'ebag_job_latency_seconds_count{task="flaky_task"} 1', text
+        )
+
+    def test_checkout_jobs(self):
+        product_id, = self.create_products(1)
+        Product.objects.filter(pk=product_id).update(stock=5)
+        ProductCache.get_many([product_id])
+        order = Orders.place({str(product_id): "2"}, self.CUSTOMER)
+        self.assertEqual(
+            sorted(Job.objects.values_list("task", flat=True)),
+            sorted(Orders.JOBS)
+        )
+        with self.assertLogs("ebag.jobs"):
+            self.assertEqual(
+                JobWorker(batch_size=10, poll_interval=0).run(once=True), 3
+            )
+        message, = mail.outbox
+        self.assertEqual(message.to, ["john@example.com"])
+        self.assertIn(str(order.number), message.subject)
+        self.assertIn("Product 0 x 2", message.body)
+        self.assertIn("Total: BGN 2", message.body)
+        self.assertIn("ebag_orders_total 1", metrics.expose())
+        # Run again, e.g. after its lease expired, the job
+        # doesn't count the order twice
+        Jobs.enqueue([("record_order_metrics", {"order_id": order.pk})])
+        JobWorker(batch_size=10, poll_interval=0).run(once=True)
+        self.assertIn("ebag_orders_total 1", metrics.expose())
+        self.assertEqual(
+            ProductCache.get_many([product_id])[product_id]["stock"], 3
+        )
+
+    def tearDown(self):
+        MetricsStore.clear()
+
+
+##############################
+#        Cache tests
+#############################
+
+
+class CategoryTreeCacheTestCase(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(name="Fruits")
+        self.child = Category.objects.create(name="Apples", parent=self.root)
+
+    def test_tree_order(self):
+        """
+        Tests if the cached nodes are ordered as expected by recursetree.
+        """
+        nodes = CategoryTreeCache.get_nodes()
+        self.assertEqual([n.pk for n in nodes], [self.root.pk, self.child.pk])
+        self.assertFalse(nodes[0].is_leaf_node())
+        self.assertTrue(nodes[1].is_leaf_node())
+
+    def test_get_node_and_descendants(self):
+        grandchild = Category.objects.create(name="Green", parent=self.child)
+        sibling = Category.objects.create(name="Pears", parent=self.root)
+        other = Category.objects.create(name="Dairy")
+        self.assertEqual(
+            CategoryTreeCache.get_node(grandchild.pk).name, "Green"
+        )
+        self.assertIsNone(CategoryTreeCache.get_node(0))
+        for node, descendants in (
+                (self.root, [self.root, self.child, grandchild, sibling]),
+                (self.child, [self.child, grandchild]),
+                (sibling, [sibling]),
+                (other, [other])):
+            node = CategoryTreeCache.get_node(node.pk)
+            self.assertEqual(
+                [n.pk for n in CategoryTreeCache.get_descendants(node)],
+                [n.pk for n in descendants]
+            )
+
+    def test_no_queries_when_cached(self):
+        """
+        Tests if the tree is read from the cache once built.
+        """
+        CategoryTreeCache.get_nodes()
+        with self.assertNumQueries(0):
+            CategoryTreeCache.get_nodes()
+
+    def test_invalidation_on_save(self):
+        CategoryTreeCache.get_nodes()
+        self.child.name = "Pears"
+        self.child.save()
+        self.assertEqual(CategoryTreeCache.get_nodes()[1].name, "Pears")
+
+    def test_invalidation_on_delete(self):
+        CategoryTreeCache.get_nodes()
+        self.child.delete()
+        self.assertEqual(len(CategoryTreeCache.get_nodes()), 1)
+
+    def test_invalidation_on_move(self):
+        CategoryTreeCache.get_nodes()
+        version = CategoryTreeCache.get_version()
+        self.child.move_to(None)
+        self.assertGreater(CategoryTreeCache.get_version(), version)
+        self.assertEqual(
+            [n.level for n in CategoryTreeCache.get_nodes()],
+            [0, 0]
+        )
+
+    def test_stats_invalidation(self):
+        """
+        Tests if a product change updates the cached product counts
+        without moving the tree version forward.
+        """
+        CategoryTreeCache.get_nodes()
+        version = CategoryTreeCache.get_version()
+        Product.objects.create(
+            name="Apple", category=self.child, description="Red",
+            price=1, image="test-img.png"
+        )
+        self.assertEqual(
+            [n.product_count for n in CategoryTreeCache.get_nodes()], [1, 1]
+        )
+        self.assertEqual(CategoryTreeCache.get_version(), version)
+
+    def test_navbar_fragment_cache(self):
+        """
+        Tests if the navbar is rendered from the fragment cache
+        and if it's re-rendered after a category change.
+        """
+        request = RequestFactory().get('/')
+        request.session = {}
+        self.assertIn(b"Apples", views.home_view(request).content)
+        with self.assertNumQueries(0):
+            self.assertIn(b"Apples", views.home_view(request).content)
+        self.child.name = "Pears"
+        self.child.save()
+        content = views.home_view(request).content
+        self.assertIn(b"Pears", content)
+        self.assertNotIn(b"Apples", content)
+
+
+class ProductCacheTestCase(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Milk",
+            category=Category.objects.create(name="Dairy"),
+            description="Fresh milk",
+            price=1.5,
+            image="test-img.png"
+        )
+
+    def test_get_many(self):
+        """
+        Tests if the products are loaded once and then read from the cache.
+        Unexisting products should be omitted.
+        """
+        with self.assertNumQueries(1):
+            products = ProductCache.get_many([self.product.pk, 0])
+        self.assertEqual(list(products), [self.product.pk])
+        self.assertEqual(products[self.product.pk]["price"], "1.50")
+        self.assertIsNone(products[self.product.pk]["stock"])
+        with self.assertNumQueries(0):
+            ProductCache.get_many([self.product.pk])
+
+    def test_invalidation(self):
+        ProductCache.get_many([self.product.pk])
+        self.product.price = 2
+        self.product.save()
+        products = ProductCache.get_many([self.product.pk])
+        self.assertEqual(float(products[self.product.pk]["price"]), 2)
+        product_id = self.product.pk
+        self.product.delete()
+        self.assertEqual(ProductCache.get_many([product_id]), {})
+
+
+##############################
+#      Middleware tests
+#############################
+
+
+class ProfilingMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.cat = Category.objects.create(name="Fruits")
+        self.url = "/" + self.cat.url + "/"
+
+    def test_not_profiled(self):
+        response = self.client.get(self.url)
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(PROFILING_ENABLED=True)
+    def test_profiled(self):
+        """
+        Tests if the request timings are added to the
+        Server-Timing header and logged.
+        """
+        with self.assertLogs("ebag.profiling", "INFO") as logs:
+            response = self.client.get(self.url)
+        timing = response["Server-Timing"]
+        for metric in ("total;dur=", "cpu;dur=", "db;dur=",
+                       "template;dur=", "session_save;dur=",
+                       "cache-category-tree-local"):
+            self.assertIn(metric, timing)
+        data = json.loads(logs.records[0].getMessage())
+        self.assertEqual(data["path"], self.url)
+        self.assertEqual(data["status"], 200)
+        self.assertEqual(data["category_tree_local_cache_misses"], 1)
+        self.assertGreater(data["db_count"], 0)
+        self.assertGreaterEqual(data["wall_ms"], data["template_ms"])
+
+    @override_settings(PROFILING_HEADER_TOKEN="secret")
+    def test_header_token(self):
+        response = self.client.get(self.url, HTTP_X_PROFILE="wrong")
+        self.assertNotIn("Server-Timing", response)
+        with self.assertLogs("ebag.profiling", "INFO"):
+            response = self.client.get(self.url, HTTP_X_PROFILE="secret")
+        self.assertIn("Server-Timing", response)
+
+    def test_cprofile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILING_ENABLED=True,
+                                   PROFILING_CPROFILE_RATE=1.0,
+                                   PROFILING_CPROFILE_DIR=directory):
+                with self.assertLogs("ebag.profiling", "INFO") as logs:
+                    self.client.get(self.url)
+            path = json.loads(logs.records[0].getMessage())["cprofile"]
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+
+
+@override_settings(METRICS_TOKEN="secret")
+class MetricsTestCase(TestCase, TestingHelper):
+    def setUp(self):
+        MetricsStore.clear()
+        self.create_cat_and_product()
+
+    def get_samples(self):
+        """
+        Returns {sample line without the value: value} from /metrics.
+        """
+        response = self.client.get(reverse("metrics"), {"token": "secret"})
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        return {
+            line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in response.content.decode().splitlines()
+            if not line.startswith("#")
+        }
+
+    def test_request_metrics(self):
+        self.client.get(reverse("home_view"))
+        self.client.get(reverse("home_view"))
+        self.client.get("/no-such-page/")
+        samples = self.get_samples()
+        self.assertEqual(samples[
+            'ebag_http_request_duration_seconds_count{view="home_view"}'
+        ], 2)
+        self.assertEqual(samples[
+            'ebag_http_request_duration_seconds_bucket'
+            '{view="home_view",le="+Inf"}'
+        ], 2)
+        self.assertEqual(samples[
+            'ebag_http_requests_total{status="200",view="home_view"}'
+        ], 2)
+        self.assertEqual(samples[
+            'ebag_http_requests_total{status="404",view="unmatched"}'
+        ], 1)
+        self.assertIn('ebag_db_queries_total{view="home_view"}', samples)
+
+    def test_cart_metrics(self):
+        url = reverse("update_cart")
+        product_id = str(self.product.pk)
+        for quantity in ("1", "2", "0"):
+            self.client.post(url, {"items": json.dumps([
+                {"product_id": product_id, "quantity": quantity}
+            ])})
+        for product_id in ("0", "x"):
+            self.client.post(url, {"items": json.dumps([
+                {"product_id": product_id, "quantity": "1"}
+            ])})
+        samples = self.get_samples()
+        for operation in ("add", "update", "remove"):
+            self.assertEqual(samples[
+                'ebag_cart_operations_total{operation="%s"}' % operation
+            ], 1)
+        for error in ("no_product", "invalid_params"):
+            self.assertEqual(samples[
+                'ebag_cart_errors_total{error="%s"}' % error
+            ], 1)
+
+    def test_token(self):
+        url = reverse("metrics")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(
+            self.client.get(url, {"token": "s\u00e9cret"}).status_code, 403
+        )
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(
+                self.client.get(url, {"token": ""}).status_code, 404
+            )
+
+    def test_multiple_processes(self):
+        """
+        Tests if the values in the files of other
+        processes are summed up.
+        """
+        metrics.CART_OPERATIONS.inc(operation="add")
+        other = MetricsFile(os.path.join(
+            settings.METRICS_DIR,
+            MetricsStore.FILE_NAME.format(host="other", pid=1)
+        ))
+        other.add(metrics.CART_OPERATIONS.key("", {"operation": "add"}), 2)
+        # Grows the file beyond its initial size
+        for i in range(1000):
+            other.add(metrics.CART_ERRORS.key("", {"error": str(i)}), 1)
+        samples = self.get_samples()
+        self.assertEqual(
+            samples['ebag_cart_operations_total{operation="add"}'], 3
+        )
+        self.assertEqual(samples['ebag_cart_errors_total{error="999"}'], 1)
+        other.close()
+
+    def test_dead_processes(self):
+        """
+        Tests if the files of the dead processes, of any host, are
+        merged into the archive file and deleted, and if clearing the
+        metrics keeps the files of the running processes.
+        """
+        key = metrics.CART_OPERATIONS.key("", {"operation": "add"})
+        metrics.CART_OPERATIONS.inc(operation="add")
+        running = MetricsFile(os.path.join(
+            settings.METRICS_DIR,
+            MetricsStore.FILE_NAME.format(host="other", pid=1)
+        ))
+        running.add(key, 10)
+        total = 11
+        for amount in (2, 3):
+            dead = MetricsFile(os.path.join(
+                settings.METRICS_DIR,
+                MetricsStore.FILE_NAME.format(host="other", pid=amount)
+            ))
+            dead.add(key, amount)
+            dead.close()
+            total += amount
+            self.assertEqual(MetricsStore.collect()[key], total)
+            self.assertEqual(sorted(MetricsStore.get_paths()), sorted([
+                MetricsStore.get_file().path, running.path
+            ]))
+        self.assertEqual(MetricsStore.collect()[key], 16)
+        self.assertEqual(MetricsStore.read(MetricsStore.get_path(
+            MetricsStore.ARCHIVE_NAME
+        )), {key: 5})
+        MetricsStore.clear()
+        self.assertEqual(MetricsStore.collect(), {key: 10})
+        running.close()
+        MetricsStore.clear()
+        self.assertEqual(MetricsStore.collect(), {})
+
+    def tearDown(self):
+        self.delete_product_image()
+        MetricsStore.clear()
+
+
+class QueryDetectorTestCase(TestCase):
+    def setUp(self):
+        Category.objects.bulk_create([
+            Category(name="Cat %d" % i, slug="cat-%d" % i,
+                     tree_id=i, lft=1, rght=2, level=0)
+            for i in range(1, 11)
+        ])
+        self.ids = list(Category.objects.values_list("id", flat=True))
+
+    def n_plus_one(self, request=None):
+        for pk in self.ids:
+            Category.objects.filter(pk=pk).exists()
+        return HttpResponse()
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql('SELECT "a" FROM "t" WHERE "id" IN (%s, %s)'),
+            normalize_sql('SELECT "a" FROM "t" WHERE "id" IN (%s,%s,%s)')
+        )
+        self.assertEqual(
+            normalize_sql("SELECT 1 FROM t WHERE name = 'x' LIMIT 21"),
+            "SELECT ? FROM t WHERE name = ? LIMIT ?"
+        )
+
+    def test_detector(self):
+        with QueryDetector() as detector:
+            self.n_plus_one()
+            list(Category.objects.filter(pk__in=self.ids))
+        self.assertEqual(detector.count, 11)
+        self.assertEqual(list(detector.repeated(5).values()), [10])
+
+    def test_query_budget(self):
+        with QueryBudget(max_queries=1):
+            list(Category.objects.filter(pk__in=self.ids))
+        with self.assertRaises(QueryBudgetExceeded):
+            with QueryBudget(max_queries=5):
+                list(Category.objects.all())
+                list(Category.objects.filter(pk__in=self.ids))
+                self.n_plus_one()
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with QueryBudget(max_queries=1):
+                list(Category.objects.all())
+                list(Category.objects.filter(pk__in=self.ids))
+        self.assertNotIsInstance(context.exception, RepeatedQueriesError)
+        with self.assertRaises(RepeatedQueriesError):
+            with QueryBudget(max_repeats=9):
+                self.n_plus_one()
+
+    def test_middleware(self):
+        middleware = QueryDetectorMiddleware(self.n_plus_one)
+        request = RequestFactory().get("/")
+        with override_settings(QUERY_DETECTOR_RAISE=False):
+            with self.assertLogs("ebag.queries", "WARNING") as logs:
+                middleware(request)
+        self.assertIn("10 x SELECT", logs.output[0])
+        with self.assertRaises(RepeatedQueriesError):
+            middleware(request)
+        with override_settings(QUERY_DETECTOR_ENABLED=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                QueryDetectorMiddleware(self.n_plus_one)
+
+
+class ViewsQueryBudgetTestCase(TestCase, TestingHelper):
+    """
+    The number of queries per view, with the caches filled by
+    a first request, so that the regressions are noticed.
+    """
+
+    def setUp(self):
+        self.create_cat_and_product()
+        self.client.post(reverse("add_to_cart"), {"items": json.dumps([
+            {"product_id": str(self.product.pk), "quantity": "1"}
+        ])})
+        self.category_url = "/" + self.cat.url + "/"
+
+    def get(self, url, **extra):
+        self.client.get(url, **extra)
+        with QueryBudget(max_repeats=1) as detector:
+            response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        return detector.count
+
+    def test_home_view(self):
+        # The session
+        self.assertEqual(self.get(reverse("home_view")), 1)
+
+    def test_category_view(self):
+        # The session and the products page, the products count
+        # of a leaf category is read from the categories tree
+        self.assertEqual(self.get(self.category_url), 2)
+        self.assertEqual(self.get(self.category_url, data={"after": ""}), 2)
+
+    def test_cart_view(self):
+        self.assertEqual(self.get(reverse("cart_view")), 1)
+
+    def test_checkout_view(self):
+        self.assertEqual(self.get(
+            reverse("checkout_view"), HTTP_REFERER=reverse("cart_view")
+        ), 1)
+
+    @QueryBudget(max_queries=4, max_repeats=1)
+    def test_update_cart(self):
+        self.client.post(reverse("update_cart"), {"items": json.dumps([
+            {"product_id": str(self.product.pk), "quantity": "3"}
+        ])})
+
+    def tearDown(self):
+        self.delete_product_image()
+
+
+##############################
+#        Search tests
+#############################
+
+
+class SearchTestingHelper(object):
+    """
+    Gives every test a new search index directory.
+    """
+    def setup_search_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index_settings = override_settings(SEARCH_INDEX_DIR=directory.name)
+        index_settings.enable()
+        self.addCleanup(index_settings.disable)
+        SearchIndex.instance = None
+
+    def create_products(self, *products):
+        """
+        Creates products from (name, description) tuples, without
+        sending signals, and returns their ids.
+        """
+        category = Category.objects.create(name="Food")
+        Product.objects.bulk_create([
+            Product(
+                name=name,
+                category=category,
+                description=description,
+                price=1,
+                image="product.png"
+            ) for name, description in products
+        ])
+        return list(Product.objects.order_by("id").values_list(
+            "id", flat=True
+        ))
+
+    def search(self, query, prefix=False):
+        return [
+            product_id for product_id, score in
+            SearchIndex.search(query, 10, prefix)
+        ]
+
+
+class SearchIndexTestCase(TestCase, SearchTestingHelper):
+    def setUp(self):
+        self.setup_search_index()
+        self.honey, self.tea, self.milk = self.create_products(
+            ("Bee honey", "Wild flowers honey"),
+            ("Green tea", "Best with honey and lemon"),
+            ("Fresh milk", "From the mountains"),
+        )
+
+    def test_tokenize(self):
+        self.assertEqual(
+            tokenize("The Fresh-Milk, a 3.5% fat"),
+            ["fresh", "milk", "fat"]
+        )
+
+    def test_search(self):
+        """
+        Tests if all the query words must match and if the products
+        with the word in the name rank above the ones with the word
+        only in the description.
+        """
+        self.assertEqual(SearchIndex.build(), 3)
+        self.assertEqual(self.search("honey"), [self.honey, self.tea])
+        self.assertEqual(self.search("HONEY lemon"), [self.tea])
+        self.assertEqual(self.search("honey cheese"), [])
+        self.assertEqual(self.search("the"), [])
+
+    def test_prefix(self):
+        SearchIndex.build()
+        self.assertEqual(self.search("fre"), [])
+        self.assertEqual(self.search("fre", prefix=True), [self.milk])
+        self.assertEqual(self.search("hon", prefix=True), [
+            self.honey, self.tea
+        ])
+        self.assertEqual(SearchIndex.complete("green te", 5), ["tea"])
+
+    def test_changes(self):
+        """
+        Tests if the logged changes are applied over the
+        segment and if a rebuild starts a new changes log.
+        """
+        SearchIndex.build()
+        SearchIndex.update_product(self.milk, "Milk", "Honey flavoured")
+        SearchIndex.delete_product(self.honey)
+        SearchIndex.update_product(self.milk + 1, "Cheese", "Honey")
+        self.assertEqual(
+            set(self.search("honey")), {self.tea, self.milk, self.milk + 1}
+        )
+        self.assertEqual(self.search("fresh"), [])
+        SearchIndex.update_product(self.milk, "Fresh milk", "")
+        self.assertEqual(self.search("fresh"), [self.milk])
+        # The changes logged before the rebuild are expected in
+        # the DB, where they were not made here
+        SearchIndex.build()
+        self.assertEqual(SearchIndex.current_generation(), 2)
+        self.assertEqual(self.search("cheese"), [])
+        self.assertEqual(self.search("bee"), [self.honey])
+        self.assertFalse(os.path.exists(SearchIndex.log_path(1)))
+
+    def test_changes_during_build(self):
+        """
+        Tests if a change logged while the DB is read
+        by a rebuild is kept in the new changes log.
+        """
+        write = IndexSegment.write
+
+        def write_and_change(*args):
+            count = write(*args)
+            SearchIndex.update_product(self.milk + 1, "Cheese", "")
+            return count
+
+        with mock.patch.object(IndexSegment, "write", write_and_change):
+            SearchIndex.build()
+        self.assertEqual(self.search("cheese"), [self.milk + 1])
+
+    def test_searched_index_not_changed(self):
+        """
+        Tests if the changes and the rebuilds give a new index,
+        so that the searches ranking without the lock see no change.
+        """
+        SearchIndex.build()
+        index = SearchIndex.current()
+        self.assertIs(SearchIndex.current(), index)
+        SearchIndex.update_product(self.milk, "Milk", "Honey flavoured")
+        changed = SearchIndex.current()
+        self.assertIsNot(changed, index)
+        self.assertEqual(
+            [product_id for product_id, score in index.rank("honey", 10)],
+            [self.honey, self.tea]
+        )
+        self.assertIn(self.milk, dict(changed.rank("honey", 10)))
+        SearchIndex.update_product(self.milk, "Milk", "")
+        self.assertNotIn(self.milk, dict(SearchIndex.current().rank(
+            "honey", 10
+        )))
+        self.assertIn(self.milk, dict(changed.rank("honey", 10)))
+        SearchIndex.build()
+        self.assertIsNot(SearchIndex.current().segment, index.segment)
+        self.assertEqual(len(index.rank("honey", 10)), 2)
+
+    def test_compaction(self):
+        """
+        Tests if a rebuild is queued whenever the
+        changes log grows by SEARCH_LOG_COMPACT_SIZE.
+        """
+        SearchIndex.build()
+        with override_settings(SEARCH_LOG_COMPACT_SIZE=200):
+            for i in range(10):
+                SearchIndex.update_product(self.milk, "Milk %d" % i, "Cow")
+        size = os.path.getsize(SearchIndex.log_path(1))
+        self.assertEqual(
+            Job.objects.filter(task="rebuild_search_index").count(),
+            size // 200
+        )
+        for job in Jobs.claim(10):
+            self.assertTrue(Jobs.run(job))
+        self.assertEqual(SearchIndex.current_generation(), 1 + size // 200)
+        self.assertFalse(os.path.exists(SearchIndex.log_path(1)))
+
+    def test_no_index(self):
+        self.assertEqual(self.search("honey"), [])
+        SearchIndex.update_product(self.tea, "Green tea", "")
+        self.assertEqual(self.search("tea"), [self.tea])
+
+
+class SearchSignalsTestCase(TransactionTestCase, SearchTestingHelper):
+    def setUp(self):
+        self.setup_search_index()
+
+    def test_signals(self):
+        """
+        Tests if the committed product changes are searchable.
+        """
+        product = Product.objects.create(
+            name="Honey",
+            category=Category.objects.create(name="Food"),
+            description="Bee honey",
+            price=1,
+            image="product.png"
+        )
+        self.assertEqual(self.search("honey"), [product.pk])
+        product.name = "Jam"
+        product.description = "Strawberry jam"
+        product.save()
+        self.assertEqual(self.search("honey"), [])
+        self.assertEqual(self.search("strawberry"), [product.pk])
+        product_id = product.pk
+        product.delete()
+        self.assertEqual(self.search("jam"), [])
+        SearchIndex.build()
+        self.assertEqual(self.search("jam"), [])
+        self.assertNotIn(product_id, self.search("strawberry"))
+
+
+class SearchViewsTestCase(TestCase, SearchTestingHelper):
+    def setUp(self):
+        self.setup_search_index()
+        self.ids = self.create_products(*[
+            ("Honey %d" % i, "Bee honey") for i in range(30)
+        ])
+        SearchIndex.build()
+
+    def test_search_view(self):
+        response = self.client.get(reverse("search"), {"q": "honey"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["query"], "honey")
+        self.assertEqual(
+            len(response.context["products"]), settings.CATEGORY_PAGE_SIZE
+        )
+        self.assertEqual(response.context["paginator"].count, 30)
+        response = self.client.get(reverse("search"), {"q": "cheese"})
+        self.assertEqual(list(response.context["products"]), [])
+        self.assertContains(response, "No products found.")
+
+    def test_autocomplete_view(self):
+        response = self.client.get(
+            reverse("search_autocomplete"), {"q": "be"}
+        )
+        data = response.json()
+        self.assertEqual(data["terms"], ["bee"])
+        self.assertEqual(
+            len(data["products"]), settings.SEARCH_AUTOCOMPLETE_LIMIT
+        )
+        self.assertEqual(data["products"][0]["name"], "Honey 0")
+        self.assertEqual(
+            self.client.get(reverse("search_autocomplete")).json(),
+            {"terms": [], "products": []}
+        )
+
+
+##############################
+#        Images tests
+#############################
+
+
+class ImagesTestingHelper(object):
+    """
+    Gives every test a new MEDIA_ROOT directory.
+    """
+    def setup_media_root(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=directory.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        ProductImages.manifests.clear()
+        ProductImages.misses.clear()
+
+    def create_image(self, name, size, mode="RGB"):
+        Image.new(mode, size).save(os.path.join(settings.MEDIA_ROOT, name))
+        return name
+
+    def formats(self, *formats):
+        if features.check("webp"):
+            formats += ("webp",)
+        return list(formats)
+
+
+class ProductImagesTestCase(TestCase, ImagesTestingHelper):
+    def setUp(self):
+        self.setup_media_root()
+
+    def test_generate(self):
+        name = self.create_image("photo.jpg", (800, 400))
+        manifest = ProductImages.generate(name)
+        self.assertEqual(manifest, {
+            "widths": [150, 300, 600], "formats": self.formats("jpg")
+        })
+        self.assertEqual(ProductImages.manifest(name), manifest)
+        for width in manifest["widths"]:
+            for extension in manifest["formats"]:
+                path = os.path.join(
+                    settings.MEDIA_ROOT,
+                    ProductImages.derivative_name(name, width, extension)
+                )
+                with Image.open(path) as derivative:
+                    self.assertEqual(derivative.size, (width, width // 2))
+        self.assertIsNone(ProductImages.generate(name))
+        self.assertEqual(ProductImages.generate(name, force=True), manifest)
+
+    def test_missing_manifest(self):
+        """
+        Tests if a missing manifest is not looked for again until
+        PRODUCT_IMAGE_MISS_TIMEOUT passes, unless generated here.
+        """
+        manifest = {"widths": [150], "formats": ["jpg"]}
+        with mock.patch("ebag.images.time.monotonic", return_value=100.0):
+            self.assertIsNone(ProductImages.manifest("photo.jpg"))
+            # Written by another process
+            ProductImages.write(
+                ProductImages.manifest_path("photo.jpg"),
+                lambda path: ProductImages.save_manifest(path, manifest)
+            )
+            with mock.patch("builtins.open") as open_:
+                self.assertIsNone(ProductImages.manifest("photo.jpg"))
+            open_.assert_not_called()
+        with mock.patch("ebag.images.time.monotonic", return_value=100.0 +
+                        settings.PRODUCT_IMAGE_MISS_TIMEOUT):
+            self.assertEqual(ProductImages.manifest("photo.jpg"), manifest)
+        self.assertEqual(len(ProductImages.misses), 0)
+        name = self.create_image("new.jpg", (200, 100))
+        self.assertIsNone(ProductImages.manifest(name))
+        self.assertIsNotNone(ProductImages.generate(name))
+        self.assertIsNotNone(ProductImages.manifest(name))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(len(cache), 2)
+
+    def test_generate_small_transparent(self):
+        """
+        Tests that the image is not upscaled and keeps its transparency.
+        """
+        name = self.create_image("logo.png", (200, 100), "RGBA")
+        self.assertEqual(
+            ProductImages.generate(name),
+            {"widths": [150, 200], "formats": self.formats("png")}
+        )
+
+    def test_product_image_tag(self):
+        template = Template(
+            "{% load product_images %}{% product_image image name %}"
+        )
+        name = self.create_image("photo.jpg", (800, 400))
+        context = Context({"image": name, "name": "Honey & jam"})
+        self.assertEqual(
+            template.render(context),
+            '<img src="%sphoto.jpg" alt="Honey &amp; jam" class="img-fluid">'
+            % settings.MEDIA_URL
+        )
+        ProductImages.generate(name)
+        html = template.render(context)
+        srcset = ", ".join(
+            "%sderivatives/photo-%dw.jpg %dw" % (settings.MEDIA_URL, w, w)
+            for w in (150, 300, 600)
+        )
+        self.assertIn('srcset="%s"' % srcset, html)
+        self.assertIn('sizes="%s"' % settings.PRODUCT_IMAGE_SIZES, html)
+        if features.check("webp"):
+            self.assertIn('<source type="image/webp"', html)
+            self.assertIn("derivatives/photo-300w.webp 300w", html)
+
+    def test_generate_product_images_command(self):
+        category = Category.objects.create(name="Food")
+        names = [
+            self.create_image("photo.jpg", (800, 400)),
+            self.create_image("done.jpg", (100, 100)),
+            "missing.jpg",
+            self.create_image("bomb.png", (1000, 1000)),
+        ]
+        ProductImages.generate("done.jpg")
+        Product.objects.bulk_create([
+            Product(
+                name=name, category=category, description=name,
+                price=1, image=name
+            ) for name in names
+        ])
+        stdout, stderr = StringIO(), StringIO()
+        # Images over twice the limit raise DecompressionBombError
+        with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 400000), \
+                self.assertLogs("ebag.images", "WARNING"):
+            call_command(
+                "generate_product_images", workers=1,
+                stdout=stdout, stderr=stderr
+            )
+        self.assertIn(
+            "1 images generated, 1 skipped, 2 failed.", stdout.getvalue()
+        )
+        self.assertIn("missing.jpg", stderr.getvalue())
+        self.assertIn("bomb.png", stderr.getvalue())
+        self.assertIsNotNone(ProductImages.manifest("photo.jpg"))
+
+
+class ProductImagesSignalsTestCase(TransactionTestCase, ImagesTestingHelper):
+    def setUp(self):
+        self.setup_media_root()
+
+    def test_upload(self):
+        """
+        Tests if the derivatives of an uploaded image are generated.
+        """
+        buffer = tempfile.SpooledTemporaryFile()
+        Image.new("RGB", (400, 400)).save(buffer, format="JPEG")
+        buffer.seek(0)
+        product = Product.objects.create(
+            name="Honey",
+            category=Category.objects.create(name="Food"),
+            description="Bee honey",
+            price=1,
+            image=SimpleUploadedFile("honey.jpg", buffer.read())
+        )
+        self.assertEqual(
+            ProductImages.manifest(product.image.name),
+            {"widths": [150, 300, 400], "formats": self.formats("jpg")}
+        )
+
+
+##############################
+#        Import and export tests
+#############################
+
+
+class ProductImportTestCase(TestCase, ImagesTestingHelper,
+                            SearchTestingHelper):
+    HEADER = "sku,name,category,description,price,image,stock\n"
+
+    def setUp(self):
+        self.setup_media_root()
+        self.setup_search_index()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.food = Category.objects.create(name="Food")
+        self.dairy = Category.objects.create(name="Dairy", parent=self.food)
+        self.errors = []
+
+    def write_feed(self, name, *lines):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file_:
+            file_.write("".join(lines))
+        return path
+
+    def run_import(self, path, **kwargs):
+        kwargs.setdefault("error", lambda line, error: self.errors.append(
+            (line, error)
+        ))
+        return ProductImport(path, **kwargs).run()
+
+    def test_csv(self):
+        path = self.write_feed(
+            "feed.csv",
+            self.HEADER,
+            'MLK-1,Milk,Food > Dairy,"Fresh, cold milk",1.50,,\n',
+            "BRD-1,Bread,Food > Bakery,Bread,2,,5\n",
+            "CHS-1,Cheese,Food > Dairy,Cheese,cheap,,\n",
+            "\n",
+            "EGG-1,Eggs,Food > Dairy,Eggs,3\n",
+        )
+        results = self.run_import(path)
+        self.assertEqual(
+            [results[name] for name in ("rows", "created", "failed")],
+            [4, 1, 3]
+        )
+        self.assertEqual([line for line, error in self.errors], [3, 4, 6])
+        self.assertIn("Unknown category", self.errors[0][1])
+        self.assertIn("price", self.errors[1][1])
+        milk = Product.objects.get(sku="MLK-1")
+        self.assertEqual(
+            (milk.name, milk.description, milk.price, milk.stock),
+            ("Milk", "Fresh, cold milk", Decimal("1.50"), None)
+        )
+        self.assertEqual(milk.category, self.dairy)
+        # The signals work of the bulk writes is done at the end
+        self.food.refresh_from_db()
+        self.assertEqual(self.food.product_count, 1)
+        self.assertEqual(SearchIndex.search("milk", 10)[0][0], milk.pk)
+        self.assertFalse(os.path.exists(path + ".checkpoint"))
+
+    def test_create_categories(self):
+        path = self.write_feed(
+            "feed.csv",
+            self.HEADER,
+            "BRD-1,Bread,Food > Bakery,Bread,2,,5\n",
+            "BRD-2,Rolls,Food > Bakery,Rolls,1,,\n",
+            "CAN-1,Candy,> Sweets,Candy,1,,\n",
+        )
+        results = self.run_import(path, create_categories=True)
+        self.assertEqual((results["created"], results["failed"]), (2, 1))
+        bakery = Category.objects.get(name="Bakery")
+        self.assertEqual(bakery.parent, self.food)
+        self.assertEqual(bakery.product_count, 2)
+        self.assertEqual(Product.objects.get(sku="BRD-1").stock, 5)
+
+    def test_upsert(self):
+        """
+        Tests that the rows of the known SKUs update the products,
+        keeping the fields missing from the rows.
+        """
+        rows = [
+            {
+                "sku": "P-%d" % i,
+                "name": "Product %d" % i,
+                "category": "Food > Dairy",
+                "description": "Product",
+                "price": i + 1,
+                "stock": 10,
+            }
+            for i in range(200)
+        ]
+        path = self.write_feed(
+            "feed.jsonl", *[json.dumps(row) + "\n" for row in rows]
+        )
+        self.run_import(path, batch_size=150)
+        product = Product.objects.get(sku="P-0")
+        ProductCache.get_many([product.pk])
+        for row in rows:
+            row["price"] += 1
+            del row["stock"]
+        rows[0]["name"] = "Renamed"
+        path = self.write_feed(
+            "feed.jsonl",
+            "not json\n",
+            *[json.dumps(row) + "\n" for row in rows + rows[:1]]
+        )
+        results = self.run_import(path, batch_size=150)
+        # The repeated row is in another batch, so it is written again
+        self.assertEqual(
+            [results[name] for name in ("rows", "created", "updated")],
+            [202, 0, 201]
+        )
+        self.assertEqual(self.errors, [(1, "Malformed row.")])
+        self.assertEqual(Product.objects.count(), 200)
+        self.assertEqual(
+            Product.objects.filter(price=F("id") - product.pk + 2).count(),
+            200
+        )
+        self.assertEqual(Product.objects.filter(stock=10).count(), 200)
+        updated = Product.objects.get(pk=product.pk)
+        self.assertEqual(updated.name, "Renamed")
+        self.assertGreater(updated.last_update, product.last_update)
+        self.assertEqual(
+            ProductCache.get_many([product.pk])[product.pk]["name"], "Renamed"
+        )
+
+    def test_reserved_stock(self):
+        """
+        Tests that the quantities reserved by the carts are subtracted
+        from the imported stock, so that the stock is right again when
+        the reservations expire.
+        """
+        path = self.write_feed(
+            "feed.csv",
+            self.HEADER,
+            "MLK-1,Milk,Food > Dairy,Milk,1,,10\n",
+            "EGG-1,Eggs,Food > Dairy,Eggs,1,,10\n",
+        )
+        self.run_import(path)
+        milk = Product.objects.get(sku="MLK-1")
+        StockReservations.reserve("cart", {milk.pk: 3})
+        StockReservations.reserve("other", {milk.pk: 5})
+        path = self.write_feed(
+            "feed.csv",
+            self.HEADER,
+            "MLK-1,Milk,Food > Dairy,Milk,1,,12\n",
+            "EGG-1,Eggs,Food > Dairy,Eggs,1,,7\n",
+        )
+        self.run_import(path)
+        self.assertEqual(Product.objects.get(pk=milk.pk).stock, 4)
+        self.assertEqual(Product.objects.get(sku="EGG-1").stock, 7)
+        StockReservation.objects.update(
+            expires=timezone.now() - timedelta(seconds=1)
+        )
+        StockReservations.sweep()
+        self.assertEqual(Product.objects.get(pk=milk.pk).stock, 12)
+
+    def test_images(self):
+        Image.new("RGB", (400, 200)).save(
+            os.path.join(self.directory, "milk.jpg")
+        )
+        with open(os.path.join(self.directory, "bad.png"), "w") as file_:
+            file_.write("not an image")
+        path = self.write_feed(
+            "feed.csv",
+            self.HEADER,
+            "MLK-1,Milk,Food > Dairy,Milk,1,milk.jpg,\n",
+            "MLK-2,Milk 2,Food > Dairy,Milk,1,milk.jpg,\n",
+            "BAD-1,Bad,Food > Dairy,Bad,1,bad.png,\n",
+            "MIS-1,Missing,Food > Dairy,Missing,1,missing.png,\n",
+        )
+        results = self.run_import(path, workers=2)
+        self.assertEqual((results["created"], results["failed"]), (2, 2))
+        first, second = Product.objects.order_by("sku")
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(first.image.name.startswith("imports/"))
+        self.assertEqual(
+            ProductImages.manifest(first.image.name),
+            {"widths": [150, 300, 400], "formats": self.formats("jpg")}
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(settings.MEDIA_ROOT, "imports")),
+            [os.path.basename(first.image.name)]
+        )
+
+    def test_resume(self):
+        path = self.write_feed("feed.csv", self.HEADER, *[
+            "P-%d,Product %d,Food > Dairy,Product,1,,\n" % (i, i)
+            for i in range(5)
+        ])
+        write = ProductImport.write
+        calls = []
+
+        def fail_second_batch(product_import, prepared, results):
+            calls.append(len(prepared))
+            if len(calls) == 2:
+                raise RuntimeError("Lost the DB")
+            write(product_import, prepared, results)
+
+        with mock.patch.object(ProductImport, "write", fail_second_batch):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path, batch_size=2)
+        with open(path + ".checkpoint") as file_:
+            self.assertEqual(json.load(file_)["line"], 3)
+        self.assertEqual(Product.objects.count(), 2)
+        # The stats of the written batches are updated anyway
+        self.assertEqual(Category.objects.get(pk=self.food.pk).product_count, 2)
+        results = self.run_import(path, batch_size=2)
+        self.assertEqual(results["resumed_from_line"], 3)
+        self.assertEqual((results["rows"], results["created"]), (5, 5))
+        self.assertEqual(
+            sorted(Product.objects.values_list("sku", flat=True)),
+            ["P-%d" % i for i in range(5)]
+        )
+        self.assertFalse(os.path.exists(path + ".checkpoint"))
+
+    def test_changed_feed_checkpoint(self):
+        path = self.write_feed(
+            "feed.csv", self.HEADER, "P-1,Product,Food > Dairy,Product,1,,\n"
+        )
+        with open(path + ".checkpoint", "w") as file_:
+            json.dump({"path": path, "size": 1, "mtime": 0, "line": 1}, file_)
+        with self.assertRaises(ValueError):
+            self.run_import(path)
+        self.assertEqual(ProductImport(path).run(restart=True)["created"], 1)
+
+    def test_command(self):
+        path = self.write_feed(
+            "feed.csv", self.HEADER, "P-1,Product,Food > Dairy,Product,1,,\n",
+            "P-2,Product,Food > Dairy,Product,x,,\n"
+        )
+        out = StringIO()
+        err = StringIO()
+        call_command(
+            "import_products", path, "--workers", "0", stdout=out, stderr=err
+        )
+        self.assertIn("2 rows: 1 created, 0 updated, 1 failed", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertIn("Line 3: price", err.getvalue())
 
 
-class ProductTestCase(TestCase, TestingHelper):
-    def test_string_representation(self):
-        product = Product(name="Milk")
-        self.assertEqual(str(product), product.name)
+class ProductFeedTestCase(TestCase):
+    def setUp(self):
+        food = Category.objects.create(name="Food")
+        self.dairy = Category.objects.create(name="Dairy", parent=food)
+        Product.objects.bulk_create([
+            Product(
+                sku="MLK-1", name="Milk", category=self.dairy,
+                description="Milk <fresh> & \x01cold", price="1.50",
+                image="milk.png"
+            ),
+            Product(
+                name="Cheese", category=self.dairy, description="Cheese",
+                price=5, stock=0
+            ),
+            Product(
+                sku="BTR-1", name="Butter", category=self.dairy,
+                description="Butter", price=3, stock=7
+            ),
+        ])
+        self.milk, self.cheese, self.butter = Product.objects.order_by("id")
+        CategoryStats.rebuild()
+
+    def read(self, format, compress=False, **kwargs):
+        feed = ProductFeed(format, "http://shop.test/", **kwargs)
+        data = b"".join(feed.stream(compress))
+        return gzip.decompress(data) if compress else data
+
+    def test_csv(self):
+        CategoryTreeCache.get_rows()
+        # A query per chunk of products
+        with self.assertNumQueries(2):
+            data = self.read("csv", chunk_size=2).decode()
+        rows = list(csv.DictReader(StringIO(data)))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0], {
+            "id": str(self.milk.pk),
+            "sku": "MLK-1",
+            "name": "Milk",
+            "category": "Food > Dairy",
+            "description": "Milk <fresh> & \x01cold",
+            "price": "1.50",
+            "stock": "",
+            "availability": "in_stock",
+            "link": "http://shop.test/%s/" % self.dairy.url,
+            "image_link": "http://shop.test%smilk.png" % settings.MEDIA_URL,
+        })
+        self.assertEqual(rows[1]["availability"], "out_of_stock")
 
-    def test_model_save_fields(self):
+    def test_import_exported(self):
         """
-        Tests the model fields after model saving
-        and tests if the image is uploaded.
+        Tests that the exported CSV is imported back.
         """
-        self.create_cat_and_product()
-        product = self.product
-        product.save()
-        uploaded_img = settings.MEDIA_ROOT + os.sep + str(product.image)
-
-        self.assertEqual(product.name, "Honey")
-        self.assertIsInstance(product.name, str)
-        self.assertIsInstance(product.category, Category)
-        self.assertEqual(product.description, "Honey is good")
-        self.assertIsInstance(product.description, str)
-        self.assertEqual(product.price, self.product_data["price"])
-        self.assertIsInstance(
-            product.image,
-            models.fields.files.ImageFieldFile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "feed.csv")
+        with open(path, "wb") as file_:
+            file_.write(self.read("csv"))
+        with override_settings(SEARCH_INDEX_DIR=directory.name):
+            results = ProductImport(path).run()
+        # The cheese has no SKU
+        self.assertEqual((results["updated"], results["failed"]), (2, 1))
+
+    def test_jsonl(self):
+        items = [
+            json.loads(line) for line in
+            self.read("jsonl", chunk_size=3).decode().splitlines()
+        ]
+        self.assertEqual(
+            [(item["name"], item["stock"]) for item in items],
+            [("Milk", None), ("Cheese", 0), ("Butter", 7)]
         )
-        self.assertTrue(os.path.isfile(uploaded_img))
-        product.image.delete()
+        self.assertEqual(items[2]["image_link"], "")
 
+    def test_xml(self):
+        namespace = "{http://base.google.com/ns/1.0}"
+        channel = ElementTree.fromstring(self.read("xml")).find("channel")
+        self.assertEqual(channel.find("link").text, "http://shop.test/")
+        milk, cheese, butter = channel.findall("item")
+        self.assertEqual(
+            milk.find(namespace + "description").text, "Milk <fresh> & cold"
+        )
+        self.assertEqual(milk.find(namespace + "price").text, "1.50 BGN")
+        self.assertEqual(
+            milk.find(namespace + "product_type").text, "Food > Dairy"
+        )
+        self.assertIsNone(cheese.find(namespace + "mpn"))
+        self.assertEqual(
+            cheese.find(namespace + "availability").text, "out_of_stock"
+        )
 
-class CategoryTestCase(TestCase):
-    def test_string_representation(self):
-        cat = Category(name="Milk")
-        self.assertEqual(str(cat), cat.name)
+    def test_gzip(self):
+        self.assertEqual(self.read("xml", compress=True), self.read("xml"))
+
+    @override_settings(PRODUCT_FEED_TOKEN="secret")
+    def test_view(self):
+        url = reverse("product_feed", args=["csv"]) + "?token=secret"
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        data = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(data.decode().count("\n"), 4)
+        self.assertIn("http://testserver/%s/" % self.dairy.url, data.decode())
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(
+            b"".join(response.streaming_content), data
+        )
+        self.assertEqual(
+            self.client.get(
+                reverse("product_feed", args=["pdf"]), {"token": "secret"}
+            ).status_code, 404
+        )
 
-    def test_parent_category_options(self):
+    def test_accepts_gzip(self):
+        for header, expected in (
+                ("gzip, deflate, br", True),
+                ("GZIP", True),
+                ("br;q=1.0, gzip;q=0.8", True),
+                ("x-gzip", True),
+                ("*", True),
+                ("", False),
+                ("identity", False),
+                ("deflate, gzip;q=0", False),
+                ("gzip; q=0.000", False),
+                ("*;q=0", False),
+                ("gzip;q=0, *", False),
+                ("gzip;q=x", False),
+                ("notgzip", False)):
+            self.assertEqual(
+                ProductFeed.accepts_gzip(header), expected, header
+            )
+
+    def test_view_without_token(self):
         """
-        Tests if category can be created both
-        with parent category and non parent category.
+        Tests that the feed is not served until a token is set.
         """
-        parents = {
-            None: None,
-            Category: Category.objects.create(),
-        }
-        for instance, parent in parents.items():
-            cat = Category(**{
-                "name": "Dairy",
-                "parent": parent,
-            })
-            cat.save()
-            if instance is not None:
-                self.assertIsInstance(cat.parent, instance)
-            else:
-                self.assertIs(cat.parent, None)
+        url = reverse("product_feed", args=["xml"])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(
+            self.client.get(url, {"token": ""}).status_code, 404
+        )
+
+    @override_settings(PRODUCT_FEED_TOKEN="secret")
+    def test_view_token(self):
+        url = reverse("product_feed", args=["xml"])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(
+            self.client.get(url, {"token": "wrong"}).status_code, 403
+        )
+        self.assertEqual(
+            self.client.get(url, {"token": "s\u00e9cret"}).status_code, 403
+        )
+        self.assertEqual(
+            self.client.get(url, {"token": "secret"}).status_code, 200
+        )
+
+    def test_command(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "feed.jsonl.gz")
+        out = StringIO()
+        call_command("export_products", path, stdout=out)
+        self.assertIn("3 products exported", out.getvalue())
+        with gzip.open(path) as file_:
+            self.assertEqual(len(file_.read().splitlines()), 3)
+        self.assertEqual(os.listdir(directory.name), ["feed.jsonl.gz"])
+        with self.assertRaises(CommandError):
+            call_command("export_products", path + ".txt")
 
 
 ##############################
@@ -310,10 +2138,7 @@ class GeneralContextMixinTestCase(TestCase):
         self.assertIsInstance(common_data, dict)
         self.assertTrue("categories" in common_data)
         self.assertEqual(len(common_data["categories"]), 1)
-        self.assertEqual(
-            common_data["categories"].values()[0]["id"],
-            self.cat.pk
-        )
+        self.assertEqual(common_data["categories"][0].pk, self.cat.pk)
 
     def test_common_data_empty_cart(self):
         """
@@ -331,26 +2156,35 @@ class GeneralContextMixinTestCase(TestCase):
         """
         quantity = 2
         price = 4.99
-        self.request.session = {
-            "cart": {
-                "5": {
-                    "quantity": quantity,
-                    "product_data": {
-                        "id": 1,
-                        "price": price,
-                    }
-                }
-            }
-        }
+        product = Product.objects.create(
+            name="Milk",
+            category=self.cat,
+            description="Fresh milk",
+            price=price,
+            image="test-img.png"
+        )
+        self.request.session = {"cart": {str(product.pk): str(quantity)}}
         common_data = views.GeneralContextMixin.common_data(self.request)
         self.assertIsInstance(common_data, dict)
+        self.assertEqual(len(common_data["cart"]), 1)
+        self.assertEqual(common_data["cart"][0]["quantity"], str(quantity))
         self.assertEqual(
-            common_data["cart"],
-            [self.request.session["cart"]["5"]]
+            common_data["cart"][0]["product_data"]["id"],
+            str(product.pk)
         )
         self.assertEqual(common_data["items_in_cart"], 1)
         self.assertEqual(common_data["cart_total"], quantity * price)
 
+    def test_common_data_deleted_product(self):
+        """
+        Test if common_data() skips the cart items
+        whose products no longer exist.
+        """
+        self.request.session = {"cart": {"5": "2"}}
+        common_data = views.GeneralContextMixin.common_data(self.request)
+        self.assertEqual(common_data["cart"], [])
+        self.assertEqual(common_data["items_in_cart"], 0)
+
     def test_common_data_add_to_ctx_param(self):
         """
         Test if common_data() includes in the returned data a
@@ -394,7 +2228,7 @@ class FunctionBasedViewsTestCase(TestCase):
         Test if cart_view loads successfully
         if the cart is not empty
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": {"5": "1"}}
         response = views.cart_view(self.request)
         self.assertEqual(response.status_code, 200)
 
@@ -425,7 +2259,7 @@ class FunctionBasedViewsTestCase(TestCase):
         the cart is not empty, but user is not coming from
         /cart/
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": {"5": "1"}}
         response = views.checkout_view(self.request)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, reverse("home_view"))
@@ -436,7 +2270,7 @@ class FunctionBasedViewsTestCase(TestCase):
         if the cart is not empty and the user is coming
         from /cart/
         """
-        self.request.session = {"cart": {}}
+        self.request.session = {"cart": {"5": "1"}}
         self.request.META["HTTP_REFERER"] = '/cart/'
         response = views.checkout_view(self.request)
         self.assertEqual(response.status_code, 200)
@@ -460,14 +2294,270 @@ class FunctionBasedViewsTestCase(TestCase):
         self.assertEqual(response.url, reverse("home_view"))
 
 
+class ConditionalGetTestCase(TestCase, TestingHelper):
+    def setUp(self):
+        self.create_cat_and_product()
+        self.category_url = "/" + self.cat.url + "/"
+
+    def assertNotModified(self, url, etag, expected=True):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304 if expected else 200)
+        return response
+
+    def test_etag(self):
+        for url in (reverse("home_view"), self.category_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("private", response["Cache-Control"])
+            self.assertIn("no-cache", response["Cache-Control"])
+            etag = response["ETag"]
+            response = self.assertNotModified(url, etag)
+            self.assertEqual(response.content, b"")
+            self.assertEqual(response["ETag"], etag)
+
+    def test_not_modified_without_rendering(self):
+        etag = self.client.get(self.category_url)["ETag"]
+        with self.assertNumQueries(0):
+            self.assertNotModified(self.category_url, etag)
+
+    def test_product_change(self):
+        etag = self.client.get(self.category_url)["ETag"]
+        home_etag = self.client.get(reverse("home_view"))["ETag"]
+        self.product.name = "Milk"
+        self.product.save()
+        self.assertNotModified(self.category_url, etag, expected=False)
+        self.assertNotModified(reverse("home_view"), home_etag)
+
+    def test_product_delete(self):
+        product = Product.objects.create(
+            name="Milk", category=self.cat, description="Milk",
+            price=1, image="test-img.png"
+        )
+        etag = self.client.get(self.category_url)["ETag"]
+        product.delete()
+        self.assertNotModified(self.category_url, etag, expected=False)
+
+    def test_category_change(self):
+        etag = self.client.get(reverse("home_view"))["ETag"]
+        Category.objects.create(name="Milk")
+        self.assertNotModified(reverse("home_view"), etag, expected=False)
+
+    def test_cart_change(self):
+        etag = self.client.get(self.category_url)["ETag"]
+        self.client.post(reverse("add_to_cart"), {"items": json.dumps([
+            {"product_id": str(self.product.pk), "quantity": "1"}
+        ])})
+        self.assertNotModified(self.category_url, etag, expected=False)
+
+    def test_unexisting_category(self):
+        response = self.client.get("/category/0/none/")
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response)
+
+    def tearDown(self):
+        self.delete_product_image()
+
+
+@override_settings(FULL_PAGE_CACHE=True)
+class PageCacheTestCase(TestCase, TestingHelper):
+    def setUp(self):
+        self.create_cat_and_product()
+        self.category_url = "/" + self.cat.url + "/"
+
+    def add_to_cart(self):
+        self.client.post(reverse("add_to_cart"), {"items": json.dumps([
+            {"product_id": str(self.product.pk), "quantity": "2"}
+        ])})
+
+    def test_cached_pages(self):
+        for url in (reverse("home_view"), self.category_url):
+            response = self.client.get(url)
+            self.assertEqual(response["X-Page-Cache"], "MISS")
+            self.assertIn(b"cart_widget_url", response.content)
+            # No CSRF token is rendered, nor even generated
+            self.assertNotIn("CSRF_COOKIE", response.wsgi_request.META)
+            self.assertIn(b'let csrf_token = "";', response.content)
+            cached = Client().get(url)
+            self.assertEqual(cached["X-Page-Cache"], "HIT")
+            self.assertEqual(cached.content, response.content)
+
+    def test_not_rendered_on_hit(self):
+        self.client.get(self.category_url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.category_url)
+        self.assertEqual(response["X-Page-Cache"], "HIT")
+        self.assertEqual(
+            self.client.get(self.category_url, {"sort": "name"})[
+                "X-Page-Cache"
+            ], "MISS"
+        )
+
+    def test_normalized_params(self):
+        """
+        Tests if the requests rendering the same page, with invalid,
+        default or unknown query parameters, share its cache entry.
+        """
+        self.client.get(self.category_url)
+        for params in ({"page": "1"}, {"page": "999"}, {"page": "x"},
+                       {"sort": "id"}, {"sort": "x"}, {"per_page": "0"},
+                       {"price": "99"}, {"sub": "0"}, {"utm_source": "x"}):
+            response = self.client.get(self.category_url, params)
+            self.assertEqual(response["X-Page-Cache"], "HIT", params)
+        self.client.get(self.category_url, {"after": ""})
+        for cursor in ("x", KeysetPaginator.encode_cursor(["x"])):
+            response = self.client.get(self.category_url, {"after": cursor})
+            self.assertEqual(response["X-Page-Cache"], "HIT", cursor)
+        response = self.client.get(self.category_url, {
+            "after": KeysetPaginator.encode_cursor([self.product.pk])
+        })
+        self.assertEqual(response["X-Page-Cache"], "MISS")
+
+    def test_not_modified(self):
+        """
+        Tests if the cached pages are validated by their cache key,
+        with no query, and change with the catalogue.
+        """
+        for url in (reverse("home_view"), self.category_url):
+            etag = self.client.get(url)["ETag"]
+            response = Client().get(url)
+            self.assertEqual(response["X-Page-Cache"], "HIT")
+            self.assertEqual(response["ETag"], etag)
+            self.assertIn("private", response["Cache-Control"])
+            with self.assertNumQueries(0):
+                response = Client().get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+        self.product.name = "Milk"
+        self.product.save()
+        response = self.client.get(self.category_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Page-Cache"], "MISS")
+
+    def test_invalidation(self):
+        self.client.get(self.category_url)
+        self.product.name = "Milk"
+        self.product.save()
+        response = self.client.get(self.category_url)
+        self.assertEqual(response["X-Page-Cache"], "MISS")
+        self.assertIn(b"Milk", response.content)
+        Category.objects.create(name="Dairy")
+        response = self.client.get(self.category_url)
+        self.assertEqual(response["X-Page-Cache"], "MISS")
+        self.assertIn(b"Dairy", response.content)
+
+    def test_not_cached(self):
+        self.add_to_cart()
+        response = self.client.get(self.category_url)
+        self.assertNotIn("X-Page-Cache", response)
+        self.assertNotIn(b"cart_widget_url", response.content)
+        with override_settings(FULL_PAGE_CACHE=False):
+            response = Client().get(self.category_url)
+            self.assertNotIn("X-Page-Cache", response)
+
+    def test_cart_widget(self):
+        response = self.client.get(reverse("cart_widget"))
+        data = json.loads(response.content)
+        self.assertEqual(data["items_in_cart"], 0)
+        self.assertEqual(data["cart"], {})
+        self.assertTrue(data["csrf_token"])
+        self.assertIn("no-store", response["Cache-Control"])
+        self.add_to_cart()
+        data = json.loads(self.client.get(reverse("cart_widget")).content)
+        self.assertEqual(data["items_in_cart"], 1)
+        self.assertEqual(data["cart"], {str(self.product.pk): "2"})
+
+    def tearDown(self):
+        self.delete_product_image()
+
+
+class CategoryFacetsTestCase(TestCase):
+    """
+    Tests the subtree browsing and the facets of a non-leaf category.
+    """
+
+    def setUp(self):
+        self.root = Category.objects.create(name="Food")
+        self.dairy = Category.objects.create(name="Dairy", parent=self.root)
+        self.fruits = Category.objects.create(name="Fruits", parent=self.root)
+        self.url = "/" + Category.objects.get(pk=self.root.pk).url + "/"
+        for category, price in ((self.dairy, 2), (self.dairy, 12),
+                                (self.fruits, 3), (self.fruits, 30)):
+            Product.objects.create(
+                name="%s %d" % (category.name, price),
+                category=category,
+                description="Product",
+                price=price,
+                image="product.png"
+            )
+
+    def get(self, **params):
+        self.client.get(self.url, params)
+        with self.assertNumQueries(1):
+            # The products page
+            response = self.client.get(self.url, params)
+        return response.context
+
+    def facets(self, ctx, name):
+        return [
+            (facet["label"], facet["count"], facet["selected"])
+            for facet in ctx[name]
+        ]
+
+    def test_subtree(self):
+        ctx = self.get(sort="price")
+        self.assertEqual(
+            [product["name"] for product in ctx["products"]],
+            ["Dairy 2", "Fruits 3", "Dairy 12", "Fruits 30"]
+        )
+        self.assertEqual(self.facets(ctx, "subcategory_facet"), [
+            ("Dairy", 2, False), ("Fruits", 2, False)
+        ])
+        self.assertEqual(self.facets(ctx, "price_facet"), [
+            ("Under 5", 2, False), ("10 - 20", 1, False),
+            ("20 - 50", 1, False)
+        ])
+        self.assertEqual(ctx["filter_query"], "")
+
+    def test_filters(self):
+        ctx = self.get(sort="price", price="0", page="1")
+        self.assertEqual(
+            [product["name"] for product in ctx["products"]],
+            ["Dairy 2", "Fruits 3"]
+        )
+        self.assertEqual(ctx["paginator"].count, 2)
+        self.assertEqual(self.facets(ctx, "subcategory_facet"), [
+            ("Dairy", 1, False), ("Fruits", 1, False)
+        ])
+        ctx = self.get(sort="price", price="0", sub=str(self.fruits.pk))
+        self.assertEqual(
+            [product["name"] for product in ctx["products"]], ["Fruits 3"]
+        )
+        self.assertEqual(self.facets(ctx, "price_facet"), [
+            ("Under 5", 1, True), ("20 - 50", 1, False)
+        ])
+        self.assertEqual(
+            ctx["filter_query"], "&price=0&sub=%d" % self.fruits.pk
+        )
+        # A selected value's link removes the filter
+        self.assertEqual(
+            ctx["price_facet"][0]["query"],
+            "sort=price&per_page=%d&sub=%d" % (
+                settings.CATEGORY_PAGE_SIZE, self.fruits.pk
+            )
+        )
+
+    def test_invalid_filters(self):
+        ctx = self.get(price="100", sub=str(self.root.pk))
+        self.assertEqual(len(ctx["products"]), 4)
+        self.assertEqual(ctx["filter_query"], "")
+
+
 class CategoryViewTestCase(TestCase, TestingHelper):
     def setUp(self):
         self.create_cat_and_product()
         self.client = Client()
         self.factory = RequestFactory()
-        self.view_url = "/" + \
-            self.cat.slug.replace(settings.PK_PLACEHOLDER,
-                                  str(self.cat.pk)) + "/"
+        self.view_url = "/" + self.cat.url + "/"
         self.request = self.factory.get(self.view_url)
 
     def test_category_view(self):
@@ -494,15 +2584,195 @@ class CategoryViewTestCase(TestCase, TestingHelper):
         self.assertEqual(response.status_code, 200)
         self.assertTrue("categories" in response.context)
         self.assertTrue("products" in response.context)
-        self.assertEqual(response.context["categories"].values()[
-                         0]["id"], self.cat.pk)
-        self.assertEqual(response.context["products"].values()[
-                         0]["id"], self.product.pk)
+        self.assertEqual(response.context["categories"][0].pk, self.cat.pk)
+        self.assertEqual(response.context["products"][0]["id"],
+                         self.product.pk)
+
+    def helper_create_products(self):
+        """
+        Creates 5 more products in the category and returns all
+        the category products ids, ordered by price and id.
+        """
+        Product.objects.bulk_create([
+            Product(
+                name="Product %d" % i,
+                category=self.cat,
+                description="Description",
+                price=price,
+                image="test-img.png"
+            ) for i, price in enumerate([3, 1, 3, 2, 0.5])
+        ])
+        # bulk_create() sends no signals
+        CategoryStats.rebuild()
+        CategoryTreeCache.invalidate()
+        return list(Product.objects.filter(category=self.cat).order_by(
+            "price", "id").values_list("id", flat=True))
+
+    def test_pagination(self):
+        ids = self.helper_create_products()
+        response = self.client.get(self.view_url, {
+            "sort": "price",
+            "per_page": "2",
+            "page": "2",
+        })
+        self.assertTrue(response.context["is_paginated"])
+        self.assertEqual(response.context["page_obj"].number, 2)
+        self.assertEqual(
+            [p["id"] for p in response.context["products"]],
+            ids[2:4]
+        )
+
+    def test_keyset_pagination(self):
+        """
+        Tests if following the cursors returns all the
+        products in the right order.
+        """
+        ids = self.helper_create_products()
+        found_ids = []
+        cursor = ""
+        while cursor is not None:
+            response = self.client.get(self.view_url, {
+                "sort": "price",
+                "per_page": "4",
+                "after": cursor,
+            })
+            products = response.context["products"]
+            self.assertLessEqual(len(products), 4)
+            found_ids += [p["id"] for p in products]
+            cursor = response.context["page_obj"].next_cursor
+        self.assertEqual(found_ids, ids)
+
+    def test_one_product_query(self):
+        """
+        Tests if, with warm caches, a category page costs a single
+        query for the products with both paginations, the page
+        number one counting the products from the denormalized
+        category count.
+        """
+        self.helper_create_products()
+        self.client.get(self.view_url)
+        with self.assertNumQueries(1):
+            self.client.get(self.view_url, {"after": ""})
+        with self.assertNumQueries(1):
+            self.client.get(self.view_url, {"page": "1"})
+
+    def test_unexisting_category(self):
+        response = self.client.get(
+            "/category/%d/none/" % (self.cat.pk + 1)
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_pagination_params(self):
+        self.helper_create_products()
+        response = self.client.get(self.view_url, {
+            "sort": "x",
+            "per_page": "100000",
+            "after": "invalid",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["sort"], "id")
+        self.assertEqual(
+            response.context["per_page"],
+            settings.CATEGORY_PAGE_SIZE
+        )
+        self.assertEqual(len(response.context["products"]), 6)
+        cursor = KeysetPaginator.encode_cursor(["x", "y"])
+        response = self.client.get(self.view_url, {
+            "sort": "price",
+            "after": cursor,
+        })
+        self.assertEqual(len(response.context["products"]), 6)
 
     def tearDown(self):
         self.product.image.delete()
 
 
+class CheckoutViewTestCase(TestCase, OrderTestingHelper):
+    def setUp(self):
+        self.product_ids = self.create_products(50)
+
+    def fill_cart(self, product_ids):
+        self.client.post(reverse("update_cart"), {"items": json.dumps([
+            {"product_id": str(pk), "quantity": "2"} for pk in product_ids
+        ])})
+
+    def checkout(self, data):
+        return self.client.post(
+            reverse("checkout_view"), data,
+            HTTP_REFERER=reverse("checkout_view")
+        )
+
+    def test_checkout(self):
+        self.fill_cart(self.product_ids[:2])
+        response = self.checkout(self.CUSTOMER)
+        order = Order.objects.get()
+        self.assertRedirects(
+            response,
+            "%s?order=%d" % (reverse("thank_you_view"), order.number),
+            fetch_redirect_response=False
+        )
+        self.assertEqual(order.total, Decimal("6"))
+        self.assertEqual(order.lines.count(), 2)
+        self.assertEqual(self.client.session.get("cart", {}), {})
+        response = self.client.get(
+            response.url, HTTP_REFERER=reverse("checkout_view")
+        )
+        self.assertContains(
+            response, "Your order number is %d." % order.number
+        )
+
+    def test_invalid_form(self):
+        self.fill_cart(self.product_ids[:1])
+        response = self.checkout(dict(self.CUSTOMER, email="john"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(len(self.client.session["cart"]), 1)
+
+    def test_queries(self):
+        """
+        Tests that the checkout queries do not depend on the cart size.
+        """
+        counts = []
+        for count in (1, 10, 50):
+            self.fill_cart(self.product_ids[:count])
+            with QueryBudget(max_repeats=1) as detector:
+                response = self.checkout(self.CUSTOMER)
+            self.assertEqual(response.status_code, 302)
+            counts.append(detector.count)
+        # The order numbers block is reserved by the first checkout,
+        # with an UPDATE and a SELECT in a savepoint
+        self.assertEqual(counts, [counts[1] + 4, counts[1], counts[1]])
+
+    def test_out_of_stock(self):
+        Product.objects.filter(pk=self.product_ids[0]).update(stock=1)
+        self.fill_cart(self.product_ids[:2])
+        response = self.checkout(self.CUSTOMER)
+        self.assertContains(
+            response, settings.ERR_MSG_OUT_OF_STOCK_ORDER % "Product 0"
+        )
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(len(self.client.session["cart"]), 2)
+
+    @override_settings(STOCK_RESERVATIONS=True)
+    def test_stock_reservations(self):
+        hot = self.product_ids[0]
+        Product.objects.filter(pk=hot).update(stock=3)
+        ProductCache.invalidate(hot)
+        self.fill_cart(self.product_ids[:2])
+        self.assertIn(settings.STOCK_RESERVATION_COOKIE, self.client.cookies)
+        self.assertEqual(StockReservation.objects.get().quantity, 2)
+        response = self.client.post(reverse("update_cart"), {
+            "items": json.dumps([{"product_id": str(hot), "quantity": "4"}])
+        })
+        self.assertEqual(
+            response.json()["err_msg"], settings.ERR_MSG_OUT_OF_STOCK
+        )
+        self.assertEqual(self.client.session["cart"][str(hot)], "2")
+        self.assertEqual(self.checkout(self.CUSTOMER).status_code, 302)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(Product.objects.get(pk=hot).stock, 1)
+
+
 class AJAXSessionCartTestCase(TestCase, TestingHelper):
 
     def setUp(self):
@@ -668,26 +2938,33 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
         self.assertEqual(self.view.err_msg, "")
         self.assertEqual(self.view.cart, {})
         # Non empty cart
-        self.view.request.session = {"cart": "item"}
+        self.view.request.session = {"cart": {"5": "1"}}
         self.view.set_init_vars()
         self.assertEqual(self.view.success, 1)
         self.assertEqual(self.view.items_in_cart, 0)
         self.assertEqual(self.view.err_msg, "")
-        self.assertEqual(self.view.cart, "item")
+        self.assertEqual(self.view.cart, {"5": "1"})
+        # Cart in the old format
+        self.view.request.session = {"cart": {"5": {
+            "quantity": "1",
+            "product_data": {"id": "5"}
+        }}}
+        self.view.set_init_vars()
+        self.assertEqual(self.view.cart, {"5": "1"})
+        self.assertEqual(self.view.request.session["cart"], {"5": "1"})
 
     def test_set_cart(self):
-        self.view.request.session["cart"] = "item"
-        """ Test if the cart is removed from the session
-        if there are no intems inside """
-        self.view.items_in_cart = 0
+        self.view.set_init_vars()
+        """ Test if the cart is saved in the session
+        if there are items inside """
+        self.view.cart = {"5": "1"}
         self.view.set_cart()
-        self.assertEqual(self.view.cart, {})
-        """ Test if the cart is assigned properly to the cart
-        attribute if there are intems inside """
-        self.view.request.session["cart"] = "item"
-        self.view.items_in_cart = 1
+        self.assertEqual(self.view.request.session["cart"], {"5": "1"})
+        """ Test if the cart is removed from the session
+        if there are no items inside """
+        self.view.cart = {}
         self.view.set_cart()
-        self.assertEqual(self.view.cart, "item")
+        self.assertFalse("cart" in self.view.request.session)
 
     def test_return_error(self):
         self.view.items_in_cart = 0
@@ -699,32 +2976,71 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
 
     def test_delete_product_from_cart(self):
         product_id = "5"
-        self.view.request.session["cart"] = {}
-        self.view.request.session["cart"][product_id] = "some product data"
+        self.view.cart = {product_id: "1"}
         self.view.delete_product_from_cart(product_id)
-        self.assertTrue(product_id not in self.view.request.session["cart"])
+        self.assertTrue(product_id not in self.view.cart)
 
     def test_update_cart_with_product(self):
         product_id = str(self.product.pk)
         quantity = "4"
-        product = Product.objects.filter(id=product_id)
-        self.view.request.session["cart"] = {}
-        self.view.update_cart_with_product(product_id, quantity, product)
-        self.assertTrue(product_id in self.view.request.session["cart"])
-        self.assertIsInstance(
-            self.view.request.session["cart"][product_id], dict)
-        self.assertEqual(
-            self.view.request.session["cart"][product_id]["quantity"],
-            quantity
-        )
-        product_data = {
-            k: str(v) for k, v in
-            product.values()[0].items()
-        }
-        self.assertEqual(
-            self.view.request.session["cart"][product_id]["product_data"],
-            product_data
-        )
+        self.view.cart = {}
+        self.view.update_cart_with_product(product_id, quantity)
+        self.assertEqual(self.view.cart, {product_id: quantity})
+
+    def test_get_products(self):
+        products = self.view.get_products([str(self.product.pk)])
+        self.assertEqual(products[self.product.pk]["name"], "Honey")
+        self.assertEqual(self.view.get_products([]), {})
+        self.assertIsNone(self.view.get_products([
+            str(self.product.pk),
+            str(self.product.pk + 1)
+        ]))
+
+    def test_no_partial_update_on_error(self):
+        """
+        Test if the cart is left untouched if any of
+        the submitted products does not exist.
+        """
+        response = self.client.post(reverse("add_to_cart"), {
+            "items": json.dumps([
+                {"product_id": str(self.product.pk), "quantity": "1"},
+                {"product_id": str(self.product.pk + 1), "quantity": "1"},
+            ])
+        })
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["success"], 0)
+        self.assertEqual(self.client.session.get("cart", {}), {})
+
+    def test_constant_number_of_queries(self):
+        """
+        Test if the number of queries does not depend
+        on the number of items in the cart update.
+        """
+        Product.objects.bulk_create([
+            Product(
+                name="Product %d" % i,
+                category=self.cat,
+                description="Description",
+                price=1,
+                image="test-img.png"
+            ) for i in range(50)
+        ])
+        products = Product.objects.filter(name__startswith="Product ")
+        queries = []
+        for items_count in (1, 10, 50):
+            items = [
+                {"product_id": str(product.pk), "quantity": "2"}
+                for product in products[:items_count]
+            ]
+            self.client.session.flush()
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(reverse("add_to_cart"), {
+                    "items": json.dumps(items)
+                })
+            json_response = json.loads(response.content)
+            self.assertEqual(json_response["items_in_cart"], items_count)
+            queries.append(len(ctx.captured_queries))
+        self.assertEqual(len(set(queries)), 1, queries)
 
     def test_return_json(self):
         cart = {"item": "item_data"}
@@ -748,3 +3064,165 @@ class AJAXSessionCartTestCase(TestCase, TestingHelper):
 
     def tearDown(self):
         self.delete_product_image()
+
+
+class CartStorageTestCase(TestCase, TestingHelper):
+    """
+    Tests the cart storage backends through the cart views.
+    """
+
+    def setUp(self):
+        self.create_cat_and_product()
+        self.client = Client()
+
+    def helper_add_to_cart(self, quantity):
+        """
+        Adds the product to cart and returns the executed
+        queries which write to the DB.
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse("add_to_cart"), {
+                "items": json.dumps([{
+                    "product_id": str(self.product.pk),
+                    "quantity": quantity,
+                }])
+            })
+        self.assertEqual(json.loads(response.content)["success"], 1)
+        return [
+            query["sql"] for query in ctx.captured_queries
+            if not query["sql"].upper().startswith("SELECT")
+        ]
+
+    def helper_check_backend(self):
+        """
+        Adds a product to the cart, checks if it's displayed
+        on the cart page, then removes it.
+        """
+        self.assertEqual(self.helper_add_to_cart("3"), [])
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["items_in_cart"], 1)
+        self.assertEqual(response.context["cart"][0]["quantity"], "3")
+        self.assertEqual(self.helper_add_to_cart("0"), [])
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(CART_STORAGE="ebag.cart.SignedCookieCartStorage")
+    def test_signed_cookie_storage(self):
+        self.helper_check_backend()
+
+    @override_settings(CART_STORAGE="ebag.cart.SignedCookieCartStorage")
+    def test_signed_cookie_tampering(self):
+        self.helper_add_to_cart("3")
+        self.client.cookies[settings.CART_COOKIE_NAME] = \
+            '{"%d":"100"}' % self.product.pk
+        response = self.client.get(reverse("cart_view"))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(CART_STORAGE="ebag.cart.KeyValueCartStorage")
+    def test_key_value_storage(self):
+        self.helper_check_backend()
+
+    def test_session_writes(self):
+        """
+        Tests if the session is saved only when the cart is changed,
+        counting the session table writes for a sequence of cart updates
+        and read-only page views.
+        """
+        def session_writes(queries):
+            return len([sql for sql in queries if "django_session" in sql])
+
+        self.assertEqual(session_writes(self.helper_add_to_cart("3")), 1)
+        for i in range(3):
+            self.assertEqual(session_writes(self.helper_add_to_cart("3")), 0)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse("cart_view"))
+            self.client.get(reverse("home_view"))
+        self.assertEqual(session_writes([
+            query["sql"] for query in ctx.captured_queries
+            if not query["sql"].upper().startswith("SELECT")
+        ]), 0)
+        self.assertEqual(session_writes(self.helper_add_to_cart("0")), 1)
+        self.assertEqual(session_writes(self.helper_add_to_cart("0")), 0)
+
+    def test_session_storage(self):
+        self.assertNotEqual(self.helper_add_to_cart("3"), [])
+        self.assertEqual(
+            self.client.session["cart"],
+            {str(self.product.pk): "3"}
+        )
+
+    def tearDown(self):
+        self.delete_product_image()
+
+
+##############################
+#      Benchmark tests
+#############################
+
+
+class BenchmarkTestCase(TestCase):
+    def test_generate_catalogue(self):
+        """
+        Tests if the generated categories form valid MPTT trees
+        and every leaf category gets the products.
+        """
+        Category.objects.create(name="Existing")
+        self.assertEqual(generate_catalogue(2, 3, 4), (12, 36))
+        fields = ("id", "parent_id", "tree_id", "level", "lft", "rght",
+                  "is_leaf", "url")
+        generated = list(Category.objects.order_by("id").values(*fields))
+        Category.objects.rebuild()
+        Category.update_leaf_flags()
+        self.assertEqual(
+            list(Category.objects.order_by("id").values(*fields)), generated
+        )
+        for category in Category.objects.filter(level=1):
+            self.assertEqual(category.product_set.count(), 4)
+            self.assertEqual(
+                category.url,
+                "category/%d/%s" % (category.pk, category.slug)
+            )
+
+    def test_percentile(self):
+        self.assertEqual(percentile([3, 1, 2, 4, 5], 50), 3)
+        self.assertEqual(percentile([1, 2], 50), 1.5)
+        self.assertEqual(percentile([1, 2, 3], 100), 3)
+
+    def test_run(self):
+        """
+        Tests if all the views are measured and if the placed
+        orders are deleted, with their stock given back.
+        """
+        generate_catalogue(2, 2, 30)
+        Product.objects.filter(id__in=Product.objects.order_by(
+            "id"
+        ).values_list("id", flat=True)[:20]).update(stock=1000)
+        stocks = dict(Product.objects.values_list("id", "stock"))
+        results = StorefrontBenchmark(repeat=3, warmup=1).run()
+        self.assertEqual(results["meta"]["products"], 120)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(
+            dict(Product.objects.values_list("id", "stock")), stocks
+        )
+        self.assertEqual(set(results["results"]), {
+            "home_view", "category_view", "category_view_last_page",
+            "category_subtree_view", "cart_view", "checkout_view",
+            "ajax_session_cart", "checkout_1_line", "checkout_10_lines",
+            "checkout_200_lines"
+        })
+        for result in results["results"].values():
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["queries"], 0)
+            self.assertGreater(result["peak_memory_kb"], 0)
+
+    def test_checkout_without_order(self):
+        """
+        Tests that a checkout placing no order is not measured.
+        """
+        generate_catalogue(1, 1, 5)
+        Product.objects.update(stock=0)
+        with self.assertRaisesMessage(ValueError, "placed no order"):
+            StorefrontBenchmark(repeat=1, warmup=1).run()
+        self.assertFalse(Order.objects.exists())
@@ -1,12 +1,37 @@
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.views.generic import ListView
 from django.views.generic.base import TemplateView
-from django.http import JsonResponse
+from django.http import (
+    JsonResponse, Http404, HttpResponse, HttpResponseForbidden,
+    StreamingHttpResponse
+)
 from django.conf import settings
-from .models import Category, Product
+from django.core.exceptions import ValidationError
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers
+)
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.middleware.csrf import get_token
+from django.utils.functional import SimpleLazyObject
+from django.views.decorators.http import condition
+from .models import Product
 from .forms import CheckoutForm
+from .caching import CategoryTreeCache, PageCache, ProductCache
+from .cart import Cart
+from .exporting import ProductFeed
+from .orders import Orders
+from .pagination import KeysetPaginator
+from .search import SearchIndex
+from .stock import OutOfStock, StockReservations
+from .stats import CategoryStats
+from . import metrics
 from functools import wraps
+import hashlib
 import json
+import math
 # Create your views here.
 
 
@@ -21,9 +46,16 @@ class GeneralContextMixin:
     def common_data(request, ctx=None):
         """
         Returns common data used in many views:
-        1) Categories tree
-        2) Cart
+        1) Categories tree (from the cache, see CategoryTreeCache)
+        and its version, with the stats version as the navbar shows
+        the product counts, used as a key for the navbar fragment cache.
+        The tree is lazy, so it's not even read from the cache
+        when the navbar is served from the fragment cache.
+        2) Cart, with the products data joined to the stored
+        cart (see Cart.hydrate)
         3) items_in_cart
+        4) page_cache, True if the page is rendered for PageCache,
+        so the per-visitor data is loaded by JavaScript
         If ctx is passed as a dict, adds its data to the
         returned result as well.
 
@@ -36,22 +68,144 @@ class GeneralContextMixin:
 
         if ctx is None:
             ctx = {}
-        ctx['categories'] = Category.objects.all()
-        ctx["items_in_cart"] = 0
-        if "cart" in request.session:
-            ctx["cart"] = [
-                item for key, item in request.session["cart"].items()
-            ]
-            cart_total = sum([
-                int(item["quantity"]) * float(item["product_data"]["price"])
-                for item in ctx["cart"]
-            ])
-            ctx["cart_total"] = cart_total
-        else:
-            ctx["cart"] = []
+        ctx['categories'] = SimpleLazyObject(CategoryTreeCache.get_nodes)
+        ctx['category_tree_version'] = "%s-%s" % (
+            CategoryTreeCache.get_version(),
+            CategoryTreeCache.get_stats_version()
+        )
+        ctx["cart"] = list(
+            Cart.hydrate(Cart.storage(request).load()).values()
+        )
+        ctx["cart_total"] = sum([
+            int(item["quantity"]) * float(item["product_data"]["price"])
+            for item in ctx["cart"]
+        ])
         ctx["items_in_cart"] = len(ctx["cart"])
+        ctx["page_cache"] = getattr(request, "page_cache", False)
         return ctx
 
+    @staticmethod
+    def etag(request, *parts):
+        """
+        Returns the ETag of a page rendered with common_data(),
+        a hash of:
+        1) The categories tree and stats versions (the navbar)
+        2) The cart fingerprint: the cart items with the last
+        update of their products
+        3) The CSRF cookie, as the page contains the CSRF token.
+        get_token() sets it on the first visit, so the ETag is the
+        same on the next request, sending the cookie.
+        4) settings.ETAG_VERSION, changed when the templates change
+        5) The page specific parts
+
+        :param request: passed from Django
+        :type request:  WSGIRequest
+        :param parts: The page specific parts, converted to strings
+        :type parts: tuple
+        """
+        get_token(request)
+        cart = Cart.hydrate(Cart.storage(request).load())
+        fingerprint = sorted(
+            (
+                product_id,
+                str(item["quantity"]),
+                item["product_data"].get("last_update", "")
+            )
+            for product_id, item in cart.items()
+        )
+        data = json.dumps([
+            CategoryTreeCache.get_version(),
+            CategoryTreeCache.get_stats_version(),
+            fingerprint,
+            request.META["CSRF_COOKIE"],
+            settings.ETAG_VERSION,
+            [str(part) for part in parts],
+        ])
+        return '"%s"' % hashlib.md5(data.encode()).hexdigest()
+
+    @staticmethod
+    def conditional(etag_func):
+        """
+        Decorator.
+        Returns 304 Not Modified without calling the view if the
+        request's If-None-Match contains the ETag returned by
+        etag_func, otherwise adds the ETag to the response.
+        The responses are marked private and always revalidated,
+        as they contain the user's cart. The pages served by
+        page_cache, which must wrap this decorator, are validated
+        by it instead.
+
+        :param etag_func: Returns the ETag, passed the view arguments
+        :type etag_func: function
+        """
+        def outer_wrapper(function):
+            conditional_function = condition(etag_func=etag_func)(function)
+
+            @wraps(function)
+            def inner_wrapper(request, *args, **kwargs):
+                if getattr(request, "page_cache", False):
+                    return function(request, *args, **kwargs)
+                response = conditional_function(request, *args, **kwargs)
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
+            return inner_wrapper
+        return outer_wrapper
+
+    @staticmethod
+    def page_cache(params_func):
+        """
+        Decorator.
+        If settings.FULL_PAGE_CACHE is set, serves the page from
+        PageCache to the visitors with an empty cart, rendering
+        and caching it if it's missing. The X-Page-Cache response
+        header tells if the page was found in the cache. The cache
+        key and the ETag are looked up before the conditional
+        decorator is called, so that a hit or a 304 costs no query:
+        the ETag of the cached pages is the hash of their cache key,
+        which holds all their versions.
+
+        :param params_func: Returns the normalized query parameters
+                            the page depends on, as (name, value)
+                            pairs, or None if the page must not be
+                            cached, passed the view arguments
+        :type params_func: function
+        """
+        def outer_wrapper(function):
+            @wraps(function)
+            def inner_wrapper(request, *args, **kwargs):
+                key = None
+                if (settings.FULL_PAGE_CACHE and
+                        request.method in ("GET", "HEAD") and
+                        not Cart.storage(request).load()):
+                    params = params_func(request, *args, **kwargs)
+                    if params is not None:
+                        key = PageCache.key(request, params)
+                if key is None:
+                    return function(request, *args, **kwargs)
+                request.page_cache = True
+                etag = '"%s"' % hashlib.md5(key.encode()).hexdigest()
+                response = get_conditional_response(request, etag=etag)
+                if response is None:
+                    page = PageCache.get(key)
+                    if page is not None:
+                        response = HttpResponse(
+                            page[0], content_type=page[1]
+                        )
+                        response["X-Page-Cache"] = "HIT"
+                    else:
+                        response = function(request, *args, **kwargs)
+                        if response.status_code != 200:
+                            return response
+                        if hasattr(response, "render"):
+                            response.render()
+                        PageCache.set(key, response)
+                        response["X-Page-Cache"] = "MISS"
+                response["ETag"] = etag
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
+            return inner_wrapper
+        return outer_wrapper
+
     @staticmethod
     def validate_referrer(valid_referrers):
         """
@@ -92,43 +246,408 @@ class GeneralContextMixin:
         """
         @wraps(function)
         def inner_dec(request, *args, **kwargs):
-            if "cart" not in request.session:
+            if not Cart.storage(request).load():
                 return redirect('home_view')
             return function(request, *args, **kwargs)
         return inner_dec
 
 
+def category_etag(request, cat_id, **kwargs):
+    """
+    Returns the category page ETag or None for an unexisting category.
+    The page shows the products of the whole subtree, which have no
+    version of their own, so the ETag changes with the PageCache
+    version instead, which costs no query. It's moved forward on every
+    product change in any category though, so the 304 responses save
+    the rendering only between two catalogue changes, e.g. while the
+    visitors browse back and forth and the catalogue is not edited.
+    """
+    if CategoryTreeCache.get_node(cat_id) is None:
+        return None
+    return GeneralContextMixin.etag(request, PageCache.get_version())
+
+
+def category_page_params(request, **kwargs):
+    """
+    Returns the normalized query parameters of a category page
+    (see CategoryView.get_cache_params) or None if it's not cached.
+    """
+    return CategoryView(request=request, kwargs=kwargs).get_cache_params()
+
+
 class CategoryView(ListView):
     """
-    Loads the products from a specific category
+    Loads the products from a specific category subtree, paginated by
+    page number (?page=) or by cursor (?after=), which needs no
+    OFFSET scans, sorted by ?sort= and filtered by subcategory (?sub=)
+    and price range (?price=). The facets counts and the number of
+    the products are read from the precomputed category stats (see
+    ebag.stats.CategoryStats) instead of being counted.
     """
     template_name = 'category.html'
-    model = Category
+    context_object_name = 'products'
+    # Only the columns rendered by category.html
+    product_fields = ("id", "name", "description", "price", "image")
+    sort_orderings = {
+        "id": ("id",),
+        "price": ("price", "id"),
+        "name": ("name", "id"),
+    }
+
+    @method_decorator(GeneralContextMixin.page_cache(category_page_params))
+    @method_decorator(GeneralContextMixin.conditional(category_etag))
+    def get(self, request, *args, **kwargs):
+        if not self.load_category():
+            raise Http404("No such category")
+        return super(__class__, self).get(request, *args, **kwargs)
+
+    def load_category(self):
+        """
+        Gets the current category, its subtree and the filters
+        from the cached categories tree. Returns False if there
+        is no such category.
+        """
+        self.category = CategoryTreeCache.get_node(self.kwargs["cat_id"])
+        if self.category is None:
+            return False
+        self.subtree = CategoryTreeCache.get_descendants(self.category)
+        self.subcategories = [
+            node for node in self.subtree
+            if node.level == self.category.level + 1
+        ]
+        self.scope, self.price_bucket = self.get_filters()
+        return True
+
+    def get_cache_params(self):
+        """
+        Returns the query parameters the page is rendered from, which
+        key it in PageCache, or None if it's not cached. The values
+        ignored by the view (e.g. an invalid sort or a subcategory of
+        another category), the default ones and the unknown parameters
+        are dropped and the page number is clamped like the paginator
+        does, so that the requests of the same page share its entry
+        and random query strings don't fill the cache. The page number
+        is not cached when it can't be clamped, without the product
+        count of the filtered category.
+        """
+        if not self.load_category():
+            return None
+        params = self.get_filter_params()
+        sort = self.get_sort()
+        if sort != "id":
+            params.append(("sort", sort))
+        per_page = self.get_paginate_by(None)
+        if per_page != settings.CATEGORY_PAGE_SIZE:
+            params.append(("per_page", per_page))
+        if "after" in self.request.GET:
+            # An invalid cursor shows the first page, by cursor
+            params.append(("after", self.get_cursor()))
+        elif self.page_kwarg in self.request.GET:
+            count = self.product_count(self.scope)
+            if count is None:
+                return None
+            pages = max(1, math.ceil(count / per_page))
+            try:
+                number = int(self.request.GET[self.page_kwarg])
+            except ValueError:
+                number = 1
+            if not 0 < number <= pages:
+                number = pages
+            if number != 1:
+                params.append((self.page_kwarg, number))
+        return sorted((name, str(value)) for name, value in params)
+
+    def get_cursor(self):
+        """
+        Returns ?after= encoded again if it's a valid cursor of the
+        current sort, otherwise an empty one.
+        """
+        ordering = self.get_ordering()
+        values = KeysetPaginator(None, ordering, None).decode_cursor(
+            self.request.GET["after"]
+        )
+        if values is None:
+            return ""
+        try:
+            for field, value in zip(ordering, values):
+                Product._meta.get_field(field).to_python(value)
+        except (ValidationError, ValueError):
+            return ""
+        return KeysetPaginator.encode_cursor(values)
+
+    def get_filters(self):
+        """
+        Returns (the subcategory from ?sub= or the category, the
+        price range number from ?price= or None). Invalid values
+        are ignored.
+        """
+        scope = self.category
+        for node in self.subcategories:
+            if str(node.pk) == self.request.GET.get("sub"):
+                scope = node
+        try:
+            price_bucket = int(self.request.GET.get("price", ""))
+        except ValueError:
+            return scope, None
+        if not 0 <= price_bucket < CategoryStats.buckets_count():
+            return scope, None
+        return scope, price_bucket
+
+    def get_filter_params(self, **changes):
+        """
+        Returns the current filters as query parameters, with the
+        given changes, a filter changed to its current value or None
+        being removed.
+        """
+        params = {
+            "sub": self.scope.pk if self.scope != self.category else None,
+            "price": self.price_bucket,
+        }
+        for name, value in changes.items():
+            params[name] = None if params[name] == value else value
+        return [
+            (name, value) for name, value in sorted(params.items())
+            if value is not None
+        ]
+
+    def product_count(self, node):
+        """
+        Returns the number of the products of the category subtree
+        in the selected price range, or None if the category has no
+        histogram (e.g. the stats were not rebuilt after a bulk insert).
+
+        :param node: The category
+        :type node: Category
+        """
+        if self.price_bucket is None:
+            return node.product_count
+        if len(node.price_histogram) != CategoryStats.buckets_count():
+            return None
+        return node.price_histogram[self.price_bucket]
+
+    def get_facets(self):
+        """
+        Returns (the subcategories facet, the price ranges facet),
+        lists of dicts with the label, the products count, the URL
+        query string and whether the value is selected.
+        """
+        sort_params = [
+            ("sort", self.get_sort()),
+            ("per_page", self.get_paginate_by(None))
+        ]
+        subcategories = [
+            {
+                "label": node.name,
+                "count": self.product_count(node),
+                "query": urlencode(
+                    sort_params + self.get_filter_params(sub=node.pk)
+                ),
+                "selected": node == self.scope,
+            }
+            for node in self.subcategories
+        ]
+        prices = []
+        if len(self.scope.price_histogram) == CategoryStats.buckets_count():
+            for bucket, count in enumerate(self.scope.price_histogram):
+                if not count:
+                    continue
+                low, high = CategoryStats.price_range(bucket)
+                if low is None:
+                    label = "Under %s" % high
+                elif high is None:
+                    label = "%s and more" % low
+                else:
+                    label = "%s - %s" % (low, high)
+                prices.append({
+                    "label": label,
+                    "count": count,
+                    "query": urlencode(
+                        sort_params + self.get_filter_params(price=bucket)
+                    ),
+                    "selected": bucket == self.price_bucket,
+                })
+        return subcategories, prices
+
+    def get_sort(self):
+        """
+        Returns the sort from ?sort= if it's valid, otherwise "id".
+        """
+        sort = self.request.GET.get("sort")
+        if sort not in self.sort_orderings:
+            return "id"
+        return sort
+
+    def get_ordering(self):
+        return self.sort_orderings[self.get_sort()]
+
+    def get_queryset(self):
+        queryset = Product.objects.filter(category_id__in=[
+            node.pk for node in self.subtree
+            if self.scope.lft <= node.lft <= self.scope.rght
+        ])
+        if self.price_bucket is not None:
+            low, high = CategoryStats.price_range(self.price_bucket)
+            if low is not None:
+                queryset = queryset.filter(price__gte=low)
+            if high is not None:
+                queryset = queryset.filter(price__lt=high)
+        return queryset.values(*self.product_fields).order_by(
+            *self.get_ordering()
+        )
+
+    def get_paginate_by(self, queryset):
+        """
+        Returns the page size from ?per_page= if it's valid,
+        otherwise the default one from the settings.
+        """
+        try:
+            per_page = int(self.request.GET.get("per_page", ""))
+        except ValueError:
+            return settings.CATEGORY_PAGE_SIZE
+        if not 0 < per_page <= settings.CATEGORY_MAX_PAGE_SIZE:
+            return settings.CATEGORY_PAGE_SIZE
+        return per_page
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginates by cursor if ?after= is passed, otherwise by page
+        number. Invalid pages and cursors return the first page.
+        """
+        if "after" in self.request.GET:
+            page = KeysetPaginator(
+                queryset,
+                self.get_ordering(),
+                page_size
+            ).page(self.request.GET["after"])
+            return (None, page, page.object_list, page.has_next())
+        paginator = self.get_paginator(queryset, page_size)
+        count = self.product_count(self.scope)
+        if count is not None:
+            # The denormalized count saves the COUNT query
+            paginator.count = count
+        page = paginator.get_page(self.request.GET.get(self.page_kwarg))
+        return (
+            paginator,
+            page,
+            list(page.object_list),
+            page.has_previous() or page.has_next()
+        )
 
     def get_context_data(self, **kwargs):
         """
         Prepares for passing to the template a context, containing:
         1) The current category data
-        2) The products belonging to the category
-        3) The estimated displayed quantity of each product based
-        on the session history
+        2) The current page of products belonging to the category
+        and the pagination data
+        3) The facets and the current filters as a query string
+        4) The estimated displayed quantity of each product based
+        on the cart
         """
 
         ctx = super(__class__, self).get_context_data(**kwargs)
-        ctx['category'] = Category.objects.get(id=self.kwargs["cat_id"])
-        ctx['products'] = Product.objects.filter(
-            category_id=self.kwargs["cat_id"]
-        ).values()
+        ctx['category'] = self.category
+        ctx['sort'] = self.get_sort()
+        ctx['per_page'] = self.get_paginate_by(None)
+        ctx['subcategory_facet'], ctx['price_facet'] = self.get_facets()
+        filter_params = self.get_filter_params()
+        ctx['filter_query'] = (
+            "&" + urlencode(filter_params) if filter_params else ""
+        )
+        cart = Cart.storage(self.request).load()
         for product in ctx['products']:
-            product_id = str(product["id"])
-            session = self.request.session
-            if ("cart" not in session or product_id not in session["cart"]):
-                product["quantity"] = 1
-            else:
-                product["quantity"] = session["cart"][product_id]["quantity"]
+            product["quantity"] = cart.get(str(product["id"]), 1)
+        return GeneralContextMixin.common_data(self.request, ctx)
+
+
+class SearchView(ListView):
+    """
+    Searches the products by the words in ?q= (see ebag.search),
+    the best matching first, paginated by page number.
+    """
+    template_name = 'search.html'
+    context_object_name = 'products'
+    product_fields = CategoryView.product_fields
+
+    def get_query(self):
+        return self.request.GET.get("q", "")[:100]
+
+    def get_queryset(self):
+        """
+        Returns the ids of the found products, their
+        data is loaded only for the displayed page.
+        """
+        return [
+            product_id for product_id, score in SearchIndex.search(
+                self.get_query(), settings.SEARCH_MAX_RESULTS
+            )
+        ]
+
+    def get_paginate_by(self, queryset):
+        return settings.CATEGORY_PAGE_SIZE
+
+    def get_context_data(self, **kwargs):
+        """
+        Prepares for passing to the template a context, containing:
+        1) The query
+        2) The current page of the found products and the pagination
+        data
+        3) The estimated displayed quantity of each product based
+        on the cart
+        """
+        ctx = super(__class__, self).get_context_data(**kwargs)
+        products = {
+            product["id"]: product for product in
+            Product.objects.filter(id__in=ctx["products"]).values(
+                *self.product_fields
+            )
+        }
+        cart = Cart.storage(self.request).load()
+        # A product deleted since it was found is skipped
+        ctx["products"] = [
+            products[product_id] for product_id in ctx["products"]
+            if product_id in products
+        ]
+        for product in ctx["products"]:
+            product["quantity"] = cart.get(str(product["id"]), 1)
+        ctx["query"] = self.get_query()
         return GeneralContextMixin.common_data(self.request, ctx)
 
 
+def autocomplete_view(request):
+    """
+    Returns the completions of the words being typed in ?q=:
+    the matching terms and the best matching products, the
+    products data read from ProductCache.
+    """
+    query = request.GET.get("q", "")[:100]
+    limit = settings.SEARCH_AUTOCOMPLETE_LIMIT
+    found = SearchIndex.search(query, limit, prefix=True)
+    products = ProductCache.get_many(
+        product_id for product_id, score in found
+    )
+    return JsonResponse({
+        "terms": SearchIndex.complete(query, limit),
+        "products": [
+            {
+                "id": product_id,
+                "name": products[product_id]["name"],
+                "price": products[product_id]["price"],
+            }
+            for product_id, score in found if product_id in products
+        ],
+    })
+
+
+def home_page_params(request):
+    """
+    The home page doesn't depend on the query string,
+    so all its requests share its PageCache entry.
+    """
+    return []
+
+
+@GeneralContextMixin.page_cache(home_page_params)
+@GeneralContextMixin.conditional(GeneralContextMixin.etag)
 def home_view(request):
     return render(
         request,
@@ -149,12 +668,16 @@ def cart_view(request):
 @GeneralContextMixin.validate_referrer(['/checkout/'])
 def thank_you_view(request):
     """
-    Displayed after successful checkout.
+    Displayed after successful checkout, with the order number.
     """
+    order_number = request.GET.get("order", "")
+    ctx = {
+        "order_number": order_number if order_number.isdigit() else None
+    }
     return render(
         request,
         "thank-you.html",
-        GeneralContextMixin.common_data(request)
+        GeneralContextMixin.common_data(request, ctx)
     )
 
 
@@ -165,9 +688,27 @@ def checkout_view(request):
     if request.method == "POST":
         form = CheckoutForm(request.POST)
         if form.is_valid():
-            del request.session["cart"]
-            request.session.save()
-            return redirect("thank_you_view")
+            storage = Cart.storage(request)
+            holder = None
+            if settings.STOCK_RESERVATIONS:
+                holder = StockReservations.holder(request)
+            try:
+                order = Orders.place(storage.load(), form.cleaned_data, holder)
+            except OutOfStock as e:
+                form.add_error(None, settings.ERR_MSG_OUT_OF_STOCK_ORDER % (
+                    ", ".join(
+                        product.name for product in
+                        Product.objects.filter(pk__in=e.product_ids)
+                    )
+                ))
+            else:
+                storage.clear()
+                if order is None:
+                    return redirect("home_view")
+                return redirect("%s?%s" % (
+                    reverse("thank_you_view"),
+                    urlencode({"order": order.number})
+                ))
     ctx = {
         "form": form
     }
@@ -178,67 +719,181 @@ def checkout_view(request):
     )
 
 
+def cart_widget_view(request):
+    """
+    Returns the per-visitor data of the pages served from
+    PageCache: the CSRF token, the number of items in the
+    cart and the products quantities.
+    """
+    cart = Cart.hydrate(Cart.storage(request).load())
+    response = JsonResponse({
+        "csrf_token": get_token(request),
+        "items_in_cart": len(cart),
+        "cart": {
+            product_id: item["quantity"]
+            for product_id, item in cart.items()
+        },
+    })
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+
+
+def metrics_view(request):
+    """
+    Exposes the metrics of all the worker processes
+    in the Prometheus text format. The ?token= must match
+    settings.METRICS_TOKEN, the metrics are not served (404)
+    until a token is set.
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        raise Http404
+    if not constant_time_compare(request.GET.get("token", ""), token):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        metrics.expose(),
+        content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def product_feed_view(request, format):
+    """
+    Streams the products feed in the format (csv, jsonl or xml),
+    gzipped if the client accepts it. The ?token= must match
+    settings.PRODUCT_FEED_TOKEN, the feed is not served (404)
+    until a token is set.
+    """
+    token = settings.PRODUCT_FEED_TOKEN
+    if format not in ProductFeed.CONTENT_TYPES or not token:
+        raise Http404
+    if not constant_time_compare(request.GET.get("token", ""), token):
+        return HttpResponseForbidden()
+    compress = ProductFeed.accepts_gzip(
+        request.META.get("HTTP_ACCEPT_ENCODING", "")
+    )
+    feed = ProductFeed(format, request.build_absolute_uri("/"))
+    response = StreamingHttpResponse(
+        feed.stream(compress), content_type=feed.content_type
+    )
+    if compress:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
 class AJAXSessionCart(TemplateView):
     template_name = None
+    # The stock reservations holder id set in the response cookie
+    new_holder = None
+    # The ebag_cart_errors_total label of each error message
+    ERROR_LABELS = {
+        settings.ERR_MSG_NO_PRODUCT: "no_product",
+        settings.ERR_MSG_INVALID_PARAMS: "invalid_params",
+        settings.ERR_MSG_OUT_OF_STOCK: "out_of_stock",
+    }
 
     def set_init_vars(self):
         """
         Assigns to the class the main
         varibales, later used in the JSON response
+        and loads the cart from the cart storage.
         """
         self.success = 1
         self.items_in_cart = 0
         self.err_msg = ""
-        if "cart" not in self.request.session:
-            self.request.session["cart"] = {}
-        self.cart = self.request.session["cart"]
+        self.storage = Cart.storage(self.request)
+        self.cart = self.storage.load()
 
     def set_cart(self):
         """
-        Deletes the session cart if it's empty.
-        Assigns to the object cart property
-        an empty dict if the cart is empty
-        or the session cart if it's not empty.
+        Saves the cart in the cart storage,
+        which deletes it if it's empty.
         """
-        if self.items_in_cart < 1:
-            del self.request.session["cart"]
-            self.request.session.save()
-        try:
-            self.cart = self.request.session["cart"]
-        except KeyError:
-            self.cart = {}
+        self.storage.save(self.cart)
 
     def post(self, request):
         """
         Sets the default returned values for the JSON output.
-        Validates the input data.
-        Processes each item by saving it in the session cart
-        and calls the return function.
+        Validates the whole input data, loads all the products
+        with a single query, updates the items in the cart
+        in one pass, saves it and calls the return function.
         """
         self.set_init_vars()
+        items = []
         for item in json.loads(request.POST["items"]):
             product_id = item["product_id"]
             quantity = item["quantity"]
             if not self.is_valid_ajax_input((product_id, quantity)):
                 return self.return_error(settings.ERR_MSG_INVALID_PARAMS)
-            int_quantity = int(quantity)
-            if int_quantity > 0:
-                product = Product.objects.filter(id=product_id)
-                if not product:
-                    return self.return_error(settings.ERR_MSG_NO_PRODUCT)
-                else:
-                    self.update_cart_with_product(
-                        product_id,
-                        quantity,
-                        product
-                    )
-            else:
+            items.append((product_id, quantity))
+        products = self.get_products([
+            product_id for product_id, quantity in items
+            if int(quantity) > 0
+        ])
+        if products is None:
+            return self.return_error(settings.ERR_MSG_NO_PRODUCT)
+        if settings.STOCK_RESERVATIONS:
+            try:
+                self.reserve_stock(items, products)
+            except OutOfStock:
+                return self.return_error(settings.ERR_MSG_OUT_OF_STOCK)
+        for product_id, quantity in items:
+            if int(quantity) > 0:
+                metrics.CART_OPERATIONS.inc(
+                    operation="update" if product_id in self.cart else "add"
+                )
+                self.update_cart_with_product(product_id, quantity)
+            elif product_id in self.cart:
+                metrics.CART_OPERATIONS.inc(operation="remove")
                 self.delete_product_from_cart(product_id)
-        self.request.session.save()
-        self.items_in_cart = len(self.request.session["cart"])
+        self.items_in_cart = len(self.cart)
         self.set_cart()
+        self.cart = Cart.hydrate(self.cart)
         return self.return_json()
 
+    def get_products(self, product_ids):
+        """
+        Returns a dict with the data of the products with
+        the given ids, loaded with a single cached lookup and
+        keyed by the integer product id, or None if any of the
+        products does not exist.
+
+        :param product_ids: The products ids
+        :type product_ids: list
+        """
+        product_ids = set(int(product_id) for product_id in product_ids)
+        if not product_ids:
+            return {}
+        products = ProductCache.get_many(product_ids)
+        if len(products) != len(product_ids):
+            return None
+        return products
+
+    def reserve_stock(self, items, products):
+        """
+        Reserves the stock of the changed cart items whose stock
+        is tracked, see StockReservations. Raises OutOfStock.
+
+        :param items: The (product_id, quantity) of the updated items
+        :type items: list
+        :param products: The products data, see get_products()
+        :type products: dict
+        """
+        quantities = {
+            int(product_id): int(quantity)
+            for product_id, quantity in items
+            if quantity != self.cart.get(product_id) and (
+                product_id in self.cart or int(quantity) > 0 and
+                products[int(product_id)]["stock"] is not None
+            )
+        }
+        if not quantities:
+            return
+        holder = StockReservations.holder(self.request)
+        if holder is None:
+            holder = self.new_holder = StockReservations.new_holder()
+        StockReservations.reserve(holder, quantities)
+
     def return_error(self, error):
         """
         Eventually returns JsonResponse
@@ -250,6 +905,7 @@ class AJAXSessionCart(TemplateView):
 
         self.success = 0
         self.err_msg = error
+        metrics.CART_ERRORS.inc(error=self.ERROR_LABELS.get(error, "other"))
         return self.return_json()
 
     def delete_product_from_cart(self, product_id):
@@ -259,12 +915,9 @@ class AJAXSessionCart(TemplateView):
         :param var: product_id
         :type var: str
         """
-        try:
-            del self.request.session["cart"][product_id]
-        except KeyError:
-            pass
+        self.cart.pop(product_id, None)
 
-    def update_cart_with_product(self, product_id, quantity, product):
+    def update_cart_with_product(self, product_id, quantity):
         """
         Adds/updates a product in cart.
 
@@ -272,20 +925,8 @@ class AJAXSessionCart(TemplateView):
         :type product_id: str
         :param quantity: Quantity
         :type quantity: str
-        :param product: The product filtered queryset
-        :type product: QuerySet
         """
-        product_data = {
-                k: str(v) for k, v in
-                product.values()[0].items()
-            }
-        self.request.session["cart"].update(
-            {product_id: {
-                "quantity": quantity,
-                "product_data": product_data
-                }
-             }
-        )
+        self.cart[product_id] = quantity
 
     def return_json(self):
         """
@@ -297,7 +938,10 @@ class AJAXSessionCart(TemplateView):
             'items_in_cart': self.items_in_cart,
             'cart': self.cart
         }
-        return JsonResponse(data)
+        response = JsonResponse(data)
+        if self.new_holder is not None:
+            StockReservations.set_holder(response, self.new_holder)
+        return response
 
     def is_valid_ajax_input(self, fields):
         """
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -49,20 +51,24 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ebag.middleware.ProfilingMiddleware',
+    'ebag.middleware.MetricsMiddleware',
+    'ebag.querydetector.QueryDetectorMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'ebag.middleware.ProfilingSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'ebag.middleware.CartStorageMiddleware',
 ]
 
 ROOT_URLCONF = 'eshop.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'ebag.profiling.ProfilingDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, "templates")],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -93,6 +99,54 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# "default" is local to each worker process, "shared" is seen by all the
+# Gunicorn workers. The tests run against a temporary database, so they
+# must not share the file-based cache with the running website.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'eshop-local',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'shared'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # Local stand-in for a network key-value store, used by
+    # ebag.cart.KeyValueCartStorage
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'carts'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+if 'test' in sys.argv:
+    for alias in ('shared', 'carts'):
+        CACHES[alias] = {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'eshop-' + alias,
+        }
+
+# Categories tree cache: cache aliases and timeout in seconds
+# (None - until invalidated by a category change)
+CATEGORY_TREE_LOCAL_CACHE = 'default'
+CATEGORY_TREE_SHARED_CACHE = 'shared'
+CATEGORY_TREE_CACHE_TIMEOUT = None
+
+# Products data cache, used to display the cart: cache alias and timeout
+# in seconds. Invalidated on product change, the timeout only covers
+# bulk updates which don't send signals.
+PRODUCT_CACHE = 'shared'
+PRODUCT_CACHE_TIMEOUT = 60 * 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -138,12 +192,177 @@ MEDIA_URL = STATIC_URL + "images/"
 # Subcategories level indentation in admin panel
 MPTT_ADMIN_LEVEL_INDENT = 20
 
-# String for replacement with item id
-PK_PLACEHOLDER = "{%pk%}"
+# Number of products per category page, the default one and the
+# maximum one which can be requested with ?per_page=
+CATEGORY_PAGE_SIZE = 24
+CATEGORY_MAX_PAGE_SIZE = 96
+
+# The price facet ranges bounds of the category page: under 5, 5 - 10,
+# ... 100 and more. Run python manage.py rebuild_category_stats after
+# changing them
+PRICE_FACET_BOUNDS = (5, 10, 20, 50, 100)
+
+# The order numbers reserved at once by a worker process
+# (see ebag.orders.OrderNumbers)
+ORDER_NUMBER_BLOCK_SIZE = 20
+
+# Stock reservations (see ebag.stock.StockReservations): the stock of
+# the products added to a cart is held for STOCK_RESERVATION_TIMEOUT
+# seconds after the last cart change, under a holder id kept in the
+# STOCK_RESERVATION_COOKIE cookie. The expired reservations are given
+# back by python manage.py sweep_reservations --interval 60
+STOCK_RESERVATIONS = False
+STOCK_RESERVATION_TIMEOUT = 15 * 60
+STOCK_RESERVATION_COOKIE = 'stock_holder'
+
+# Job queue (see ebag.jobs), run by python manage.py run_jobs: a claimed
+# job is claimed again by another worker after JOB_LEASE seconds, a
+# failed one is retried after JOB_RETRY_DELAY seconds, doubled with every
+# attempt up to JOB_RETRY_MAX_DELAY, and marked as failed after
+# JOB_MAX_ATTEMPTS attempts. The workers claim JOB_BATCH_SIZE jobs at
+# once and check the queue every JOB_POLL_INTERVAL seconds when idle
+JOB_LEASE = 5 * 60
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_RETRY_MAX_DELAY = 60 * 60
+JOB_BATCH_SIZE = 10
+JOB_POLL_INTERVAL = 1
+
+# The order confirmation e-mails, printed to the console
+# until a real e-mail backend is configured
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+DEFAULT_FROM_EMAIL = 'orders@ebag.bg'
+ORDER_EMAIL_SUBJECT = "Your Ebag.bg order No. %d"
+
+# Cart storage backend, one of:
+# ebag.cart.SessionCartStorage - in the session (DB)
+# ebag.cart.SignedCookieCartStorage - in a signed cookie, no server writes
+# ebag.cart.KeyValueCartStorage - in the CART_KV_CACHE cache
+CART_STORAGE = 'ebag.cart.SessionCartStorage'
+CART_KV_CACHE = 'carts'
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 14
+
+# Request profiling (see ebag.middleware.ProfilingMiddleware):
+# PROFILING_ENABLED - profile every request
+# PROFILING_HEADER_TOKEN - profile the requests sent with the header
+# X-Profile: <token>, disabled if None
+# PROFILING_CPROFILE_RATE - fraction of the profiled requests run under
+# cProfile, with the stats saved to PROFILING_CPROFILE_DIR
+PROFILING_ENABLED = False
+PROFILING_HEADER_TOKEN = None
+PROFILING_CPROFILE_RATE = 0.0
+PROFILING_CPROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+
+# N+1 queries detection (see ebag.querydetector): a request executing
+# the same query shape more than QUERY_DETECTOR_THRESHOLD times logs a
+# warning, or fails when the tests run
+QUERY_DETECTOR_ENABLED = DEBUG or 'test' in sys.argv
+QUERY_DETECTOR_RAISE = 'test' in sys.argv
+QUERY_DETECTOR_THRESHOLD = 5
+
+# Directory of the metrics files, one per worker process, exposed
+# summed up at /metrics (see ebag.metrics) and the token the /metrics
+# requests must pass as ?token=, the metrics are not served while it's
+# None. The counters are reset with python manage.py clear_metrics
+METRICS_DIR = os.path.join(BASE_DIR, "metrics")
+if 'test' in sys.argv:
+    METRICS_DIR = tempfile.mkdtemp(prefix='eshop-metrics-')
+METRICS_TOKEN = None
+
+# The profiled requests (as JSON lines), the repeated queries
+# and the failed jobs are logged to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'ebag.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'ebag.images': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'ebag.queries': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'ebag.jobs': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Part of the home and category pages ETag and full-page cache key,
+# change it when the templates change, so that the old pages are
+# not served
+ETAG_VERSION = '4'
+
+# Full-page cache of the home and category pages for the visitors
+# with an empty cart (see ebag.caching.PageCache): cache alias and
+# timeout in seconds. The CSRF token and the cart widget of the cached
+# pages are loaded by JavaScript from /cart/widget/
+FULL_PAGE_CACHE = False
+FULL_PAGE_CACHE_ALIAS = 'shared'
+FULL_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Products search index (see ebag.search): the index directory, the
+# maximum number of results, the autocomplete suggestions and the terms
+# a word being typed is expanded to. Rebuilt, folding in the changes
+# logged since the last build, with python manage.py build_search_index
+# and by a job queued whenever the changes log grows by
+# SEARCH_LOG_COMPACT_SIZE bytes
+SEARCH_INDEX_DIR = os.path.join(BASE_DIR, "search")
+if 'test' in sys.argv:
+    SEARCH_INDEX_DIR = tempfile.mkdtemp(prefix='eshop-search-')
+SEARCH_MAX_RESULTS = 200
+SEARCH_AUTOCOMPLETE_LIMIT = 8
+SEARCH_MAX_EXPANSIONS = 50
+SEARCH_LOG_COMPACT_SIZE = 1024 * 1024
+
+# Product image derivatives (see ebag.images): the widths the uploaded
+# images are resized to, the JPEG and WebP quality, the background
+# threads generating them per worker process (0 to generate them during
+# the request), the default sizes attribute of the product images, the
+# seconds a missing derivatives manifest is not looked for again and
+# the number of the images whose manifest or miss is kept in memory.
+# Generated for the existing images with
+# python manage.py generate_product_images
+PRODUCT_IMAGE_WIDTHS = (150, 300, 600)
+PRODUCT_IMAGE_QUALITY = 85
+PRODUCT_IMAGE_WEBP_QUALITY = 80
+PRODUCT_IMAGE_WORKERS = 2
+if 'test' in sys.argv:
+    PRODUCT_IMAGE_WORKERS = 0
+PRODUCT_IMAGE_SIZES = "(max-width: 576px) 100vw, 300px"
+PRODUCT_IMAGE_MISS_TIMEOUT = 10
+PRODUCT_IMAGE_CACHE_SIZE = 10000
+
+# Product feed of the marketing partners (see ebag.exporting): the
+# products read per query, the currency of the XML feed prices and
+# the token the /feed/products.<csv|jsonl|xml> requests must pass as
+# ?token=, the feed is not served while it's None. Exported to a file with
+# python manage.py export_products
+PRODUCT_FEED_CHUNK_SIZE = 1000
+PRODUCT_FEED_CURRENCY = 'BGN'
+PRODUCT_FEED_TOKEN = None
 
 # AJAX error messages
 ERR_MSG_NO_PRODUCT = "Invalid product_id!"
 ERR_MSG_INVALID_PARAMS = "Invalid parameters!"
+ERR_MSG_OUT_OF_STOCK = "Not enough stock!"
+ERR_MSG_OUT_OF_STOCK_ORDER = "Sorry, not enough stock of: %s."
 
 # Used by django-test-without-migrations
 TEST_WITHOUT_MIGRATIONS_COMMAND = 'django_nose.management.commands.test.Command'
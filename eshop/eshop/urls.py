@@ -30,6 +30,13 @@ urlpatterns = [
     path('cart/update/', views.AJAXSessionCart.as_view(), name='update_cart'),
     path('', views.home_view, name='home_view'),
     path('cart/', views.cart_view, name='cart_view'),
+    path('cart/widget/', views.cart_widget_view, name='cart_widget'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('search/autocomplete/', views.autocomplete_view,
+         name='search_autocomplete'),
     path('checkout/', views.checkout_view, name='checkout_view'),
     path('thank-you/', views.thank_you_view, name='thank_you_view'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('feed/products.<str:format>', views.product_feed_view,
+         name='product_feed'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)